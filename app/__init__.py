@@ -13,23 +13,23 @@ __author__= "japp <japp@iac.es>"
 
 from flask import Flask, make_response, request
 from flask import request, redirect, Response
-from flask import render_template, jsonify
+from flask import render_template, jsonify, abort, url_for
 import datetime
+import functools
+import os
+import time
 from sys import exit
 import socket
 
 from astropy import units as u
 from astropy.coordinates import SkyCoord
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 
 import sys
 
 if sys.version_info.major < 3:
     from urllib2 import urlopen
-    from StringIO import StringIO
 else:
     from urllib.request import urlopen
-    from io import BytesIO as StringIO
 
 # -- END IMPORTS ---------------------------
 
@@ -38,15 +38,224 @@ hostname = socket.gethostname()
 
 app = Flask(__name__)
 
+# Plot output formats and their mimetypes
+PLOT_FORMATS = {
+    'png' : 'image/png',
+    'svg' : 'image/svg+xml',
+    'webp' : 'image/webp',
+    'jpeg' : 'image/jpeg',
+}
+
+# Rendered plots are kept in the cache shared by all the workers,
+# opened on first use (app.cache.get_cache)
+from app.cache import get_cache, cache_key
+
+
+@functools.lru_cache()
+def get_name_resolver():
+    """
+    Object names resolver for /submit, with a persistent cache
+
+    It is created on first use, so STARALT_NAMES_CACHE can be set until then.
+    The cache is optionally seeded from a local catalogue (name, RA, Dec in
+    degrees) set in STARALT_CATALOGUE.
+
+    """
+
+    from app.cache import cache_directory, private_file
+    from app.resolver import NameCache, Resolver
+
+    names_path = os.environ.get('STARALT_NAMES_CACHE') or os.path.join(cache_directory(), 'names.sqlite')
+    name_resolver = Resolver(NameCache(private_file(names_path)))
+
+    if os.environ.get('STARALT_CATALOGUE'):
+        name_resolver.cache.seed(os.environ['STARALT_CATALOGUE'])
+
+    return name_resolver
+
+
+def submit_names(objects):
+    """
+    Object names to resolve in the objects field of the /submit form
+
+    Lines with a single field are names, the others have coordinates.
+    """
+
+    return [obj.strip() for obj in objects.strip().split("\r\n") if len(obj.split(",")) == 1]
+
+
+def plot_options(params):
+    """
+    Output format, resolution and size of a plot from the request parameters
+
+    Parameters
+    ----------
+    params : dict
+        Request parameters, with optional 'format' (png, svg, webp, jpeg),
+        'dpi', and 'width' and 'height' in inches
+
+    Returns
+    -------
+    options : dict
+        Plot options, with 'format', 'dpi' and 'figsize' keys
+
+    """
+
+    plot_format = str(params.get('format', 'png')).lower()
+
+    if plot_format == 'jpg':
+        plot_format = 'jpeg'
+
+    if plot_format not in PLOT_FORMATS:
+        abort(400, "Invalid plot format {}".format(plot_format))
+
+    try:
+        dpi = float(params.get('dpi', 100))
+        width = float(params.get('width', 11))
+        height = float(params.get('height', 6))
+    except (TypeError, ValueError):
+        abort(400, "Invalid plot dpi or size")
+
+    # Keep the image size within reasonable limits
+    options = {
+        'format' : plot_format,
+        'dpi' : min(max(dpi, 20), 300),
+        'figsize' : (min(max(width, 2), 20), min(max(height, 2), 20))
+    }
+
+    return options
+
+
+from app.constraints import TargetError
+
+@app.errorhandler(TargetError)
+def invalid_target(error):
+    """
+    Invalid targets in a request are client errors, reported as JSON
+    """
+
+    response = jsonify({'error': str(error)})
+    response.status_code = 400
+
+    return response
+
+
+def admission_control(name):
+    """
+    Admission control of a view, see app.admission
+
+    The capacity and the cost estimate of the request are the ones
+    of the endpoint in app.admission.controllers and app.admission.costs.
+    Requests already admitted by the ASGI adapter (app.asgi) are run directly.
+
+    Parameters
+    ----------
+    name : str
+        Endpoint name, from app.admission.controllers
+
+    """
+
+    from app.admission import controllers, costs
+
+    controller = controllers[name]
+    cost = costs[name]
+
+    def decorator(view):
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+
+            if request.environ.get('staralt.admitted'):
+                return view(*args, **kwargs)
+
+            data = request.get_json(silent=True) or request.form.to_dict()
+
+            # Malformed requests (a JSON list, dates or numbers that can
+            # not be parsed) are rejected before any work
+            try:
+                request_cost = cost(data)
+            except (AttributeError, KeyError, TypeError, ValueError):
+                response = jsonify({'error': 'Invalid request data'})
+                response.status_code = 400
+                return response
+
+            rejection = controller.acquire(request_cost)
+
+            if rejection:
+                status, retry_after = rejection
+                response = jsonify({'error': 'Service overloaded, retry later',
+                                    'retry_after': retry_after})
+                response.status_code = status
+                response.headers['Retry-After'] = str(retry_after)
+                return response
+
+            start = time.perf_counter()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                controller.release(request_cost, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def cached_plot(key, figure, options):
+    """
+    Rendered plot from the shared cache, drawn and rendered only if missing
+
+    Plots are stored under their own namespace of the cache (see plot_key),
+    so /plot/<key> only serves plots. The /plot/<key> URLs of /submit are
+    served by any worker only with the shared SQLite cache backend.
+
+    Parameters
+    ----------
+    key : str
+        Plot cache key
+    figure : function
+        Function returning the matplotlib figure
+    options : dict
+        Plot options, from plot_options
+
+    Returns
+    -------
+    image : bytes
+        Rendered plot
+
+    """
+
+    from app.staralt import render
+
+    image, options = get_cache().get_or_set(
+        plot_key(key), lambda: (render(figure(), options['format'], options['dpi']), options), ttl=86400)
+
+    return image
+
+
+def plot_key(key):
+    """Shared cache key of a rendered plot"""
+
+    return 'plot:' + key
+
+
+def plot_response(image, options):
+    """
+    Response for a rendered plot
+    """
+
+    response = make_response(image)
+    response.mimetype = PLOT_FORMATS[options['format']]
+
+    return response
+
+
 @app.route('/submit', methods=['POST', 'GET'])
+@admission_control('submit')
 def submit():
     """
     staralt form
 
     """
-    import base64
-    from io import BytesIO
-    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
     from app.staralt import staralt, get_location
 
     data = {}
@@ -64,6 +273,12 @@ def submit():
 
         objects_list = []
 
+        # Names are resolved together, only the ones not in the cache are requested.
+        # In ASGI mode they are already resolved, awaited by the adapter (app.asgi).
+        resolved = request.environ.get('staralt.resolved')
+        if resolved is None:
+            resolved = get_name_resolver().resolve(submit_names(request.form['objects']))
+
         for obj in objects_str:
             obj_info = obj.split(",")
             try:
@@ -71,7 +286,8 @@ def submit():
                     c = "{0} {1}".format(obj_info[1], obj_info[2])
                     coordinates = SkyCoord(c, unit=(u.hourangle, u.deg))
                 elif len(obj_info) == 1:
-                    coordinates = SkyCoord.from_name(obj_info[0])
+                    ra, dec = resolved[obj.strip()]
+                    coordinates = SkyCoord(ra, dec, unit='deg')
 
                 if len(obj_info) in [1, 3]:
                     objects_list.append({'name': obj_info[0],
@@ -94,15 +310,83 @@ def submit():
         observatory = "OT"
         objects_list = []
 
+    options = plot_options(request.values)
+
+    # The plot is referenced by URL, rendered only if not cached
+    key = cache_key('submit', observatory, date, objects_list, options)
+
     # matplotlib figure
-    fig = staralt(observatory, date, objects_list, transits=[])
-    canvas = FigureCanvas(fig)
-    figfile = BytesIO()
-    canvas.print_png(figfile)
+    cached_plot(key, lambda: staralt(observatory, date, objects_list, transits=[],
+                                     figsize=options['figsize']), options)
 
-    plot = base64.b64encode(figfile.getvalue())
-  
-    return render_template('submit.html', data=data, plot=plot.decode('utf8'), objects_list=objects_list_str)
+    plot = url_for('plot_image', key=key)
+
+    return render_template('submit.html', data=data, plot=plot, objects_list=objects_list_str)
+
+
+@app.route('/plot/<key>', methods=['GET'])
+def plot_image(key):
+    """
+    Rendered plot from /submit
+
+    Parameters
+    ----------
+    key : str
+        Plot cache key
+
+    Returns
+    -------
+    response : image
+        Altitude plot in the format requested in /submit
+
+    """
+
+    cached = get_cache().get(plot_key(key))
+
+    if cached is None:
+        abort(404)
+
+    image, options = cached
+
+    response = plot_response(image, options)
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    response.set_etag(key)
+
+    return response.make_conditional(request)
+
+
+@app.route('/admission', methods=['GET'])
+def admission_status():
+    """
+    Admission control status
+
+    Returns
+    -------
+    resp : application/json
+        Requests in progress, queue depth and rejection counters of each endpoint
+
+    """
+
+    from app.admission import controllers
+
+    return jsonify({name: controller.stats() for name, controller in controllers.items()})
+
+
+@app.route('/cache', methods=['GET'])
+def cache_status():
+    """
+    Memoized observability results statistics
+
+    Returns
+    -------
+    resp : application/json
+        Hits, misses and hit rate of each endpoint, in this worker
+
+    """
+
+    from app.cache import memoize_stats
+
+    return jsonify(memoize_stats())
 
 
 @app.route('/', methods=['POST', 'GET'])
@@ -132,6 +416,7 @@ def status():
 
 @app.route('/staralt')
 @app.route('/staralt/<date>/<observatory>', methods=['GET'])
+@admission_control('staralt')
 def staralt(date=None, observatory='OT'):
     """
     Create a basic altitude plot for the indicated date. Location is OT.
@@ -144,10 +429,13 @@ def staralt(date=None, observatory='OT'):
         Observation code, from the locations available at staralt.get_location.
         Default OT.
 
+    Optional query parameters: format (png, svg, webp, jpeg), dpi,
+    width and height (inches).
+
     Returns
     -------
-    response : image/png
-        Altitude plot in png format
+    response : image
+        Altitude plot, in png format by default
 
     """
 
@@ -163,24 +451,23 @@ def staralt(date=None, observatory='OT'):
         # Add UTC timezone to date
         date = date.replace(tzinfo=pytz.UTC)
 
-    # matplotlib figure
-    fig = staralt(observatory, date, [])
-
-    canvas = FigureCanvas(fig)
+    options = plot_options(request.args)
+    key = cache_key('staralt', observatory, date, options)
 
-    output = StringIO()
-
-    canvas.print_png(output)
-    response = make_response(output.getvalue())
-    response.mimetype = 'image/png'
+    # matplotlib figure
+    image = cached_plot(key, lambda: staralt(observatory, date, [], figsize=options['figsize']),
+                        options)
 
-    return response
+    return plot_response(image, options)
 
 
 @app.route('/altitudeplot', methods=['POST', 'GET'])
+@admission_control('altitudeplot')
 def plot():
     """
     ReST service for an altitude plot
+
+    Optional keys: format (png, svg, webp, jpeg), dpi, width and height (inches)
     """
     
 
@@ -203,20 +490,153 @@ def plot():
     else:
         twilight = 'astronomical'
 
-    fig = staralt(data['observatory'], date, data['objects'], transits, twilight)
+    options = plot_options(data)
+    key = cache_key('altitudeplot', data['observatory'], date, data['objects'],
+                    transits, twilight, options)
 
-    canvas = FigureCanvas(fig)
+    image = cached_plot(key, lambda: staralt(data['observatory'], date, data['objects'],
+                                             transits, twilight, figsize=options['figsize']),
+                        options)
 
-    output = StringIO()
+    return plot_response(image, options)
 
-    canvas.print_png(output)
-    response = make_response(output.getvalue())
-    response.mimetype = 'image/png'
 
-    return response
+@app.route('/altitudeplot_observability', methods=['POST', 'GET'])
+@admission_control('altitudeplot_observability')
+def plot_observability():
+    """
+    ReST service for an altitude plot and the observability of its targets
+
+    The altitudes are computed once for both. Returns the observability and
+    observable windows of each target, and the URL of the plot:
+
+        {
+            'plot' : '/plot/<key>',
+            'observability' : {
+                'Kelt 8b' : {
+                    'observable' : 'True', 'moon_separation' : 30.4,
+                    'windows' : [['2020-06-11 23:10:05', '2020-06-12 04:30:12']]
+                }
+            }
+        }
+
+    Optional keys: format (png, svg, webp, jpeg), dpi, width and height (inches)
+    """
+
+    from app.staralt import plot_observability
+
+    # POST data from client, converted to json
+    data = request.get_json(silent=True)
+
+    options = plot_options(data)
+
+    objects_observability, figure = plot_observability(data)
+
+    key = cache_key('altitudeplot_observability', data, options)
+    cached_plot(key, lambda: figure(options['figsize']), options)
+
+    return jsonify({
+        'plot': url_for('plot_image', key=key),
+        'observability': objects_observability
+    })
+
+
+@app.route('/visibility', methods=['POST', 'GET'])
+@admission_control('visibility')
+def visibility():
+    """
+    ReST service for the annual visibility chart of a list of targets
+
+    Optional keys: format (png, svg, webp, jpeg, or json for the chart
+    data), dpi, width and height (inches)
+    """
+
+    from app.staralt import visibility_year
+
+    # POST data from client, converted to json
+    data = request.get_json(silent=True)
+
+    if str(data.get('format', 'png')).lower() == 'json':
+        objects_visibility, figure = visibility_year(data)
+        return jsonify(objects_visibility)
+
+    options = plot_options(data)
+    key = cache_key('visibility', data, options)
+
+    image = cached_plot(key, lambda: visibility_year(data)[1](options['figsize']), options)
+
+    return plot_response(image, options)
+
+
+@app.route('/culmination', methods=['POST', 'GET'])
+@admission_control('culmination')
+def culmination():
+    """
+    ReST service for the culmination, best time and observable window of targets in a night
+    """
+
+    from app.staralt import culminations
+
+    # POST data from client, converted to json
+    data = request.get_json(silent=True)
+    objects_culmination = culminations(data)
+
+    return jsonify(objects_culmination)
+
+
+@app.route('/schedule', methods=['POST', 'GET'])
+@admission_control('schedule')
+def schedule():
+    """
+    ReST service for a night schedule of targets with priorities and exposure times
+    """
+
+    from app.staralt import schedule
+
+    # POST data from client, converted to json
+    data = request.get_json(silent=True)
+    night_schedule = schedule(data)
+
+    return jsonify(night_schedule)
+
+
+@app.route('/subscribe', methods=['POST'])
+@admission_control('subscribe')
+def subscribe():
+    """
+    ReST service to register a subscription to the observability of a list of targets
+
+    Returns the subscription token and the observability of all the targets
+    """
+
+    from app.staralt import subscribe
+
+    # POST data from client, converted to json
+    data = request.get_json(silent=True)
+    subscription = subscribe(data)
+
+    return jsonify(subscription)
+
+
+@app.route('/subscription/<token>', methods=['POST', 'GET'])
+@admission_control('subscription')
+def subscription(token):
+    """
+    ReST service with the targets whose observability changed since the previous poll
+    """
+
+    from app.staralt import poll_subscription
+
+    changes = poll_subscription(token)
+
+    if changes is None:
+        abort(404, "Unknown or expired subscription")
+
+    return jsonify(changes)
 
 
 @app.route('/observability', methods=['POST', 'GET'])
+@admission_control('observability')
 def observability():
     """
     ReST service to test observability for multiple targets for a single date
@@ -234,6 +654,7 @@ def observability():
 
 
 @app.route('/observability_dates', methods=['POST', 'GET'])
+@admission_control('observability_dates')
 def observability_dates():
     """
     ReST service to test observability for multiple dates
@@ -249,6 +670,7 @@ def observability_dates():
 
 
 @app.route('/observability_objects', methods=['POST', 'GET'])
+@admission_control('observability_objects')
 def observability_objects():
     """
     ReST service to test observability for multiple targets
@@ -263,6 +685,22 @@ def observability_objects():
     return jsonify(objects_observability)
 
 
+@app.route('/observability_sites', methods=['POST', 'GET'])
+@admission_control('observability_sites')
+def observability_sites():
+    """
+    ReST service to test observability of multiple targets for several observatories
+    """
+
+    from app.staralt import observability_sites
+
+    # POST data from client, converted to json
+    data = request.get_json(silent=True)
+    objects_observability = observability_sites(data)
+
+    return jsonify(objects_observability)
+
+
 @app.route('/transits', methods=['POST', 'GET'])
 def transits():
     """
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+Admission control and load shedding for the expensive services
+
+Each endpoint has a capacity in cost units (curves to plot, or targets x
+time samples to evaluate) estimated from the request, with the time samples
+of its dates or time ranges. Requests wait while the capacity is in use, and
+they are rejected when the queue is full (429) or the expected queue time
+exceeds the endpoint budget (503), with a Retry-After time, so the service
+degrades instead of collapsing.
+
+"""
+
+import math
+import time
+import datetime
+import threading
+
+
+# Time samples of a night, at the 0.5h resolution of the observability services
+NIGHT_SAMPLES = 24
+
+# Time resolution of the observability services, in hours
+RESOLUTION = 0.5
+
+
+class AdmissionController(object):
+    """
+    Concurrency limit and queue time budget of an endpoint
+
+    Parameters
+    ----------
+    name : str
+        Endpoint name
+    capacity : float
+        Maximum cost units in progress at the same time. A request
+        costlier than the capacity is run alone.
+    max_queued : int
+        Maximum number of waiting requests
+    queue_time : float
+        Maximum queue time of a request, in seconds
+    seconds_per_cost : float (optional)
+        Initial estimate of the processing time of one cost unit, in seconds.
+        It is updated with the measured times.
+
+    """
+
+    def __init__(self, name, capacity, max_queued, queue_time, seconds_per_cost=0.01):
+        self.name = name
+        self.capacity = capacity
+        self.max_queued = max_queued
+        self.queue_time = queue_time
+        self.seconds_per_cost = seconds_per_cost
+
+        self.in_progress = 0
+        self.in_progress_cost = 0
+        self.queued = 0
+        self.queued_cost = 0
+        self.admitted = 0
+        self.rejected = {429: 0, 503: 0}
+
+        self._condition = threading.Condition()
+
+    def expected_wait(self, cost):
+        """Expected queue time in seconds of a new request"""
+
+        # Cost units are processed at capacity/seconds_per_cost units per second
+        pending = self.queued_cost + self.in_progress_cost + cost - self.capacity
+
+        return max(pending, 0) * self.seconds_per_cost / self.capacity
+
+    def acquire(self, cost):
+        """
+        Wait for the capacity for a request
+
+        Parameters
+        ----------
+        cost : float
+            Estimated cost of the request
+
+        Returns
+        -------
+        rejection : tuple
+            None if the request is admitted, otherwise the HTTP status
+            code (429 or 503) and the Retry-After time in seconds
+
+        """
+
+        with self._condition:
+
+            expected_wait = self.expected_wait(cost)
+            retry_after = max(1, int(math.ceil(expected_wait)))
+
+            if self.queued >= self.max_queued:
+                self.rejected[429] += 1
+                return 429, retry_after
+
+            if expected_wait > self.queue_time:
+                self.rejected[503] += 1
+                return 503, retry_after
+
+            self.queued += 1
+            self.queued_cost += cost
+            deadline = time.monotonic() + self.queue_time
+
+            try:
+                while self.in_progress_cost > 0 and self.in_progress_cost + cost > self.capacity:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected[503] += 1
+                        return 503, max(1, int(math.ceil(self.expected_wait(cost))))
+                    self._condition.wait(remaining)
+            finally:
+                self.queued -= 1
+                self.queued_cost -= cost
+
+            self.in_progress += 1
+            self.in_progress_cost += cost
+            self.admitted += 1
+
+            return None
+
+    def release(self, cost, duration=None):
+        """
+        Release the capacity of a finished request
+
+        Parameters
+        ----------
+        cost : float
+            Estimated cost of the request
+        duration : float (optional)
+            Processing time of the request, in seconds. None if
+            the request was not run (the client went away).
+
+        """
+
+        with self._condition:
+            self.in_progress -= 1
+            self.in_progress_cost -= cost
+
+            # Moving average of the processing time per cost unit
+            if cost > 0 and duration is not None:
+                self.seconds_per_cost = 0.8*self.seconds_per_cost + 0.2*duration/cost
+
+            self._condition.notify_all()
+
+    def stats(self):
+        """Queue depth, requests in progress and rejection counters"""
+
+        with self._condition:
+            return {
+                'capacity': self.capacity,
+                'in_progress': self.in_progress,
+                'in_progress_cost': self.in_progress_cost,
+                'queued': self.queued,
+                'queued_cost': self.queued_cost,
+                'admitted': self.admitted,
+                'rejected_429': self.rejected[429],
+                'rejected_503': self.rejected[503],
+                'seconds_per_cost': self.seconds_per_cost,
+            }
+
+
+def _parse_date(date):
+    """Date and time of an ISO date, to the second"""
+
+    date = date.strip().replace('T', ' ')
+    for size, date_format in [(19, "%Y-%m-%d %H:%M:%S"), (16, "%Y-%m-%d %H:%M")]:
+        if len(date) >= size:
+            return datetime.datetime.strptime(date[:size], date_format)
+
+    return datetime.datetime.strptime(date, "%Y-%m-%d")
+
+
+def window_samples(start, end):
+    """
+    Time samples of a window at the resolution of the observability services
+
+    Parameters
+    ----------
+    start, end : str
+        Window limits, ISO dates
+
+    Returns
+    -------
+    samples : int
+        Number of time samples, at least one
+
+    Raises
+    ------
+    ValueError
+        If the dates can not be parsed
+
+    """
+
+    start, end = [_parse_date(date) for date in (start, end)]
+    hours = (end - start).total_seconds()/3600
+
+    return max(int(math.ceil(hours/RESOLUTION)), 1)
+
+
+def dates_samples(dates):
+    """
+    Time samples of a list of dates of the observability services
+
+    Each element is a time range [start, end], or a single date that is
+    evaluated for the whole night (NIGHT_SAMPLES).
+
+    """
+
+    return sum(window_samples(*date[:2]) if len(date) > 1 else NIGHT_SAMPLES
+               for date in dates)
+
+
+def staralt_cost(data):
+    """Cost of a /staralt plot: a single object"""
+
+    return 1
+
+
+def plot_cost(data):
+    """Cost of an altitude plot: number of curves, including the Moon"""
+
+    return 1 + len(data.get('objects', []))
+
+
+def submit_cost(data):
+    """Cost of the /submit form plot: number of lines of objects, plus the Moon"""
+
+    return 1 + len(data.get('objects', '').strip().splitlines())
+
+
+def observability_cost(data):
+    """Cost of /observability: targets x time samples from date to date_end"""
+
+    if 'date' in data and 'date_end' in data:
+        samples = window_samples(data['date'], data['date_end'])
+    else:
+        samples = NIGHT_SAMPLES
+
+    return max(len(data.get('objects', [])), 1) * samples
+
+
+def observability_dates_cost(data):
+    """Cost of /observability_dates: time samples of all the dates or time ranges"""
+
+    return max(dates_samples(data.get('dates', [])), 1)
+
+
+def observability_objects_cost(data):
+    """Cost of /observability_objects: time samples of all the targets and dates"""
+
+    samples = sum(dates_samples(target.get('dates', [])) for target in data.get('objects', []))
+
+    return max(samples, 1)
+
+
+def observability_sites_cost(data):
+    """Cost of /observability_sites: sites x targets x time samples"""
+
+    if 'date' in data and 'date_end' in data:
+        samples = window_samples(data['date'], data['date_end'])
+    else:
+        samples = NIGHT_SAMPLES
+
+    return max(len(data.get('observatories', [])) * len(data.get('objects', [])), 1) * samples
+
+
+def visibility_cost(data):
+    """Cost of /visibility: targets x nights x time samples"""
+
+    days = min(max(int(data.get('days', 365)), 1), 366)
+
+    return max(len(data.get('objects', [])), 1) * days * NIGHT_SAMPLES
+
+
+def culmination_cost(data):
+    """Cost of /culmination: targets, computed analytically"""
+
+    return max(len(data.get('objects', [])), 1)
+
+
+def schedule_cost(data):
+    """Cost of /schedule: targets x time slots"""
+
+    slot = max(float(data.get('slot', 5)), 1)
+
+    return max(len(data.get('objects', [])), 1) * int(12*60/slot)
+
+
+def subscribe_cost(data):
+    """Cost of /subscribe: targets x time slots of the rolling window"""
+
+    slots = float(data.get('window', 12))*60 / max(float(data.get('resolution', 5)), 1)
+
+    return max(len(data.get('objects', [])), 1) * int(slots)
+
+
+def subscription_cost(data):
+    """Cost of a subscription poll, only the advanced time slots are evaluated"""
+
+    return NIGHT_SAMPLES
+
+
+# Admission controller of each endpoint
+controllers = {
+    'altitudeplot': AdmissionController('altitudeplot', capacity=400, max_queued=20, queue_time=10),
+    'staralt': AdmissionController('staralt', capacity=4, max_queued=20, queue_time=10),
+    'altitudeplot_observability': AdmissionController('altitudeplot_observability', capacity=400, max_queued=20, queue_time=10),
+    'submit': AdmissionController('submit', capacity=400, max_queued=20, queue_time=10),
+    'visibility': AdmissionController('visibility', capacity=100000, max_queued=20, queue_time=20),
+    'culmination': AdmissionController('culmination', capacity=100000, max_queued=50, queue_time=10),
+    'schedule': AdmissionController('schedule', capacity=1000000, max_queued=20, queue_time=20),
+    'subscribe': AdmissionController('subscribe', capacity=1000000, max_queued=20, queue_time=20),
+    'subscription': AdmissionController('subscription', capacity=1000, max_queued=100, queue_time=10),
+    'observability': AdmissionController('observability', capacity=100000, max_queued=50, queue_time=20),
+    'observability_dates': AdmissionController('observability_dates', capacity=100000, max_queued=50, queue_time=20),
+    'observability_objects': AdmissionController('observability_objects', capacity=100000, max_queued=50, queue_time=20),
+    'observability_sites': AdmissionController('observability_sites', capacity=100000, max_queued=50, queue_time=20),
+}
+
+
+# Cost estimate of each endpoint, from the JSON or form data of the request
+costs = {
+    'altitudeplot': plot_cost,
+    'staralt': staralt_cost,
+    'altitudeplot_observability': plot_cost,
+    'submit': submit_cost,
+    'visibility': visibility_cost,
+    'culmination': culmination_cost,
+    'schedule': schedule_cost,
+    'subscribe': subscribe_cost,
+    'subscription': subscription_cost,
+    'observability': observability_cost,
+    'observability_dates': observability_dates_cost,
+    'observability_objects': observability_objects_cost,
+    'observability_sites': observability_sites_cost,
+}
+
+
+def endpoint_name(path):
+    """
+    Admission controller name of a request path
+
+    The name is the first path segment (/staralt/<date>/<observatory> is
+    'staralt'), or None if the endpoint has no admission control.
+
+    """
+
+    name = path.strip('/').split('/', 1)[0]
+
+    return name if name in controllers else None
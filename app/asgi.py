@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+ASGI serving mode
+
+The Flask application is served by an ASGI server, for instance
+
+    uvicorn app.asgi:application
+
+Reading the request and sending the response are awaited in the event loop,
+while the views (astropy computations, matplotlib renders) run in dedicated
+executors. Plots and JSON services have separate pools, and the status
+service its own, so slow plots do not starve the cheap requests.
+
+Admission control (app.admission) runs in the adapter, before a request is
+queued in the executors, so the queue limits and time budgets apply to the
+requests waiting for a worker, and the counters are shared by all the
+workers when plots are rendered in processes.
+
+The object names of /submit are resolved (Sesame lookups) in an I/O pool
+and awaited before the plot is dispatched to the plot pool, so the lookups
+do not hold plot workers. The names are passed to the view in the environ.
+
+Pool sizes are set with the STARALT_PLOT_WORKERS, STARALT_JSON_WORKERS,
+STARALT_LIGHT_WORKERS and STARALT_IO_WORKERS environment variables. With STARALT_PLOT_PROCESSES=1
+plots are rendered in a pool of processes instead of threads.
+
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+# Executor pool of the endpoints, by path prefix.
+# Other paths (status, static files) are served by the 'light' pool.
+ENDPOINT_POOLS = [
+    ('/altitudeplot', 'plot'),
+    ('/staralt', 'plot'),
+    ('/submit', 'plot'),
+    ('/plot/', 'plot'),
+    ('/visibility', 'plot'),
+    ('/observability', 'json'),
+    ('/transits', 'json'),
+    ('/culmination', 'json'),
+    ('/schedule', 'json'),
+    ('/subscribe', 'json'),
+    ('/subscription/', 'json'),
+]
+
+
+def endpoint_pool(path):
+    """Name of the executor pool for a request path"""
+
+    for prefix, pool in ENDPOINT_POOLS:
+        if path.startswith(prefix):
+            return pool
+
+    return 'light'
+
+
+def call_wsgi(environ, body):
+    """
+    Run a request in the Flask application
+
+    It is run inside the executors, so all the arguments and
+    results are picklable to be used with process pools.
+
+    Parameters
+    ----------
+    environ : dict
+        WSGI environ, without the input and errors streams
+    body : bytes
+        Request body
+
+    Returns
+    -------
+    status : int
+        HTTP status code
+    headers : list
+        Response headers, as (name, value) str tuples
+    content : bytes
+        Response body
+
+    """
+
+    from app import app as wsgi_app
+
+    environ = dict(environ)
+    environ['wsgi.input'] = io.BytesIO(body)
+    environ['wsgi.errors'] = sys.stderr
+
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = headers
+
+    result = wsgi_app(environ, start_response)
+
+    try:
+        content = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+
+    return response['status'], response['headers'], content
+
+
+def admit(environ, body):
+    """
+    Admission control of a request, see app.admission
+
+    The cost is estimated from the JSON or form data, as in the views.
+    It blocks while the request waits for capacity, so it is run
+    in the admission executor.
+
+    Parameters
+    ----------
+    environ : dict
+        WSGI environ, without the input and errors streams
+    body : bytes
+        Request body
+
+    Returns
+    -------
+    admission : tuple
+        Controller and cost of the admitted request, to be released when it
+        finishes, or None if the endpoint has no admission control or the
+        cost cannot be estimated (the view reports the invalid request)
+    rejection : tuple
+        None if the request can run, otherwise the HTTP status
+        code (429 or 503) and the Retry-After time in seconds
+
+    """
+
+    from werkzeug.wrappers import Request
+    from app.admission import controllers, costs, endpoint_name
+
+    name = endpoint_name(environ['PATH_INFO'])
+
+    if name is None:
+        return None, None
+
+    request = Request(dict(environ, **{'wsgi.input': io.BytesIO(body), 'wsgi.errors': sys.stderr}))
+
+    try:
+        cost = costs[name](request.get_json(silent=True) or request.form.to_dict())
+    except Exception:
+        return None, None
+
+    rejection = controllers[name].acquire(cost)
+
+    if rejection:
+        return None, rejection
+
+    return (controllers[name], cost), None
+
+
+def resolve_names(environ, body):
+    """
+    Resolve the object names of a /submit form, see app.get_name_resolver
+
+    It waits for the name resolver service, so it is run in the I/O executor.
+
+    Parameters
+    ----------
+    environ : dict
+        WSGI environ, without the input and errors streams
+    body : bytes
+        Request body
+
+    Returns
+    -------
+    resolved : dict
+        (RA, Dec) in degrees for each name, or None if it is unknown, or
+        None if the request is not a /submit form with objects
+
+    """
+
+    from werkzeug.wrappers import Request
+    from app import get_name_resolver, submit_names
+
+    if environ['PATH_INFO'] != '/submit' or environ['REQUEST_METHOD'] != 'POST':
+        return None
+
+    request = Request(dict(environ, **{'wsgi.input': io.BytesIO(body), 'wsgi.errors': sys.stderr}))
+
+    if 'objects' not in request.form:
+        return None
+
+    return get_name_resolver().resolve(submit_names(request.form['objects']))
+
+
+def cancel_admission(future):
+    """Release the capacity of a request admitted after it was cancelled"""
+
+    if future.cancelled() or future.exception() is not None:
+        return
+
+    admission, rejection = future.result()
+
+    if admission:
+        controller, cost = admission
+        controller.release(cost)
+
+
+def wsgi_environ(scope, body):
+    """
+    WSGI environ from an ASGI HTTP scope
+    """
+
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'REMOTE_ADDR': str(client[0]),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').lower()
+        value = value.decode('latin1')
+
+        if name == 'content-length':
+            continue
+        elif name == 'content-type':
+            key = 'CONTENT_TYPE'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+
+        if key in environ:
+            value = environ[key] + ',' + value
+        environ[key] = value
+
+    return environ
+
+
+class ASGIApplication(object):
+    """
+    ASGI adapter running the Flask views in per-endpoint executors
+
+    Parameters
+    ----------
+    executors : dict
+        Executor for each pool: 'plot', 'json' and 'light', the 'io'
+        executor of the name lookups, and the 'admission' executor
+        where the requests wait for capacity
+
+    """
+
+    def __init__(self, executors):
+        self.executors = executors
+
+    async def __call__(self, scope, receive, send):
+
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        if scope['type'] != 'http':
+            return
+
+        # Request body, awaited without blocking a worker
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+
+        loop = asyncio.get_running_loop()
+        executor = self.executors[endpoint_pool(scope['path'])]
+        environ = wsgi_environ(scope, body)
+
+        # Name lookups are awaited before the request takes any capacity
+        if scope['path'] == '/submit':
+            resolved = await loop.run_in_executor(self.executors['io'], resolve_names, environ, body)
+            if resolved is not None:
+                environ['staralt.resolved'] = resolved
+
+        # Admitted before waiting in the executor queue
+        admitting = loop.run_in_executor(self.executors['admission'], admit, environ, body)
+        try:
+            admission, rejection = await asyncio.shield(admitting)
+        except asyncio.CancelledError:
+            # Client gone while waiting, the capacity is released once admitted
+            admitting.add_done_callback(cancel_admission)
+            raise
+
+        if rejection:
+            status, retry_after = rejection
+            await self.respond(send, status,
+                               [('Content-Type', 'application/json'),
+                                ('Retry-After', str(retry_after))],
+                               json.dumps({'error': 'Service overloaded, retry later',
+                                           'retry_after': retry_after}).encode('utf8'))
+            return
+
+        if admission:
+            environ['staralt.admitted'] = True
+
+        start = time.perf_counter()
+        try:
+            status, headers, content = await loop.run_in_executor(
+                executor, call_wsgi, environ, body)
+        finally:
+            if admission:
+                controller, cost = admission
+                controller.release(cost, time.perf_counter() - start)
+
+        await self.respond(send, status, headers, content)
+
+    async def respond(self, send, status, headers, content):
+        """Send a complete response"""
+
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin1'), value.encode('latin1'))
+                        for name, value in headers],
+        })
+        await send({'type': 'http.response.body', 'body': content})
+
+    async def lifespan(self, receive, send):
+        """Shut down the executors when the server stops"""
+
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for executor in self.executors.values():
+                    executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def create_app(plot_workers=None, json_workers=None, light_workers=None, io_workers=None,
+               plot_processes=None):
+    """
+    Create the ASGI application
+
+    Parameters
+    ----------
+    plot_workers : int (optional)
+        Size of the plots pool. Default STARALT_PLOT_WORKERS or 2.
+    json_workers : int (optional)
+        Size of the JSON services pool. Default STARALT_JSON_WORKERS or 4.
+    light_workers : int (optional)
+        Size of the pool of status and static files. Default STARALT_LIGHT_WORKERS or 2.
+    io_workers : int (optional)
+        Size of the pool of name lookups. Default STARALT_IO_WORKERS or 8.
+    plot_processes : bool (optional)
+        Render the plots in a pool of processes instead of threads.
+        Default STARALT_PLOT_PROCESSES.
+
+    Returns
+    -------
+    application : ASGIApplication
+        ASGI application
+
+    """
+
+    if plot_workers is None:
+        plot_workers = int(os.environ.get('STARALT_PLOT_WORKERS', 2))
+    if json_workers is None:
+        json_workers = int(os.environ.get('STARALT_JSON_WORKERS', 4))
+    if light_workers is None:
+        light_workers = int(os.environ.get('STARALT_LIGHT_WORKERS', 2))
+    if io_workers is None:
+        io_workers = int(os.environ.get('STARALT_IO_WORKERS', 8))
+    if plot_processes is None:
+        plot_processes = os.environ.get('STARALT_PLOT_PROCESSES', '0') == '1'
+
+    if plot_processes:
+        plot_executor = ProcessPoolExecutor(max_workers=plot_workers)
+    else:
+        plot_executor = ThreadPoolExecutor(max_workers=plot_workers, thread_name_prefix='plot')
+
+    # Enough threads for all the requests allowed to wait for capacity,
+    # more are rejected by the controllers without waiting
+    from app.admission import controllers
+    admission_workers = sum(controller.max_queued + 1 for controller in controllers.values())
+
+    executors = {
+        'plot': plot_executor,
+        'json': ThreadPoolExecutor(max_workers=json_workers, thread_name_prefix='json'),
+        'light': ThreadPoolExecutor(max_workers=light_workers, thread_name_prefix='light'),
+        'io': ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix='io'),
+        'admission': ThreadPoolExecutor(max_workers=admission_workers, thread_name_prefix='admission'),
+    }
+
+    return ASGIApplication(executors)
+
+
+application = create_app()
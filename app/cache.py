@@ -0,0 +1,667 @@
+# -*- coding: utf-8 -*-
+"""
+Caches for computed results and rendered plots
+
+Two interchangeable backends are available, with get, set and get_or_set
+methods:
+
+* LRUCache, in-process cache
+* SQLiteCache, cache shared by all the worker processes of the host, stored
+  in a SQLite file, with size limit, least recently used eviction and atomic
+  fills (only one process computes a missing value, the others wait for it)
+
+StateStore and MemoryStateStore keep versioned states (subscriptions) that
+must not be evicted, updated with compare and set, and get_store returns
+the store of the application, in the same file as the shared cache.
+
+get_cache returns the shared cache of the application, configured with the
+STARALT_CACHE environment variable: 'memory' for an in-process cache, or the
+path of the SQLite file (default cache.sqlite in the private cache directory
+of the application, see cache_directory). STARALT_CACHE_SIZE sets its size
+limit in MB (default 256).
+
+Values are stored as JSON, with bytes and numpy arrays encoded, so a cache
+file can only hold data, never code to run when it is read.
+
+"""
+
+import os
+import time
+import json
+import base64
+import hashlib
+import sqlite3
+import threading
+import functools
+import collections
+from contextlib import contextmanager
+
+
+# Minimum time in seconds between updates of the last access time of a
+# value, so cache hits are plain reads that do not take the write lock
+ACCESS_RESOLUTION = 60
+
+_MISSING = object()
+
+
+def cache_directory():
+    """
+    Private cache directory of the application, created if needed
+
+    $XDG_CACHE_HOME/staralt, or ~/.cache/staralt, only accessible by the
+    user running the service.
+
+    Raises
+    ------
+    PermissionError
+        If the directory is owned by another user
+
+    """
+
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    path = os.path.join(base, 'staralt')
+
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    check_owner(path)
+    os.chmod(path, 0o700)
+
+    return path
+
+
+def check_owner(path):
+    """
+    Raise PermissionError if path is not owned by the user running the service
+    """
+
+    if hasattr(os, 'getuid') and os.stat(path).st_uid != os.getuid():
+        raise PermissionError("{} is owned by another user".format(path))
+
+
+def private_file(path):
+    """
+    Check a cache file of the application, creating it readable only by the user
+
+    Symbolic links and files owned by other users are rejected.
+
+    Returns
+    -------
+    path : str
+        The checked file
+
+    """
+
+    flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0)
+    os.close(os.open(path, flags, 0o600))
+    check_owner(path)
+    os.chmod(path, 0o600)
+
+    return path
+
+
+def _encode(value):
+    """JSON representation of the bytes and numpy values"""
+
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+
+    # numpy arrays and scalars, without importing numpy
+    if hasattr(value, 'dtype') and hasattr(value, 'tolist'):
+        if getattr(value, 'ndim', 0) == 0:
+            return value.item()
+        return {'__ndarray__': value.tolist(), 'dtype': str(value.dtype)}
+
+    raise TypeError("{} values can not be cached".format(type(value).__name__))
+
+
+def _decode(item):
+    """Restore the bytes and numpy arrays encoded by _encode"""
+
+    if '__bytes__' in item:
+        return base64.b64decode(item['__bytes__'])
+
+    if '__ndarray__' in item:
+        import numpy as np
+        return np.array(item['__ndarray__'], dtype=item['dtype'])
+
+    return item
+
+
+def dumps(value):
+    """Serialize a cache value: JSON data, bytes and numpy arrays"""
+
+    return json.dumps(value, default=_encode, separators=(',', ':')).encode('utf8')
+
+
+def loads(blob):
+    """Deserialize a cache value stored with dumps"""
+
+    return json.loads(blob.decode('utf8'), object_hook=_decode)
+
+
+class LRUCache(object):
+    """
+    Thread safe in-process cache with least recently used eviction
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of items
+
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the cached value of key, or default if not cached or expired"""
+
+        with self._lock:
+            if key not in self._items:
+                return default
+
+            expires, value = self._items[key]
+            if expires is not None and expires < time.time():
+                del self._items[key]
+                return default
+
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store value for key, evicting the least recently used items if full
+
+        Parameters
+        ----------
+        key : str
+            Cache key
+        value : object
+            Value to store
+        ttl : float (optional)
+            Expiration time in seconds. Default never.
+
+        """
+
+        expires = time.time() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._items[key] = (expires, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def get_many(self, keys):
+        """Return a dict with the cached values of the keys found"""
+
+        result = {}
+        for key in keys:
+            value = self.get(key, _MISSING)
+            if value is not _MISSING:
+                result[key] = value
+
+        return result
+
+    def set_many(self, items, ttl=None):
+        """Store a dict of values"""
+
+        for key, value in items.items():
+            self.set(key, value, ttl)
+
+    def get_or_set(self, key, function, ttl=None):
+        """Return the cached value of key, computing and storing it with function if missing"""
+
+        value = self.get(key, _MISSING)
+
+        if value is _MISSING:
+            value = function()
+            self.set(key, value, ttl)
+
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._items)
+
+
+class SQLiteCache(object):
+    """
+    Cache shared by all the processes of the host, stored in a SQLite file
+
+    Values are serialized with dumps: JSON data, bytes and numpy arrays.
+    Tuples are returned as lists. The file is created readable only by
+    the user, and files owned by other users are rejected.
+
+    Parameters
+    ----------
+    path : str (optional)
+        SQLite database file. Default cache.sqlite in cache_directory.
+    max_bytes : int (optional)
+        Maximum size of the stored values. The least recently used
+        values are evicted when it is exceeded.
+    fill_timeout : float (optional)
+        Maximum time in seconds to wait for a value being computed by
+        another process, before computing it again
+
+    """
+
+    def __init__(self, path=None, max_bytes=256*2**20, fill_timeout=30):
+        if path is None:
+            path = os.path.join(cache_directory(), 'cache.sqlite')
+
+        self.path = private_file(path)
+        self.max_bytes = max_bytes
+        self.fill_timeout = fill_timeout
+
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, "
+                               "value BLOB, size INTEGER, accessed REAL, expires REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+            connection.execute("CREATE TABLE IF NOT EXISTS fills (key TEXT PRIMARY KEY, expires REAL)")
+
+    @contextmanager
+    def _connect(self):
+        """Connection in autocommit mode, transactions are explicit. Always closed."""
+
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def get(self, key, default=None):
+        """Return the cached value of key, or default if not cached or expired"""
+
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        """Return a dict with the cached values of the keys found"""
+
+        now = time.time()
+        result = {}
+        touched = []
+
+        with self._connect() as connection:
+            keys = list(keys)
+
+            # SQLite limit of query parameters
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i+500]
+                rows = connection.execute(
+                    "SELECT key, value, accessed FROM cache WHERE (expires IS NULL OR expires >= ?) "
+                    "AND key IN ({})".format(','.join('?'*len(chunk))), [now] + chunk).fetchall()
+
+                for key, value, accessed in rows:
+                    result[key] = loads(value)
+                    if accessed < now - ACCESS_RESOLUTION:
+                        touched.append((now, key))
+
+            # Access times for the eviction order, only when they are
+            # stale, in a single write for all the keys
+            if touched:
+                connection.executemany("UPDATE cache SET accessed = ? WHERE key = ?", touched)
+
+        return result
+
+    def set(self, key, value, ttl=None):
+        """
+        Store value for key, evicting the least recently used values if full
+
+        Parameters
+        ----------
+        key : str
+            Cache key
+        value : object
+            Value to store: JSON data, bytes or numpy arrays
+        ttl : float (optional)
+            Expiration time in seconds. Default never.
+
+        """
+
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, items, ttl=None):
+        """
+        Store a dict of values in a single transaction, evicting the least recently used values if full
+        """
+
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+
+        rows = []
+        for key, value in items.items():
+            blob = dumps(value)
+            if len(blob) <= self.max_bytes:
+                rows.append((key, blob, len(blob), now, expires))
+
+        if not rows:
+            return
+
+        with self._connect() as connection:
+            try:
+                # Store and evict in a single write transaction
+                connection.execute("BEGIN IMMEDIATE")
+                connection.executemany("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)", rows)
+
+                total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+                if total > self.max_bytes:
+                    evicted = []
+                    rows = connection.execute("SELECT key, size FROM cache ORDER BY accessed").fetchall()
+                    for old_key, size in rows:
+                        if total <= self.max_bytes:
+                            break
+                        evicted.append((old_key,))
+                        total -= size
+
+                    connection.executemany("DELETE FROM cache WHERE key = ?", evicted)
+
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+
+    def get_or_set(self, key, function, ttl=None):
+        """
+        Return the cached value of key, computing and storing it with function if missing
+
+        Only one process computes a missing value, the others wait for it
+        up to fill_timeout seconds.
+
+        """
+
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        if not self._start_fill(key):
+            # Another process is computing the value
+            deadline = time.time() + self.fill_timeout
+            while time.time() < deadline:
+                time.sleep(0.05)
+                value = self.get(key, _MISSING)
+                if value is not _MISSING:
+                    return value
+                if self._start_fill(key):
+                    break
+
+        try:
+            value = function()
+            self.set(key, value, ttl)
+        finally:
+            self._end_fill(key)
+
+        return value
+
+    def _start_fill(self, key):
+        """Take the fill lock of a key, return False if another process has it"""
+
+        now = time.time()
+
+        with self._connect() as connection:
+            connection.execute("DELETE FROM fills WHERE key = ? AND expires < ?", (key, now))
+            cursor = connection.execute("INSERT OR IGNORE INTO fills VALUES (?, ?)",
+                                        (key, now + self.fill_timeout))
+
+        return cursor.rowcount == 1
+
+    def _end_fill(self, key):
+        """Release the fill lock of a key"""
+
+        with self._connect() as connection:
+            connection.execute("DELETE FROM fills WHERE key = ?", (key,))
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+
+@functools.lru_cache()
+def get_cache():
+    """
+    Shared cache of the application, configured with STARALT_CACHE and STARALT_CACHE_SIZE
+    """
+
+    backend = os.environ.get('STARALT_CACHE')
+    max_megabytes = float(os.environ.get('STARALT_CACHE_SIZE', 256))
+
+    if backend == 'memory':
+        return LRUCache(maxsize=1024)
+
+    return SQLiteCache(backend, max_bytes=int(max_megabytes*2**20))
+
+
+class StateStore(object):
+    """
+    Versioned states shared by all the processes of the host, stored in a SQLite file
+
+    Unlike the cache, states are never evicted, they are only removed when
+    they expire. Each update increments the version of a state, so
+    concurrent read-modify-write updates are detected (compare and set).
+    Values are serialized as in SQLiteCache.
+
+    Parameters
+    ----------
+    path : str (optional)
+        SQLite database file. Default cache.sqlite in cache_directory.
+
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(cache_directory(), 'cache.sqlite')
+
+        self.path = private_file(path)
+
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS states (key TEXT PRIMARY KEY, "
+                               "value BLOB, version INTEGER, expires REAL)")
+
+    @contextmanager
+    def _connect(self):
+        """Connection in autocommit mode, always closed"""
+
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def get(self, key):
+        """
+        Return the state of key and its version, or None if missing or expired
+        """
+
+        with self._connect() as connection:
+            row = connection.execute("SELECT value, version FROM states WHERE key = ? AND expires >= ?",
+                                     (key, time.time())).fetchone()
+
+        if row is None:
+            return None
+
+        return loads(row[0]), row[1]
+
+    def add(self, key, value, ttl):
+        """
+        Store a new state, with version 1
+
+        Parameters
+        ----------
+        key : str
+            State key
+        value : object
+            Value to store: JSON data, bytes or numpy arrays
+        ttl : float
+            Expiration time in seconds
+
+        """
+
+        now = time.time()
+
+        with self._connect() as connection:
+            connection.execute("DELETE FROM states WHERE expires < ?", (now,))
+            connection.execute("INSERT OR REPLACE INTO states VALUES (?, ?, 1, ?)",
+                               (key, dumps(value), now + ttl))
+
+    def replace(self, key, value, version, ttl):
+        """
+        Update a state only if it is still at the version read
+
+        Parameters
+        ----------
+        key : str
+            State key
+        value : object
+            New value
+        version : int
+            Version of the state the value was computed from, from get
+        ttl : float
+            Expiration time in seconds, from now
+
+        Returns
+        -------
+        replaced : bool
+            False if the state was updated by another request, or expired,
+            meanwhile. The update must then be done again from a fresh get.
+
+        """
+
+        with self._connect() as connection:
+            cursor = connection.execute("UPDATE states SET value = ?, version = version + 1, expires = ? "
+                                        "WHERE key = ? AND version = ?",
+                                        (dumps(value), time.time() + ttl, key, version))
+
+        return cursor.rowcount == 1
+
+
+class MemoryStateStore(object):
+    """
+    In-process store with the StateStore interface
+    """
+
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the state of key and its version, or None if missing or expired"""
+
+        with self._lock:
+            if key not in self._states:
+                return None
+
+            value, version, expires = self._states[key]
+            if expires < time.time():
+                del self._states[key]
+                return None
+
+            # A copy, so the stored state only changes through replace
+            return loads(dumps(value)), version
+
+    def add(self, key, value, ttl):
+        """Store a new state, with version 1"""
+
+        with self._lock:
+            self._states[key] = (loads(dumps(value)), 1, time.time() + ttl)
+
+    def replace(self, key, value, version, ttl):
+        """Update a state only if it is still at the version read, see StateStore.replace"""
+
+        with self._lock:
+            if key not in self._states or self._states[key][1] != version:
+                return False
+
+            self._states[key] = (loads(dumps(value)), version + 1, time.time() + ttl)
+            return True
+
+
+@functools.lru_cache()
+def get_store():
+    """
+    State store of the application, in the file of the shared cache (see get_cache)
+    """
+
+    backend = os.environ.get('STARALT_CACHE')
+
+    if backend == 'memory':
+        return MemoryStateStore()
+
+    return StateStore(backend)
+
+
+# Hits and misses of the memoized results of each endpoint, in this process
+_memo_stats = collections.defaultdict(lambda: {'hits': 0, 'misses': 0})
+_memo_stats_lock = threading.Lock()
+
+
+def memoize_entries(endpoint, keys, compute, ttl=30*86400):
+    """
+    Memoize the results of the entries of a request
+
+    The cached results are read at once, and only the missing ones are
+    computed, in a single batch, and stored.
+
+    Parameters
+    ----------
+    endpoint : str
+        Endpoint name, for the hit rate statistics
+    keys : list
+        Cache key of each entry
+    compute : function
+        Function computing the results for a list of entry indices,
+        returning a list of results in the same order
+    ttl : float (optional)
+        Expiration time of the results, in seconds. Default 30 days.
+
+    Returns
+    -------
+    results : list
+        Result of each entry
+
+    """
+
+    cache = get_cache()
+    cached = cache.get_many(set(keys))
+
+    missing = [i for i, key in enumerate(keys) if key not in cached]
+
+    with _memo_stats_lock:
+        _memo_stats[endpoint]['hits'] += len(keys) - len(missing)
+        _memo_stats[endpoint]['misses'] += len(missing)
+
+    if missing:
+        computed = dict(zip(missing, compute(missing)))
+        cache.set_many({keys[i]: result for i, result in computed.items()}, ttl)
+
+        return [computed[i] if i in computed else cached[key] for i, key in enumerate(keys)]
+
+    return [cached[key] for key in keys]
+
+
+def memoize_stats():
+    """
+    Hits, misses and hit rate of the memoized results of each endpoint, in this process
+    """
+
+    stats = {}
+
+    with _memo_stats_lock:
+        for endpoint, counts in _memo_stats.items():
+            total = counts['hits'] + counts['misses']
+            stats[endpoint] = dict(counts, hit_rate=counts['hits']/total if total else 0)
+
+    return stats
+
+
+def cache_key(*args):
+    """
+    Return a hash key for JSON serializable arguments, independent of the dicts order
+    """
+
+    serialized = json.dumps(args, sort_keys=True, default=str)
+
+    return hashlib.sha1(serialized.encode('utf8')).hexdigest()
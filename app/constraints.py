@@ -0,0 +1,672 @@
+# -*- coding: utf-8 -*-
+"""
+Observation constraints evaluated on a targets x times grid
+
+All the constraints of a request are compiled once and evaluated together
+over the same altitude/azimuth arrays, so the target positions, the Sun and
+the Moon are computed only once per time grid.
+
+"""
+
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import SkyCoord, GCRS
+from astropy.time import Time
+
+
+# Maximum Sun altitude (degrees) for each twilight type
+TWILIGHT_ALTITUDES = {
+    'civil' : -6,
+    'nautical' : -12,
+    'astronomical' : -18,
+}
+
+# Bodies of the ephemeris that are not seen in the sky of an observatory
+UNOBSERVABLE_BODIES = ('earth', 'earth-moon-barycenter')
+
+
+class Constraints(object):
+    """
+    Observation constraints of a request
+
+    Parameters
+    ----------
+    data : POST data format
+
+        Limits are optional, only the ones included are evaluated.
+        Altitude limits default to 0-90 degrees and twilight to astronomical.
+        data = {
+            'altitude_lower_limit' : '30',
+            'altitude_higher_limit' : '90',
+            'twilight_type' : 'astronomical',
+            'moon_separation_lower_limit' : 20,
+            'airmass_higher_limit' : 2.0,
+            'moon_illumination_higher_limit' : 0.6,
+            'hour_angle_lower_limit' : -4,
+            'hour_angle_higher_limit' : 4,
+            'horizon' : [[0, 15], [90, 10], [180, 20], [270, 5]],
+            (more data...)
+            }
+
+        Hour angle limits are in hours. 'horizon' is a list of
+        [azimuth, altitude] pairs (degrees) of the local horizon.
+
+    """
+
+    def __init__(self, data):
+
+        self.altitude_lower_limit = float(data.get('altitude_lower_limit', 0))
+        self.altitude_higher_limit = float(data.get('altitude_higher_limit', 90))
+
+        self.twilight_type = data.get('twilight_type', 'astronomical')
+        if self.twilight_type not in TWILIGHT_ALTITUDES:
+            self.twilight_type = 'astronomical'
+        self.sun_altitude_limit = TWILIGHT_ALTITUDES[self.twilight_type]
+
+        self.moon_separation_lower_limit = _optional_float(data, 'moon_separation_lower_limit')
+        self.airmass_higher_limit = _optional_float(data, 'airmass_higher_limit')
+        self.moon_illumination_higher_limit = _optional_float(data, 'moon_illumination_higher_limit')
+        self.hour_angle_lower_limit = _optional_float(data, 'hour_angle_lower_limit')
+        self.hour_angle_higher_limit = _optional_float(data, 'hour_angle_higher_limit')
+
+        # Horizon profile as a dense azimuth lookup array
+        if data.get('horizon'):
+            self.horizon = horizon_lookup(data['horizon'])
+        else:
+            self.horizon = None
+
+    def signature(self):
+        """
+        Canonical signature of the constraints, to be used in cache keys
+
+        Equivalent requests (e.g. '30' and 30.0 as altitude limit) have
+        the same signature.
+        """
+
+        horizon = None
+        if self.horizon is not None:
+            horizon = np.round(self.horizon, 2).tolist()
+
+        return [self.altitude_lower_limit, self.altitude_higher_limit, self.twilight_type,
+                self.moon_separation_lower_limit, self.airmass_higher_limit,
+                self.moon_illumination_higher_limit, self.hour_angle_lower_limit,
+                self.hour_angle_higher_limit, horizon]
+
+    def evaluate(self, observer, times, alt, az, horizon=None, time_index=None):
+        """
+        Evaluate all the constraints over the targets x times grid
+
+        Parameters
+        ----------
+        observer : astroplan.observer.Observer
+            Site location
+        times : astropy.time.Time
+            Time grid, shape (n_times,)
+        alt, az : numpy.ndarray
+            Altitude and azimuth of the targets in degrees, shape (n_targets, n_times),
+            or flat samples, shape (n_samples,), if time_index is given
+        horizon : numpy.ndarray (optional)
+            Site horizon lookup array, from horizon_lookup. The request horizon,
+            if any, is combined with it, keeping the highest obstruction
+            at each azimuth.
+        time_index : numpy.ndarray (optional)
+            Index in times of each sample, for flat samples
+
+        Returns
+        -------
+        mask : numpy.ndarray
+            Boolean array, same shape as alt, True where all
+            the constraints are satisfied
+
+        """
+
+        # Sun and Moon positions are computed once for each time,
+        # and indexed for the samples if needed
+        def per_sample(values):
+            return values if time_index is None else values[time_index]
+
+        mask = (alt >= self.altitude_lower_limit) & (alt <= self.altitude_higher_limit)
+
+        # Sun altitude is shared by all the targets
+        sun_alt = per_sample(observer.sun_altaz(times).alt.deg)
+        mask &= sun_alt < self.sun_altitude_limit
+
+        if self.airmass_higher_limit is not None:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                airmass = 1/np.sin(np.radians(alt))
+            mask &= (alt > 0) & (airmass <= self.airmass_higher_limit)
+
+        if self.hour_angle_lower_limit is not None or self.hour_angle_higher_limit is not None:
+            ha = hour_angle(alt, az, observer.location.lat.deg)
+            if self.hour_angle_lower_limit is not None:
+                mask &= ha >= self.hour_angle_lower_limit
+            if self.hour_angle_higher_limit is not None:
+                mask &= ha <= self.hour_angle_higher_limit
+
+        if self.horizon is not None:
+            horizon = self.horizon if horizon is None else np.maximum(horizon, self.horizon)
+        if horizon is not None:
+            mask &= alt >= horizon_altitude(horizon, az)
+
+        # Moon constraints, only computed if requested
+        if self.moon_separation_lower_limit is not None or \
+                self.moon_illumination_higher_limit is not None:
+            moon = observer.moon_altaz(times)
+            moon_alt = per_sample(moon.alt.deg)
+
+            if self.moon_separation_lower_limit is not None:
+                separation = angular_separation(alt, az, moon_alt, per_sample(moon.az.deg))
+                mask &= separation >= self.moon_separation_lower_limit
+
+            # Satisfied as well if the Moon is below the horizon
+            if self.moon_illumination_higher_limit is not None:
+                illumination = per_sample(observer.moon_illumination(times))
+                mask &= (illumination <= self.moon_illumination_higher_limit) | (moon_alt < 0)
+
+        return mask
+
+
+def _optional_float(data, key):
+    """Return data[key] as float, or None if not included"""
+
+    if data.get(key) is None:
+        return None
+
+    return float(data[key])
+
+
+class DateTable(object):
+    """
+    Date strings of a request, parsed in a single vectorized Time call
+
+    Repeated strings are parsed once, and the dates are
+    referenced by their index in the table.
+
+    Parameters
+    ----------
+    strings : list
+        Date strings in ISO format, 'YYYY-MM-DD[ hh:mm[:ss]]'. The
+        'T' separator is accepted as well.
+
+    """
+
+    def __init__(self, strings):
+
+        self.strings = sorted({_canonical_date(string) for string in strings})
+        self._index = {string: i for i, string in enumerate(self.strings)}
+
+        if self.strings:
+            self.times = Time(self.strings)
+        else:
+            self.times = Time([], format='jd')
+
+        self.jd = self.times.jd
+
+    def index(self, strings):
+        """Index array of a list of date strings"""
+
+        return np.array([self._index[_canonical_date(string)] for string in strings], dtype=int)
+
+
+def _canonical_date(string):
+    """Date string with ISO space separator"""
+
+    return str(string).strip().replace('T', ' ')
+
+
+def target_coords(objects):
+    """
+    Return a SkyCoord array from a list of dict of objects with RA and Dec in degrees
+    """
+
+    return SkyCoord(ra=[obj['RA'] for obj in objects]*u.deg,
+                    dec=[obj['Dec'] for obj in objects]*u.deg)
+
+
+def time_grid(time_range, resolution=0.5*u.hour):
+    """
+    Time grid for a time range, with the astroplan default resolution of 0.5h
+    """
+
+    from astroplan import time_grid_from_range
+
+    return time_grid_from_range(time_range, time_resolution=resolution)
+
+
+def target_altaz(observer, coords, times):
+    """
+    Altitude and azimuth of the targets for all the times in a single transformation
+
+    Returns
+    -------
+    alt, az : numpy.ndarray
+        Altitude and azimuth in degrees, shape (n_targets, n_times)
+
+    """
+
+    altaz = observer.altaz(times, coords, grid_times_targets=True)
+
+    return altaz.alt.deg, altaz.az.deg
+
+
+class TargetError(ValueError):
+    """
+    Invalid target in a request, reported to the client
+    """
+
+
+def check_targets(objects, moving=True):
+    """
+    Check the targets of a request before they are evaluated
+
+    Parameters
+    ----------
+    objects : list
+        Targets with 'RA' and 'Dec' in degrees, or moving targets with
+        'body' or 'ephemeris' (see moving_coords)
+    moving : bool (optional)
+        False for the services that only support fixed targets
+
+    Raises
+    ------
+    TargetError
+        Naming the first invalid target and what is wrong with it
+
+    """
+
+    from astropy.coordinates import solar_system_ephemeris
+
+    for i, obj in enumerate(objects):
+
+        if not isinstance(obj, dict):
+            raise TargetError("Target {} is not an object".format(i + 1))
+
+        name = obj.get('name', 'Target {}'.format(i + 1))
+
+        if is_moving(obj) and not moving:
+            raise TargetError("{}: moving targets (body or ephemeris) are not supported "
+                              "by this service, use RA and Dec".format(name))
+
+        if 'body' in obj:
+            bodies = [body for body in solar_system_ephemeris.bodies if body not in UNOBSERVABLE_BODIES]
+            if not isinstance(obj['body'], str) or obj['body'].strip().lower() not in bodies:
+                raise TargetError("{}: unknown body {!r}, known bodies are {}".format(
+                    name, obj['body'], ', '.join(bodies)))
+
+        elif 'ephemeris' in obj:
+            _check_ephemeris(name, obj['ephemeris'])
+
+        else:
+            if not all(_is_number(obj.get(key)) for key in ('RA', 'Dec')):
+                raise TargetError("{}: RA and Dec in degrees are required".format(name))
+            if not (np.isfinite(obj['RA']) and -90 <= obj['Dec'] <= 90):
+                raise TargetError("{}: invalid coordinates RA {} Dec {}".format(
+                    name, obj['RA'], obj['Dec']))
+
+
+def _check_ephemeris(name, table):
+    """Raise TargetError if an ephemeris table is not a list of [time, RA, Dec] rows"""
+
+    if not isinstance(table, list) or not table or \
+            not all(isinstance(row, list) and len(row) == 3 for row in table):
+        raise TargetError("{}: the ephemeris must be a list of [time, RA, Dec] rows".format(name))
+
+    if not all(_is_number(row[1]) and _is_number(row[2]) and np.isfinite(row[1]) and
+               -90 <= row[2] <= 90 for row in table):
+        raise TargetError("{}: ephemeris RA and Dec must be numbers in degrees".format(name))
+
+    try:
+        jd = _ephemeris_jd([row[0] for row in table])
+    except Exception:
+        jd = None
+
+    if jd is None or not np.isfinite(jd).all():
+        raise TargetError("{}: ephemeris times must be ISO dates or JD numbers".format(name))
+
+
+def _is_number(value):
+    """True for int and float values, not bool"""
+
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_moving(obj):
+    """True for moving targets, with 'body' or 'ephemeris' instead of fixed RA and Dec"""
+
+    return 'body' in obj or 'ephemeris' in obj
+
+
+def moving_coords(obj, times):
+    """
+    Coordinates of a moving target at the given times
+
+    Parameters
+    ----------
+    obj : dict
+        Target with either 'body', a Solar System body name known by
+        astropy.coordinates.get_body ('moon', 'mars', 'jupiter'...), or
+        'ephemeris', a table of [time, RA, Dec] rows, time in ISO format
+        or JD and RA, Dec in degrees. Ephemeris positions are linearly
+        interpolated, and clamped outside the table.
+    times : astropy.time.Time
+        Times, shape (n_times,)
+
+    Returns
+    -------
+    coords : astropy.coordinates.SkyCoord
+        Coordinates at each time, shape (n_times,)
+
+    """
+
+    if 'body' in obj:
+        ra, dec, distance = body_positions(obj['body'], times)
+
+        # Geocentric positions with distance, so the transformation
+        # to the site includes the parallax
+        return SkyCoord(ra=ra*u.deg, dec=dec*u.deg, distance=distance*u.au,
+                        frame=GCRS(obstime=times))
+
+    table = np.asarray(obj['ephemeris'], dtype=object)
+    table = table[np.argsort(_ephemeris_jd(table[:, 0]))]
+    jd = _ephemeris_jd(table[:, 0])
+
+    ra = np.degrees(np.unwrap(np.radians(table[:, 1].astype(float))))
+    dec = table[:, 2].astype(float)
+
+    return SkyCoord(ra=(np.interp(times.jd, jd, ra) % 360)*u.deg,
+                    dec=np.interp(times.jd, jd, dec)*u.deg)
+
+
+def _ephemeris_jd(values):
+    """JD of ephemeris table times, ISO strings or JD numbers"""
+
+    if all(isinstance(value, (int, float)) for value in values):
+        return np.asarray(values, dtype=float)
+
+    dates = DateTable(values)
+
+    return dates.jd[dates.index(values)]
+
+
+def body_positions(body, times):
+    """
+    Geocentric RA, Dec (degrees) and distance (AU) of a Solar System body
+
+    The positions are computed hourly for each UTC day, cached for all
+    the workers, and linearly interpolated at the times.
+
+    """
+
+    from astropy.coordinates import get_body
+    from app.cache import get_cache, cache_key
+
+    body = body.strip().lower()
+    days = np.arange(np.floor(times.jd.min() - 0.5), np.floor(times.jd.max() - 0.5) + 1)
+
+    nodes = []
+    for day in days:
+
+        def compute():
+            # Hourly positions from 0h to 24h UT of the day
+            node_times = Time(day + 0.5 + np.arange(25)/24, format='jd')
+            position = get_body(body, node_times)
+            return np.stack([node_times.jd, position.ra.deg, position.dec.deg,
+                             position.distance.to(u.au).value])
+
+        node = get_cache().get_or_set(cache_key('body_positions', body, float(day)), compute)
+        nodes.append(node)
+
+    nodes = np.concatenate(nodes, axis=1)
+    ra = np.degrees(np.unwrap(np.radians(nodes[1])))
+
+    return (np.interp(times.jd, nodes[0], ra) % 360, np.interp(times.jd, nodes[0], nodes[2]),
+            np.interp(times.jd, nodes[0], nodes[3]))
+
+
+def objects_altaz(observer, objects, times):
+    """
+    Altitude and azimuth of fixed and moving targets for all the times
+
+    Fixed targets are transformed together, as in target_altaz, and
+    moving targets with their positions at each time.
+
+    Returns
+    -------
+    alt, az : numpy.ndarray
+        Altitude and azimuth in degrees, shape (n_targets, n_times)
+
+    """
+
+    alt = np.zeros((len(objects), len(times)))
+    az = np.zeros((len(objects), len(times)))
+
+    fixed = [i for i, obj in enumerate(objects) if not is_moving(obj)]
+    if fixed:
+        alt[fixed], az[fixed] = target_altaz(observer, target_coords([objects[i] for i in fixed]), times)
+
+    for i, obj in enumerate(objects):
+        if is_moving(obj):
+            altaz = moving_coords(obj, times).transform_to(observer.altaz(times))
+            alt[i], az[i] = altaz.alt.deg, altaz.az.deg
+
+    return alt, az
+
+
+def sample_altaz(observer, objects, target_index, times):
+    """
+    Altitude and azimuth of flat samples, each one a target at a time
+
+    Parameters
+    ----------
+    observer : astroplan.observer.Observer
+        Site location
+    objects : list
+        Targets, fixed or moving
+    target_index : numpy.ndarray
+        Index in objects of the target of each sample, shape (n_samples,)
+    times : astropy.time.Time
+        Time of each sample, shape (n_samples,)
+
+    Returns
+    -------
+    alt, az : numpy.ndarray
+        Altitude and azimuth in degrees, shape (n_samples,)
+
+    """
+
+    target_index = np.asarray(target_index, dtype=int)
+    alt = np.zeros(len(target_index))
+    az = np.zeros(len(target_index))
+
+    moving = np.array([is_moving(obj) for obj in objects], dtype=bool)
+
+    # Fixed targets, in a single elementwise transformation
+    fixed_samples = ~moving[target_index]
+    if fixed_samples.any():
+        fixed = np.flatnonzero(~moving)
+        fixed_index = np.cumsum(~moving) - 1
+        coords = target_coords([objects[i] for i in fixed])[fixed_index[target_index[fixed_samples]]]
+        altaz = coords.transform_to(observer.altaz(times[fixed_samples]))
+        alt[fixed_samples], az[fixed_samples] = altaz.alt.deg, altaz.az.deg
+
+    for i in np.flatnonzero(moving):
+        samples = target_index == i
+        if samples.any():
+            sample_times = times[samples]
+            altaz = moving_coords(objects[i], sample_times).transform_to(observer.altaz(sample_times))
+            alt[samples], az[samples] = altaz.alt.deg, altaz.az.deg
+
+    return alt, az
+
+
+def evaluate_windows(constraints, observer, objects, starts, ends, horizon=None,
+                     resolution=0.5*u.hour):
+    """
+    Evaluate the constraints for entries with their own time window in a single pass
+
+    The time grid of each distinct window is built once, as in
+    astroplan.time_grid_from_range (at least one time per window), and the
+    samples of all the entries are transformed together.
+
+    Parameters
+    ----------
+    constraints : Constraints
+        Observation constraints
+    observer : astroplan.observer.Observer
+        Site location
+    objects : list
+        Target of each entry, fixed or moving
+    starts, ends : numpy.ndarray
+        Start and end of the window of each entry, in JD
+    horizon : numpy.ndarray (optional)
+        Site horizon lookup array
+    resolution : astropy.units.Quantity (optional)
+        Time grid resolution
+
+    Returns
+    -------
+    ever, always : numpy.ndarray
+        Boolean arrays, shape (n_entries,), True if the entry is observable
+        at any time, or at all the times, of its window
+
+    """
+
+    starts = np.asarray(starts, dtype=float)
+    ends = np.asarray(ends, dtype=float)
+
+    if not len(starts):
+        return np.zeros(0, dtype=bool), np.zeros(0, dtype=bool)
+
+    # Distinct windows, and time grid of each one
+    windows, window_index = np.unique(np.stack([starts, ends], axis=1), axis=0, return_inverse=True)
+    window_index = window_index.ravel()
+
+    step = resolution.to(u.day).value
+    counts = np.maximum(np.ceil((windows[:, 1] - windows[:, 0])/step - 1e-9), 1).astype(int)
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    window_of_time = np.repeat(np.arange(len(windows)), counts)
+    times = Time(windows[window_of_time, 0] + (np.arange(counts.sum()) - offsets[window_of_time])*step,
+                 format='jd')
+
+    # Samples of each entry, the times of its window
+    entry_counts = counts[window_index]
+    entry_offsets = np.concatenate([[0], np.cumsum(entry_counts)[:-1]])
+    entry_of_sample = np.repeat(np.arange(len(starts)), entry_counts)
+    time_index = offsets[window_index][entry_of_sample] + \
+        np.arange(entry_counts.sum()) - entry_offsets[entry_of_sample]
+
+    alt, az = sample_altaz(observer, objects, entry_of_sample, times[time_index])
+    mask = constraints.evaluate(observer, times, alt, az, horizon, time_index=time_index)
+
+    ever = np.logical_or.reduceat(mask, entry_offsets)
+    always = np.logical_and.reduceat(mask, entry_offsets)
+
+    return ever, always
+
+
+def angular_separation(alt1, az1, alt2, az2):
+    """
+    Angular separation between horizontal coordinates, in degrees
+    """
+
+    alt1, az1, alt2, az2 = np.radians(alt1), np.radians(az1), np.radians(alt2), np.radians(az2)
+
+    # Haversine formula, stable for small separations
+    sin_alt = np.sin((alt2 - alt1)/2)
+    sin_az = np.sin((az2 - az1)/2)
+    a = sin_alt**2 + np.cos(alt1)*np.cos(alt2)*sin_az**2
+
+    return np.degrees(2*np.arcsin(np.sqrt(np.clip(a, 0, 1))))
+
+
+def hour_angle(alt, az, latitude):
+    """
+    Hour angle in hours (-12, 12] from horizontal coordinates in degrees
+
+    Azimuth is measured from North to East, as in astropy.
+    """
+
+    alt, az, lat = np.radians(alt), np.radians(az), np.radians(latitude)
+
+    ha = np.arctan2(-np.sin(az)*np.cos(alt),
+                    np.sin(alt)*np.cos(lat) - np.cos(alt)*np.cos(az)*np.sin(lat))
+
+    return np.degrees(ha)/15
+
+
+def horizon_lookup(profile, resolution=1.0):
+    """
+    Dense azimuth to minimum altitude lookup array from a horizon profile
+
+    Parameters
+    ----------
+    profile : list
+        List of [azimuth, altitude] pairs in degrees. Altitudes between
+        the given azimuths are linearly interpolated.
+    resolution : float (optional)
+        Azimuth step of the lookup array, in degrees
+
+    Returns
+    -------
+    lookup : numpy.ndarray
+        Minimum altitude for each azimuth step, from 0 to 360 degrees
+
+    """
+
+    profile = np.array(sorted(profile), dtype=float).reshape(-1, 2)
+    azimuths = np.arange(0, 360, resolution)
+
+    return np.interp(azimuths, profile[:, 0] % 360, profile[:, 1], period=360)
+
+
+def horizon_altitude(lookup, az):
+    """
+    Minimum altitude of the horizon for the azimuths (degrees) from a lookup array
+    """
+
+    index = (np.asarray(az) * len(lookup) / 360).astype(int) % len(lookup)
+
+    return lookup[index]
+
+
+def cirs_grid(coords, times):
+    """
+    Site independent part of the altitude computation
+
+    Transforms the targets to CIRS for all the times of a shared (UTC) grid,
+    so the result can be reused for several sites with cirs_altaz.
+
+    Returns
+    -------
+    cirs : astropy.coordinates.SkyCoord
+        Targets in CIRS, shape (n_targets, n_times)
+
+    """
+
+    from astropy.coordinates import CIRS
+
+    return coords[:, np.newaxis].transform_to(CIRS(obstime=times))
+
+
+def cirs_altaz(observer, cirs, times):
+    """
+    Altitude and azimuth of the targets from a CIRS grid computed with cirs_grid
+
+    The geocentric CIRS positions are used as topocentric ones, so only the
+    CIRS to AltAz rotation is computed for the site. The difference (diurnal
+    aberration, below 0.5 arcsec) is negligible for observability.
+
+    Returns
+    -------
+    alt, az : numpy.ndarray
+        Altitude and azimuth in degrees, shape (n_targets, n_times)
+
+    """
+
+    from astropy.coordinates import CIRS
+
+    topocentric = CIRS(cirs.data, obstime=times, location=observer.location)
+    altaz = topocentric.transform_to(observer.altaz(times))
+
+    return altaz.alt.deg, altaz.az.deg
@@ -4,6 +4,9 @@ coordinates.EarthLocation.get_site_names()
 
 """
 
+import os
+import numpy as np
+
 from astropy.coordinates import SkyCoord
 from astroplan import FixedTarget, Observer
 from astropy import units as u
@@ -11,6 +14,35 @@ from astropy.coordinates import EarthLocation
 from pytz import timezone
 
 
+# Directory with the horizon profiles of the observatories
+HORIZONS_PATH = os.environ.get('STARALT_HORIZONS',
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), 'horizons'))
+
+
+def horizon_profile(observatory):
+    """
+    Horizon profile of an observatory, read from <observatory>.dat in HORIZONS_PATH
+    (app/horizons, or the STARALT_HORIZONS directory)
+
+    The file has two columns, azimuth and minimum altitude in degrees,
+    for the obstructions (domes, mountains) seen from the site.
+
+    Returns
+    -------
+    profile : list
+        List of [azimuth, altitude] pairs, or None if there is
+        no profile for the observatory (flat horizon)
+
+    """
+
+    filename = os.path.join(HORIZONS_PATH, '{}.dat'.format(observatory))
+
+    if not os.path.exists(filename):
+        return None
+
+    return np.loadtxt(filename, ndmin=2).tolist()
+
+
 def OT_observer():
     """
     OT Location
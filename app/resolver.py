@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Object name resolution with a persistent local cache
+
+Names are resolved with a pluggable backend (Sesame by default) and stored
+in a SQLite cache shared by all the processes of the host. Unknown names are
+cached as well (negative cache), with a shorter expiration time.
+
+"""
+
+import time
+import sqlite3
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+from urllib.request import urlopen
+
+
+# Sesame name resolver, all services
+SESAME_URL = "https://cds.unistra.fr/cgi-bin/nph-sesame/A?"
+
+def normalize_name(name):
+    """Cache key for an object name: lowercase, single spaced"""
+
+    return ' '.join(name.split()).lower()
+
+
+class NameCache(object):
+    """
+    Persistent name to coordinates cache
+
+    Parameters
+    ----------
+    path : str
+        SQLite database file
+    ttl : float (optional)
+        Expiration time of resolved names, in seconds. Default 30 days.
+    negative_ttl : float (optional)
+        Expiration time of unknown names, in seconds. Default 1 day.
+
+    """
+
+    def __init__(self, path, ttl=30*86400, negative_ttl=86400):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        with self._connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS names "
+                               "(name TEXT PRIMARY KEY, ra REAL, dec REAL, expires REAL)")
+
+    @contextmanager
+    def _connect(self):
+        """Connection committed on success and always closed"""
+
+        connection = sqlite3.connect(self.path, timeout=10)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get_many(self, names):
+        """
+        Cached coordinates of a list of names
+
+        Returns
+        -------
+        coordinates : dict
+            (RA, Dec) in degrees for each cached name, or None for
+            cached unknown names. Missing or expired names are not included.
+
+        """
+
+        # All the spellings of the same name share the cache entry
+        keys = {}
+        for name in names:
+            keys.setdefault(normalize_name(name), []).append(name)
+
+        now = time.time()
+        result = {}
+
+        with self._connect() as connection:
+            # SQLite limit of query parameters
+            key_list = list(keys)
+            for i in range(0, len(key_list), 500):
+                chunk = key_list[i:i+500]
+                rows = connection.execute(
+                    "SELECT name, ra, dec FROM names WHERE (expires IS NULL OR expires > ?) "
+                    "AND name IN ({})".format(','.join('?'*len(chunk))), [now] + chunk)
+
+                for key, ra, dec in rows:
+                    for name in keys[key]:
+                        result[name] = None if ra is None else (ra, dec)
+
+        return result
+
+    def set_many(self, coordinates, ttl=None):
+        """
+        Store the coordinates of several names
+
+        Parameters
+        ----------
+        coordinates : dict
+            (RA, Dec) in degrees for each name, or None for unknown names
+        ttl : float (optional)
+            Expiration time in seconds, overriding the cache default.
+            Use float('inf') for entries that never expire.
+
+        """
+
+        now = time.time()
+        rows = []
+
+        for name, coords in coordinates.items():
+            if ttl is not None:
+                expires = now + ttl
+            elif coords is None:
+                expires = now + self.negative_ttl
+            else:
+                expires = now + self.ttl
+
+            if expires == float('inf'):
+                expires = None
+
+            ra, dec = coords if coords is not None else (None, None)
+            rows.append((normalize_name(name), ra, dec, expires))
+
+        with self._connect() as connection:
+            connection.executemany("INSERT OR REPLACE INTO names VALUES (?, ?, ?, ?)", rows)
+
+    def seed(self, filename):
+        """
+        Seed the cache from a local catalogue file
+
+        The file has one object per line, with name, RA and Dec in degrees
+        separated by commas. Lines starting with # are ignored.
+        Seeded names never expire.
+
+        """
+
+        coordinates = {}
+
+        with open(filename) as catalogue:
+            for line in catalogue:
+                if not line.strip() or line.startswith('#'):
+                    continue
+                name, ra, dec = line.rsplit(',', 2)
+                coordinates[name.strip()] = (float(ra), float(dec))
+
+        self.set_many(coordinates, ttl=float('inf'))
+
+
+class SesameBackend(object):
+    """
+    Sesame name resolver backend
+
+    Parameters
+    ----------
+    url : str (optional)
+        Sesame service URL, the name is appended to it. A local
+        service with the same output can be used for tests.
+    timeout : float (optional)
+        Request timeout in seconds
+
+    """
+
+    def __init__(self, url=SESAME_URL, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def __call__(self, name):
+        """
+        Return (RA, Dec) in degrees of an object name, or None if unknown
+        """
+
+        with urlopen(self.url + quote(name), timeout=self.timeout) as response:
+            text = response.read().decode('utf8', 'replace')
+
+        # Sesame J2000 position line: %J 83.82208 -05.39111 = 05 35 17.30 -05 23 28.0
+        for line in text.splitlines():
+            if line.startswith('%J '):
+                ra, dec = line.split()[1:3]
+                return float(ra), float(dec)
+
+        return None
+
+
+class Resolver(object):
+    """
+    Batch name resolver
+
+    Cache misses are resolved concurrently with the backend.
+
+    Parameters
+    ----------
+    cache : NameCache
+        Names cache
+    backend : callable (optional)
+        Function returning (RA, Dec) in degrees for a name, or None if
+        unknown. It raises an exception if the service fails, and then
+        the name is not cached. Default SesameBackend.
+    max_workers : int (optional)
+        Maximum number of concurrent backend requests
+
+    """
+
+    def __init__(self, cache, backend=None, max_workers=8):
+        self.cache = cache
+        self.backend = backend or SesameBackend()
+        self.max_workers = max_workers
+
+    def resolve(self, names):
+        """
+        Resolve a list of names
+
+        Returns
+        -------
+        coordinates : dict
+            (RA, Dec) in degrees for each name, or None if it is unknown
+            or could not be resolved
+
+        """
+
+        result = self.cache.get_many(names)
+
+        # A single backend request for all the spellings of a name
+        missing = {}
+        for name in names:
+            if name not in result:
+                missing.setdefault(normalize_name(name), []).append(name)
+
+        if not missing:
+            return result
+
+        queries = [spellings[0] for spellings in missing.values()]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(queries))) as executor:
+            resolved = list(executor.map(self._resolve, queries))
+
+        # Only answers from the backend are cached, not failures
+        answers = {}
+        for spellings, query, (ok, coords) in zip(missing.values(), queries, resolved):
+            for name in spellings:
+                result[name] = coords
+            if ok:
+                answers[query] = coords
+
+        self.cache.set_many(answers)
+
+        return result
+
+    def _resolve(self, name):
+        """Return (ok, coordinates) for a name, ok is False if the backend failed"""
+
+        try:
+            return True, self.backend(name)
+        except Exception:
+            return False, None
@@ -5,7 +5,9 @@ General library for altitude plots and observability
 """
 
 import numpy as np
+import collections
 import datetime
+import functools
 import pytz
 from astropy.time import Time
 import matplotlib.dates as mdates
@@ -19,8 +21,16 @@ from matplotlib.pyplot import style
 
 style.use('fast')
 
+# Number of objects above which the altitude plot is drawn as a
+# single collection of curves, labelled at culmination
+MANY_OBJECTS = 20
 
-def staralt(observatory, observation_date, objects, transits=[], twilight='astronomical'):
+# Expiration time of the observability subscriptions since the last poll, in seconds
+SUBSCRIPTION_TTL = 86400
+
+
+def staralt(observatory, observation_date, objects, transits=[], twilight='astronomical',
+            figsize=(11, 6), altaz=None):
     """
     Plot altitude curves for a list of objects
 
@@ -36,64 +46,84 @@ def staralt(observatory, observation_date, objects, transits=[], twilight='astro
         List of dict of transits to plot
     twilight : str (optional)
         Twilight limits to plot: civil, nautical or astronomical
+    figsize : tuple (optional)
+        Figure width and height in inches
+    altaz : tuple (optional)
+        Altitude and azimuth arrays of the objects (degrees) on the night_grid
+        time grid, shape (n_objects, n_times), if already computed
 
     Returns
     -------
-    image : image/png
-        Altitude plot in PNG format
+    fig : matplotlib.figure.Figure
+        Altitude plot figure, to be rendered with render
 
     """
 
+    from app.constraints import horizon_altitude, objects_altaz, check_targets
+
+    check_targets(objects)
+
     # Site location
     location = get_location(observatory)
 
     # Observation date string to use the graph
     obs_date = observation_date.strftime("%-d of %B, %Y")
 
-    # Observation date in Time string
-    observation_date_Time = Time(observation_date.strftime("%Y-%m-%d 12:00"))
+    # Position of twilights, sun rising and setting, cached for all the workers,
+    # and time grid of the curves
+    night, visible_time = night_grid(observatory, observation_date.strftime("%Y-%m-%d"), twilight)
 
-    # Position of twilights, sun rising and setting
-    # Sun's rising and setting time, in astropy.Time object
-    setting_time = location.sun_set_time(observation_date_Time).datetime
-    rising_time = location.sun_rise_time(observation_date_Time, which='next').datetime
-    
-    # twilights in astropy.Time object
-    if twilight == 'civil':
-        twilight1 = location.twilight_evening_civil(observation_date_Time).datetime
-        twilight2 = location.twilight_morning_civil(observation_date_Time, which='next').datetime
-    elif twilight == 'nautical':
-        twilight1 = location.twilight_evening_nautical(observation_date_Time).datetime
-        twilight2 = location.twilight_morning_nautical(observation_date_Time, which='next').datetime
-    else:
-        twilight1 = location.twilight_evening_astronomical(observation_date_Time).datetime
-        twilight2 = location.twilight_morning_astronomical(observation_date_Time, which='next').datetime
+    # Sun's rising and setting time
+    setting_time = Time(night['sunset'], format='jd').datetime
+    rising_time = Time(night['sunrise'], format='jd').datetime
+
+    # twilights
+    twilight1 = Time(night['twilight_evening'], format='jd').datetime
+    twilight2 = Time(night['twilight_morning'], format='jd').datetime
 
     # -- Plotting -------------------------------
 
-    fig = Figure(figsize=(11, 6))
+    fig = Figure(figsize=figsize)
     fig.set_facecolor("white")
 
     ax = fig.add_subplot(111)
-    fig.subplots_adjust(top=0.93, right=0.88, wspace=0.01, bottom=0.24)
+
+    # Many objects are labelled at culmination, without legend below the plot
+    many_objects = len(objects) > MANY_OBJECTS
+
+    if many_objects:
+        fig.subplots_adjust(top=0.93, right=0.88, wspace=0.01, bottom=0.12)
+    else:
+        fig.subplots_adjust(top=0.93, right=0.88, wspace=0.01, bottom=0.24)
     
 
     # --- Objects altitude curves -------------
-    visible_time = Time(setting_time + (rising_time - setting_time)*np.linspace(0, 1, 100))
 
     # dict to store the line color of the plots, to use
     # in transits if required
     object_colors = {}
-    for obj in objects:
 
-        coordinates = SkyCoord(obj['RA'], obj['Dec'], unit='deg')
-        target = FixedTarget(name=obj['name'], coord=coordinates)
+    # Site horizon, shaded below each curve where the object is obstructed
+    horizon = get_horizon(observatory)
+
+    # Altitude of all the objects, in a single transformation
+    if altaz is not None:
+        alt, az = altaz
+    elif objects:
+        alt, az = objects_altaz(location, objects, visible_time)
+
+    if many_objects:
+        object_colors = plot_many_objects(ax, visible_time, objects, alt)
+    else:
+        for i, obj in enumerate(objects):
 
-        altaz = location.altaz(visible_time, target)
+            object_label = '{:s}'.format(obj['name'])
+            object_curve, = ax.plot(visible_time.datetime, alt[i], label=object_label)
+            object_colors[obj['name']] = object_curve.get_color()
 
-        object_label = '{:s}'.format(obj['name'])
-        object_curve, = ax.plot(visible_time.datetime, altaz.alt.deg, label=object_label)
-        object_colors[obj['name']] = object_curve.get_color()
+            if horizon is not None:
+                ax.fill_between(visible_time.datetime, 0, horizon_altitude(horizon, az[i]),
+                                color=object_curve.get_color(), alpha=0.1, lw=0)
 
     # Moon altitude curve
     ax.plot(visible_time.datetime, location.moon_altaz(visible_time).alt,
@@ -158,72 +188,992 @@ def staralt(observatory, observation_date, objects, transits=[], twilight='astro
         else:
             xlabels.append('{utc:.0f}'.format(utc=utc_hour))
 
-    ax.set_xticks(xticks_utc)
-    ax.set_xticklabels(xlabels)
+    ax.set_xticks(xticks_utc)
+    ax.set_xticklabels(xlabels)
+
+    # x axis date format in hours.
+    # Add a hyphen between the % and the letter to remove the leading zero (01 -> 1).
+    #ax.xaxis.set_major_formatter(mdates.DateFormatter('%-H'))
+
+    # --- Y axis ----
+    # set the values and labels of the yticks
+    ax.set_yticklabels(ylabels)
+    ax_airmass = ax.twinx()
+
+    # set the values and labels of the yticks
+    ax_airmass_labels = np.round(1/np.cos(np.radians(90-yticks_values)), 2)
+    ax_airmass.set_yticks(yticks_values)
+    ax_airmass_labels = ax_airmass_labels.tolist()
+    ax_airmass_labels[0] = ""
+    ax_airmass.set_yticklabels(ax_airmass_labels)
+    ax_airmass.set_ylabel("Airmass")
+
+    # Plotting limits are sun setting and rising, which
+    # are the first and last elements in fractions_days list
+    ax.set_xlim(setting_time, rising_time)
+    ax.set_xlabel('{} Local Time, starting night {}'.format(observatory, obs_date))
+
+    # Upper x axis with sidereal time
+    # -------------------------------
+    # sidereal time upper ticks are cloned from xticks (UT local time) using
+    # ax.get_xticks(), which returns a list of floats  which gives the number
+    # of days (fraction part represents hours, minutes, seconds) since
+    # 0001-01-01 00:00:00 UTC *plus* *one* (historical reasons)
+    # Then this float must be converted to datetime with num2date and then
+    # to astropy.Time to compute the sidereal time for each value, properly formatted
+    ax_sidereal_time = ax.twiny()
+    ax_sidereal_time_ticks = ax.get_xticks()
+    ax_sidereal_time.set_xticks(ax_sidereal_time_ticks)
+    ax_sidereal_time.set_xbound(ax.get_xbound())
+
+    sidereal_times = []
+    dates_datetime = Time(dates.num2date(ax.get_xticks()))
+
+    for sidereal in dates_datetime.sidereal_time(
+            kind='mean', longitude=location.location.lon):
+        sidereal_times.append("{:02.0f}:{:02.0f}".format(sidereal.hms.h, sidereal.hms.m))
+
+    ax_sidereal_time.set_xticklabels(sidereal_times)
+    ax_sidereal_time.set_xlabel('Local sidereal time at {}'.format(observatory), fontsize=10)
+
+    # Transit band limits, if any.
+    # Dates in YYYY-MM-SS hh:mm format. seconds are removed if included
+    if transits:
+        for transit in transits:
+            t_early = datetime.datetime.strptime(transit['t_early'][:16], "%Y-%m-%d %H:%M")
+            t_late = datetime.datetime.strptime(transit['t_late'][:16], "%Y-%m-%d %H:%M")
+
+            ax.axvspan(t_early, t_late, color=object_colors[transit['name']], alpha=0.2)
+
+    ax.set_ylim(0, 90)
+    ax.set_ylabel('Altitude')
+
+    if not many_objects:
+        ax.legend(loc='upper center', bbox_to_anchor=(0.5, -0.15),
+              fancybox=False, shadow=False, ncol=5, fontsize=8)
+
+    ax.set_ymargin(0)
+
+    return fig
+
+
+def render(fig, format='png', dpi=100):
+    """
+    Render a figure in the requested format
+
+    Parameters
+    ----------
+    fig : matplotlib.figure.Figure
+        Figure to render
+    format : str (optional)
+        Output format: png, svg, webp or jpeg. WebP and JPEG require Pillow.
+    dpi : float (optional)
+        Resolution of raster formats, in dots per inch
+
+    Returns
+    -------
+    image : bytes
+        Rendered image
+
+    """
+
+    from io import BytesIO
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+
+    FigureCanvas(fig)
+    output = BytesIO()
+    fig.savefig(output, format=format, dpi=dpi, facecolor=fig.get_facecolor())
+
+    return output.getvalue()
+
+
+def plot_many_objects(ax, times, objects, alt):
+    """
+    Plot the altitude curves of many objects as a single LineCollection
+
+    Curves are labelled at culmination instead of using a legend. The
+    horizon band is not shaded, as it would hide the curves.
+
+    Parameters
+    ----------
+    ax : matplotlib.axes.Axes
+        Altitude plot axes
+    times : astropy.time.Time
+        Time grid, shape (n_times,)
+    objects : list
+        List of dict of objects to plot
+    alt : numpy.ndarray
+        Altitude of the objects in degrees, shape (n_objects, n_times)
+
+    Returns
+    -------
+    object_colors : dict
+        Line color of each object
+
+    """
+
+    from matplotlib.collections import LineCollection
+
+    x = mdates.date2num(times.datetime)
+
+    colors = matplotlib.rcParams['axes.prop_cycle'].by_key()['color']
+    colors = [colors[i % len(colors)] for i in range(len(objects))]
+
+    segments = np.stack([np.broadcast_to(x, alt.shape), alt], axis=-1)
+    ax.add_collection(LineCollection(segments, colors=colors, linewidths=1))
+
+    # Labels at culmination, for the objects above the horizon
+    culmination = np.argmax(alt, axis=1)
+
+    object_colors = {}
+    for i, obj in enumerate(objects):
+        object_colors[obj['name']] = colors[i]
+
+        if alt[i, culmination[i]] > 0:
+            ax.annotate(obj['name'], (x[culmination[i]], alt[i, culmination[i]]),
+                        xytext=(0, 2), textcoords='offset points', ha='center',
+                        va='bottom', fontsize=6, color=colors[i], clip_on=True)
+
+    return object_colors
+
+
+def plot_observability(data):
+    """
+    Altitude plot and observability of a list of objects for a night
+
+    The altitudes of the objects are computed once, on the time grid of the
+    plot, and used both to draw the plot and to test the observability.
+
+    Parameters
+    ----------
+    data : POST data format
+
+        Same data as the altitude plot, with the observability limits
+        data = {
+            'observatory' : 'OT',
+            'date' : '2020-06-11',
+            'twilight' : 'astronomical',
+            'altitude_lower_limit' : '30',
+            'altitude_higher_limit' : '90',
+            'objects' : [{
+                    'name' : 'Kelt 8b',
+                    'RA' : 283.30551667 ,
+                    'Dec' : 24.12738139
+                    },
+                    (more objects...)
+                ],
+            'transits' : [(transits to plot...)]
+            }
+
+        'twilight' sets both the plotted and the observability twilight,
+        unless 'twilight_type' is given. Optional constraints (moon separation,
+        airmass, moon illumination, hour angle and horizon) are described in
+        app.constraints.Constraints
+
+    Returns
+    -------
+    observability : dict
+        Observability, moon separation in the middle of the night and
+        observable windows (UTC) of each object
+        {
+            'Kelt 8b' : {
+                'observable' : 'True', 'moon_separation' : 30.4,
+                'windows' : [['2020-06-11 23:10:05', '2020-06-12 04:30:12']]
+            }
+        }
+    figure : function
+        Function returning the altitude plot figure, drawn with the same
+        altitudes. It accepts the staralt figsize argument.
+
+    """
+
+    from app.constraints import Constraints, objects_altaz, angular_separation, check_targets
+
+    observatory = data['observatory']
+    date = data['date'][:10]
+    objects = data['objects']
+    check_targets(objects)
+    transits = data.get('transits', [])
+    twilight = data.get('twilight', 'astronomical')
+
+    location = get_location(observatory)
+    night, times = night_grid(observatory, date, twilight)
+
+    # Observability twilight is the plotted one, if not given
+    data = dict(data)
+    data.setdefault('twilight_type', twilight)
+    constraints = Constraints(data)
+
+    result = {}
+
+    if objects:
+        # Altitudes of all the objects, shared by the plot and the observability
+        alt, az = objects_altaz(location, objects, times)
+        mask = constraints.evaluate(location, times, alt, az, get_horizon(observatory))
+
+        middle = len(times)//2
+        moon = location.moon_altaz(times[middle])
+        moon_separation = angular_separation(alt[:, middle], az[:, middle], moon.alt.deg, moon.az.deg)
+
+        for i, obj in enumerate(objects):
+            result[obj['name']] = {
+                    'observable': str(mask[i].any()),
+                    'moon_separation': moon_separation[i],
+                    'windows': observable_windows(times, mask[i])
+                    }
+    else:
+        alt, az = np.zeros((0, len(times))), np.zeros((0, len(times)))
+
+    def figure(figsize=(11, 6)):
+        observation_date = datetime.datetime.strptime(date, "%Y-%m-%d").date()
+        return staralt(observatory, observation_date, objects, transits, twilight,
+                       figsize=figsize, altaz=(alt, az))
+
+    return result, figure
+
+
+def observable_windows(times, mask):
+    """
+    Time windows where a target is observable
+
+    Parameters
+    ----------
+    times : astropy.time.Time
+        Time grid, shape (n_times,)
+    mask : numpy.ndarray
+        Observability of the target at each time, shape (n_times,)
+
+    Returns
+    -------
+    windows : list
+        List of [start, end] times (ISO format, UTC) of each window
+
+    """
+
+    # Start and end indices of the runs of True values
+    edges = np.diff(np.concatenate([[0], mask.astype(int), [0]]))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1) - 1
+
+    if not len(starts):
+        return []
+
+    iso = times.iso
+
+    return [[iso[start], iso[end]] for start, end in zip(starts, ends)]
+
+
+def visibility_year(data, samples=24):
+    """
+    Visibility of a list of objects for every night of a year
+
+    For each night: altitude at local midnight, hours of the night (between
+    twilights) where the object satisfies the constraints, and Moon distance
+    at local midnight. The nights x samples x objects grid is computed in a
+    single transformation, from the cached night boundaries of the year.
+
+    Parameters
+    ----------
+    data : POST data format
+
+        data = {
+            'observatory' : 'OT',
+            'date' : '2021-01-01',
+            'days' : 365,
+            'twilight' : 'astronomical',
+            'altitude_lower_limit' : '30',
+            'objects' : [{
+                    'name' : 'Kelt 8b',
+                    'RA' : 283.30551667 ,
+                    'Dec' : 24.12738139
+                    },
+                    (more objects...)
+                ]
+            }
+
+        'date' is the first night (default January 1st of the current year)
+        and 'days' the number of nights (default 365, 366 at most).
+        Optional constraints (moon separation, airmass, moon illumination,
+        hour angle and horizon) are described in app.constraints.Constraints
+    samples : int (optional)
+        Number of times of each night
+
+    Returns
+    -------
+    visibility : dict
+        Dates of the nights, dark hours of each night and, for each object,
+        the altitude at local midnight, the hours observable and the
+        Moon distance, in degrees
+
+        {
+            'dates' : ['2021-01-01', ...],
+            'night_hours' : [12.1, ...],
+            'objects' : {
+                'Kelt 8b' : {
+                    'midnight_altitude' : [-10.2, ...],
+                    'hours' : [0.0, ...],
+                    'moon_separation' : [95.3, ...]
+                }
+            }
+        }
+    figure : function
+        Function returning the visibility chart figure, with
+        optional figsize argument
+
+    """
+
+    from app.constraints import Constraints, objects_altaz, angular_separation, check_targets
+
+    observatory = data['observatory']
+    start = data.get('date', '{}-01-01'.format(datetime.date.today().year))[:10]
+    days = min(max(int(data.get('days', 365)), 1), 366)
+    twilight = data.get('twilight', data.get('twilight_type', 'astronomical'))
+    objects = data['objects']
+    check_targets(objects)
+
+    location = get_location(observatory)
+
+    data = dict(data)
+    data.setdefault('twilight_type', twilight)
+    constraints = Constraints(data)
+
+    night = night_table(observatory, start, days, twilight)
+
+    # Local midnight of each night
+    first = datetime.datetime.strptime(start, "%Y-%m-%d")
+    midnights = Time([location.timezone.localize(first + datetime.timedelta(days=day + 1))
+                      for day in range(days)])
+
+    # Samples at the middle of equal intervals between twilights.
+    # Nights without astronomical night (high latitudes) have no samples.
+    dark = np.isfinite(night['twilight_evening']) & np.isfinite(night['twilight_morning'])
+    evening = np.where(dark, night['twilight_evening'], midnights.jd)
+    morning = np.where(dark, night['twilight_morning'], midnights.jd)
+    step = (morning - evening)/samples
+    grid = evening[:, None] + step[:, None]*(np.arange(samples) + 0.5)
+
+    # Night samples and midnights of all the objects, in a single transformation
+    times = Time(np.concatenate([grid.ravel(), midnights.jd]), format='jd')
+    alt, az = objects_altaz(location, objects, times)
+
+    night_alt, night_az = alt[:, :days*samples], az[:, :days*samples]
+    midnight_alt, midnight_az = alt[:, days*samples:], az[:, days*samples:]
+
+    mask = constraints.evaluate(location, times[:days*samples], night_alt, night_az,
+                                get_horizon(observatory))
+    hours = mask.reshape(len(objects), days, samples).sum(axis=2) * step*24 * dark
+
+    moon = location.moon_altaz(midnights)
+    moon_separation = angular_separation(midnight_alt, midnight_az, moon.alt.deg, moon.az.deg)
+
+    dates = [(first + datetime.timedelta(days=day)).strftime("%Y-%m-%d") for day in range(days)]
+
+    result = {
+        'dates' : dates,
+        'night_hours' : np.round((morning - evening)*24*dark, 2).tolist(),
+        'objects' : {}
+        }
+
+    for i, obj in enumerate(objects):
+        result['objects'][obj['name']] = {
+                'midnight_altitude' : np.round(midnight_alt[i], 2).tolist(),
+                'hours' : np.round(hours[i], 2).tolist(),
+                'moon_separation' : np.round(moon_separation[i], 2).tolist()
+                }
+
+    def figure(figsize=(11, 6)):
+        return visibility_chart(observatory, dates, result, twilight, figsize)
+
+    return result, figure
+
+
+def visibility_chart(observatory, dates, visibility, twilight='astronomical', figsize=(11, 6)):
+    """
+    Annual visibility chart, from visibility_year results
+
+    Three panels sharing the date axis: altitude at local midnight,
+    hours observable per night, and Moon distance at local midnight.
+
+    Returns
+    -------
+    fig : matplotlib.figure.Figure
+        Visibility chart figure, to be rendered with render
+
+    """
+
+    nights = [datetime.datetime.strptime(date, "%Y-%m-%d") for date in dates]
+
+    fig = Figure(figsize=figsize)
+    fig.set_facecolor("white")
+    fig.subplots_adjust(top=0.93, right=0.80, hspace=0.08, bottom=0.08)
+
+    ax_altitude = fig.add_subplot(311)
+    ax_hours = fig.add_subplot(312, sharex=ax_altitude)
+    ax_moon = fig.add_subplot(313, sharex=ax_altitude)
+
+    for name, obj in visibility['objects'].items():
+        line, = ax_altitude.plot(nights, obj['midnight_altitude'], label=name)
+        ax_hours.plot(nights, obj['hours'], color=line.get_color())
+        ax_moon.plot(nights, obj['moon_separation'], color=line.get_color())
+
+    # Length of the night between twilights, the maximum observable
+    ax_hours.fill_between(nights, 0, visibility['night_hours'], color='k', alpha=0.1, lw=0,
+                          label='{} night'.format(twilight.capitalize()))
+
+    ax_altitude.set_ylim(0, 90)
+    ax_altitude.set_ylabel('Altitude at\nmidnight')
+    ax_hours.set_ylim(bottom=0)
+    ax_hours.set_ylabel('Hours\nobservable')
+    ax_moon.set_ylim(0, 180)
+    ax_moon.set_ylabel('Moon distance\nat midnight')
+
+    for ax in (ax_altitude, ax_hours):
+        for label in ax.get_xticklabels():
+            label.set_visible(False)
+
+    ax_moon.xaxis.set_major_formatter(mdates.DateFormatter('%b'))
+    ax_moon.set_xlim(nights[0], nights[-1])
+    ax_moon.set_xlabel('Visibility at {} from {} to {}'.format(observatory, dates[0], dates[-1]))
+
+    ax_altitude.legend(loc='upper left', bbox_to_anchor=(1.01, 1), fancybox=False,
+                       shadow=False, fontsize=8)
+    ax_hours.legend(loc='upper left', bbox_to_anchor=(1.01, 1), fancybox=False,
+                    shadow=False, fontsize=8)
+
+    return fig
+
+
+def culminations(data):
+    """
+    Culmination, best time and observable window of a list of objects for a night
+
+    The times are computed analytically from the local sidereal time and the
+    hour angle of each object, for all the objects at once. Altitudes are
+    geometric (no atmospheric refraction).
+
+    Parameters
+    ----------
+    data : POST data format
+
+        data = {
+            'observatory' : 'OT',
+            'date' : '2020-06-11',
+            'altitude_lower_limit' : '30',
+            'objects' : [{
+                    'name' : 'Kelt 8b',
+                    'RA' : 283.30551667 ,
+                    'Dec' : 24.12738139
+                    },
+                    (more objects...)
+                ]
+            }
+
+        The night starts at the Sun setting of the local date.
+
+    Returns
+    -------
+    culminations : dict
+        For each object: next meridian transit after the Sun setting,
+        maximum altitude (degrees), rising and setting times above the altitude
+        limit around the transit (None if always or never above it), best time
+        (minimum airmass) in the night, altitude and airmass at that time, and
+        window of the night above the altitude limit. Times in ISO format, UTC.
+
+        {
+            'Kelt 8b' : {
+                'transit' : '2020-06-12 02:49:46.350',
+                'max_altitude' : 85.4,
+                'rise' : '2020-06-11 22:30:01.200',
+                'set' : '2020-06-12 07:09:31.500',
+                'best_time' : '2020-06-12 02:49:46.350',
+                'best_altitude' : 85.4,
+                'min_airmass' : 1.0,
+                'window' : ['2020-06-11 22:30:01.200', '2020-06-12 05:41:10.000']
+            }
+        }
+
+    """
+
+    from astropy.coordinates import TETE
+    from app.constraints import Constraints, target_coords, is_moving, moving_coords, check_targets
+
+    # Sidereal hours per solar hour
+    sidereal_rate = 1.00273790935
+
+    observatory = data['observatory']
+    objects = data['objects']
+    check_targets(objects)
+
+    if not objects:
+        return {}
+
+    location = get_location(observatory)
+    altitude_limit = Constraints(data).altitude_lower_limit
+
+    # Night window, from Sun setting to rising, in JD
+    night = night_time_range(observatory, data['date'])
+    sunset, sunrise = night.jd
+
+    # Apparent coordinates for the night, moving targets at the middle of the night
+    middle = Time((sunset + sunrise)/2, format='jd')
+    ra = np.zeros(len(objects))
+    dec = np.zeros(len(objects))
+
+    fixed = [i for i, obj in enumerate(objects) if not is_moving(obj)]
+    if fixed:
+        coords = target_coords([objects[i] for i in fixed]).transform_to(TETE(obstime=middle))
+        ra[fixed], dec[fixed] = coords.ra.hour, coords.dec.rad
+
+    for i, obj in enumerate(objects):
+        if is_moving(obj):
+            coords = moving_coords(obj, Time([middle.jd], format='jd')).transform_to(TETE(obstime=middle))
+            ra[i], dec[i] = coords.ra.hour[0], coords.dec.rad[0]
+
+    lat = np.radians(location.location.lat.deg)
+
+    lst_sunset = Time(sunset, format='jd').sidereal_time('apparent', longitude=location.location.lon).hour
+
+    def hours_to_days(hours):
+        return hours/sidereal_rate/24
+
+    def altitude(ha):
+        """Altitude in degrees for hour angles in hours"""
+        sin_alt = np.sin(lat)*np.sin(dec) + np.cos(lat)*np.cos(dec)*np.cos(np.radians(ha*15))
+        return np.degrees(np.arcsin(np.clip(sin_alt, -1, 1)))
+
+    # Next meridian transit after the Sun setting, and the previous one
+    transit = sunset + hours_to_days((ra - lst_sunset) % 24)
+    previous_transit = transit - hours_to_days(24)
+
+    max_altitude = 90 - np.degrees(np.abs(lat - dec))
+
+    # Semi-diurnal arc above the altitude limit: cos(H0) <= -1 always above,
+    # cos(H0) >= 1 never above
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cos_h0 = (np.sin(np.radians(altitude_limit)) - np.sin(lat)*np.sin(dec)) / (np.cos(lat)*np.cos(dec))
+    always_up = cos_h0 <= -1
+    never_up = cos_h0 >= 1
+    half_arc = hours_to_days(np.degrees(np.arccos(np.clip(cos_h0, -1, 1)))/15)
+
+    # Window above the limit in the night, around the previous or next transit,
+    # whichever is longer
+    windows = []
+    for center in (previous_transit, transit):
+        start = np.where(always_up, sunset, np.maximum(center - half_arc, sunset))
+        end = np.where(always_up, sunrise, np.minimum(center + half_arc, sunrise))
+        windows.append((start, end, np.where(never_up, 0, np.maximum(end - start, 0))))
+
+    use_next = windows[1][2] >= windows[0][2]
+    window_start = np.where(use_next, windows[1][0], windows[0][0])
+    window_end = np.where(use_next, windows[1][1], windows[0][1])
+    window_length = np.where(use_next, windows[1][2], windows[0][2])
+    rise = np.where(use_next, transit, previous_transit) - half_arc
+    set_ = np.where(use_next, transit, previous_transit) + half_arc
+
+    # Best time: the transit if it is in the night, otherwise
+    # the night limit with the smallest hour angle
+    ha_sunset = (lst_sunset - ra + 12) % 24 - 12
+    ha_sunrise = ha_sunset + (sunrise - sunset)*24*sidereal_rate
+    ha_sunrise = (ha_sunrise + 12) % 24 - 12
+
+    transit_in_night = transit <= sunrise
+    best_time = np.where(transit_in_night, transit,
+                         np.where(np.abs(ha_sunset) <= np.abs(ha_sunrise), sunset, sunrise))
+    best_altitude = np.where(transit_in_night, max_altitude,
+                             altitude(np.where(np.abs(ha_sunset) <= np.abs(ha_sunrise), ha_sunset, ha_sunrise)))
+
+    # ISO times of all the objects in single conversions
+    def iso(jd):
+        return Time(jd, format='jd').iso
+
+    transit_iso, best_iso = iso(transit), iso(best_time)
+    rise_iso, set_iso = iso(rise), iso(set_)
+    start_iso, end_iso = iso(window_start), iso(window_end)
+
+    result = {}
+    for i, obj in enumerate(objects):
+        arc = not (always_up[i] or never_up[i])
+        result[obj['name']] = {
+                'transit' : transit_iso[i],
+                'max_altitude' : round(float(max_altitude[i]), 2),
+                'rise' : rise_iso[i] if arc else None,
+                'set' : set_iso[i] if arc else None,
+                'best_time' : best_iso[i],
+                'best_altitude' : round(float(best_altitude[i]), 2),
+                'min_airmass' : round(float(1/np.sin(np.radians(best_altitude[i]))), 3)
+                                if best_altitude[i] > 0 else None,
+                'window' : [start_iso[i], end_iso[i]] if window_length[i] > 0 else []
+                }
+
+    return result
+
+
+def schedule(data):
+    """
+    Sequence of observations for a night, from a list of targets with priorities
+
+    The targets x time slots feasibility matrix is computed once with the
+    observability constraints. Transits are placed first, in their own
+    slots, and then the other targets, by decreasing priority, in the
+    free feasible slots where their mean altitude is highest.
+
+    Parameters
+    ----------
+    data : POST data format
+
+        data = {
+            'observatory' : 'OT',
+            'date' : '2020-06-11',
+            'twilight_type' : 'astronomical',
+            'altitude_lower_limit' : '30',
+            'slot' : 5,
+            'objects' : [{
+                    'name' : 'Kelt 8b',
+                    'RA' : 283.30551667 ,
+                    'Dec' : 24.12738139,
+                    'priority' : 3,
+                    'planet' : {
+                        'period' : 3.24406,
+                        't0' : 2456883.4803,
+                        'duration' : 0.1431
+                        }
+                    },
+                    {
+                    'name' : 'KIC8012732',
+                    'RA' : 284.72949583 ,
+                    'Dec' : 43.86421667,
+                    'priority' : 1,
+                    'exposure' : 45
+                    },
+                    (more objects...)
+                ]
+            }
+
+        'slot' is the time resolution in minutes (default 5) and 'exposure'
+        the observing time in minutes (default one slot). Higher priorities
+        are placed first (default 1). Transits are given with 'transit'
+        ('t_early' and 't_late' times) or with the 'planet' ephemeris, as in
+        transits, and they must be observable for the whole transit.
+        Optional constraints (moon separation, airmass, moon illumination,
+        hour angle and horizon) are described in app.constraints.Constraints
+
+    Returns
+    -------
+    schedule : dict
+        Night limits (between twilights), scheduled observations sorted by
+        start time, and unscheduled targets with the reason
+
+        {
+            'night' : ['2020-06-11 21:44:10.012', '2020-06-12 05:11:34.533'],
+            'schedule' : [
+                {'name' : 'KIC8012732', 'start' : '2020-06-11 23:09:10.012',
+                 'end' : '2020-06-11 23:54:10.012', 'priority' : 1},
+                (more observations...)
+            ],
+            'unscheduled' : [
+                {'name' : 'TIC 123456789', 'reason' : 'not observable'}
+            ]
+        }
+
+    """
+
+    from app.constraints import Constraints, objects_altaz, check_targets
+
+    observatory = data['observatory']
+    date = data['date'][:10]
+    objects = data['objects']
+    check_targets(objects)
+
+    location = get_location(observatory)
+    constraints = Constraints(data)
+
+    # Night between twilights, in slots
+    night = night_boundaries(observatory, date, constraints.twilight_type)
+    evening, morning = night['twilight_evening'], night['twilight_morning']
+
+    slot = float(data.get('slot', 5))/1440
+    n_slots = max(int((morning - evening)/slot), 1)
+    times = Time(evening + slot*(np.arange(n_slots) + 0.5), format='jd')
+
+    result = {
+        'night' : [Time(evening, format='jd').iso, Time(morning, format='jd').iso],
+        'schedule' : [],
+        'unscheduled' : []
+        }
+
+    if not objects:
+        return result
+
+    # Feasibility matrix of all the targets, and altitudes to choose the best slots
+    alt, az = objects_altaz(location, objects, times)
+    feasible = constraints.evaluate(location, times, alt, az, get_horizon(observatory))
+
+    # Required slots of each target: transit limits, or number of slots
+    transit_slots = {}
+    n_required = np.ones(len(objects), dtype=int)
+
+    for i, obj in enumerate(objects):
+        transit = obj.get('transit')
+        if transit is None and obj.get('planet'):
+            # Next transit after the start of the night
+            obstime = Time(evening + obj['planet']['duration']/2, format='jd').iso
+            transit = transits({obj['name']: obj['planet']}, obstime, n_eclipses=1)[obj['name']][0]
+
+        if transit is not None:
+            first = int(np.floor((Time(transit['t_early']).jd - evening)/slot))
+            last = int(np.ceil((Time(transit['t_late']).jd - evening)/slot))
+            transit_slots[i] = (first, last)
+        else:
+            n_required[i] = max(int(np.ceil(float(obj.get('exposure', 0))/1440/slot)), 1)
+
+    priority = np.array([float(obj.get('priority', 1)) for obj in objects])
+
+    free = np.ones(n_slots, dtype=bool)
+    placed = {}
+    reasons = {}
+
+    # Transits, hard slots, by decreasing priority
+    for i in sorted(transit_slots, key=lambda i: -priority[i]):
+        first, last = transit_slots[i]
+        if first < 0 or last > n_slots:
+            reasons[i] = 'transit not in the night'
+        elif not feasible[i, first:last].all():
+            reasons[i] = 'transit not observable'
+        elif not free[first:last].all():
+            reasons[i] = 'no free time'
+        else:
+            free[first:last] = False
+            placed[i] = (first, last)
+
+    # Other targets, by decreasing priority and then shorter exposures
+    others = [i for i in np.lexsort((n_required, -priority)) if i not in transit_slots]
+
+    for i in others:
+        k = n_required[i]
+
+        # Feasible windows of k consecutive slots, with cumulative sums
+        feasible_count = np.concatenate([[0], np.cumsum(feasible[i])])
+        windows = (feasible_count[k:] - feasible_count[:-k]) == k
+
+        if not windows.any():
+            reasons[i] = 'not observable'
+            continue
+
+        free_count = np.concatenate([[0], np.cumsum(feasible[i] & free)])
+        windows = (free_count[k:] - free_count[:-k]) == k
+
+        if not windows.any():
+            reasons[i] = 'no free time'
+            continue
+
+        # Free window with the highest mean altitude
+        alt_sum = np.concatenate([[0], np.cumsum(alt[i])])
+        mean_alt = np.where(windows, alt_sum[k:] - alt_sum[:-k], -np.inf)
+        first = int(np.argmax(mean_alt))
+
+        free[first:first + k] = False
+        placed[i] = (first, first + k)
+
+    # Slot limits in ISO format, in a single conversion
+    limits = Time(evening + slot*np.arange(n_slots + 1), format='jd').iso
+
+    for i, (first, last) in sorted(placed.items(), key=lambda item: item[1]):
+        result['schedule'].append({
+                'name' : objects[i]['name'],
+                'start' : limits[first],
+                'end' : limits[last],
+                'priority' : priority[i]
+                })
+
+    for i, obj in enumerate(objects):
+        if i in reasons:
+            result['unscheduled'].append({'name' : obj['name'], 'reason' : reasons[i]})
+
+    return result
+
+
+def subscribe(data, now=None):
+    """
+    Register a subscription to the observability of a list of objects
+
+    The observability is evaluated on a rolling time grid from the current
+    time, stored in the state store of the application (app.cache.get_store).
+    Each poll (see poll_subscription) evaluates only the time slots added
+    since the previous one, and returns only the objects whose observability
+    changed.
+
+    Parameters
+    ----------
+    data : POST data format
+
+        data = {
+            'observatory' : 'OT',
+            'altitude_lower_limit' : '30',
+            'twilight_type' : 'astronomical',
+            'window' : 12,
+            'resolution' : 5,
+            'objects' : [{
+                    'name' : 'Kelt 8b',
+                    'RA' : 283.30551667 ,
+                    'Dec' : 24.12738139
+                    },
+                    (more objects...)
+                ]
+            }
+
+        'window' is the length of the rolling grid in hours (default 12) and
+        'resolution' its time step in minutes (default 5).
+        Optional constraints (moon separation, airmass, moon illumination,
+        hour angle and horizon) are described in app.constraints.Constraints
+    now : astropy.time.Time (optional)
+        Current time. Default Time.now()
+
+    Returns
+    -------
+    subscription : dict
+        Subscription token, and observability of all the objects, as
+        in poll_subscription
+
+    """
+
+    import secrets
+    from app.cache import get_store
+    from app.constraints import check_targets
+
+    check_targets(data['objects'])
+
+    token = secrets.token_urlsafe(16)
+
+    state = {'data': data, 'start': None, 'mask': None, 'reported': {}}
+    changed = _update_subscription(state, now or Time.now())
+
+    get_store().add(token, state, SUBSCRIPTION_TTL)
+
+    return {'token': token, 'observability': changed}
+
+
+def poll_subscription(token, now=None):
+    """
+    Observability changes of a subscription since the previous poll
+
+    Parameters
+    ----------
+    token : str
+        Subscription token, from subscribe
+    now : astropy.time.Time (optional)
+        Current time. Default Time.now()
+
+    Returns
+    -------
+    changes : dict
+        Objects whose observability changed, or None if the subscription
+        does not exist or expired. 'observable' is *ever* in the rolling
+        window, 'observable_now' at the current time slot, and 'windows'
+        the observable time windows in the rolling window (ISO format, UTC).
+
+        {
+            'token' : 'Xq3...',
+            'time' : '2020-06-11 23:05:00.000',
+            'changed' : {
+                'Kelt 8b' : {
+                    'observable' : 'True',
+                    'observable_now' : 'False',
+                    'windows' : [['2020-06-11 23:30:00.000', '2020-06-12 04:25:00.000']]
+                }
+            }
+        }
+
+    """
+
+    from app.cache import get_store
+
+    store = get_store()
+    now = now or Time.now()
+
+    # Concurrent polls of a subscription: the update is only stored if the
+    # state was not updated meanwhile, otherwise it is done again from it
+    while True:
+        stored = store.get(token)
+        if stored is None:
+            return None
+
+        state, version = stored
+        changed = _update_subscription(state, now)
+
+        if store.replace(token, state, version, SUBSCRIPTION_TTL):
+            return {'token': token, 'time': now.iso, 'changed': changed}
+
+
+def _update_subscription(state, now):
+    """
+    Advance the rolling grid of a subscription to now, and return the changed objects
 
-    # x axis date format in hours.
-    # Add a hyphen between the % and the letter to remove the leading zero (01 -> 1).
-    #ax.xaxis.set_major_formatter(mdates.DateFormatter('%-H'))
+    The grid is aligned to multiples of the resolution, so only the slots
+    added since the previous update are evaluated. Changes are detected
+    ignoring the start of windows already open and the end of windows
+    reaching the end of the grid, which move with the grid.
 
-    # --- Y axis ----
-    # set the values and labels of the yticks
-    ax.set_yticklabels(ylabels)
-    ax_airmass = ax.twinx()
+    """
 
-    # set the values and labels of the yticks
-    ax_airmass_labels = np.round(1/np.cos(np.radians(90-yticks_values)), 2)
-    ax_airmass.set_yticks(yticks_values)
-    ax_airmass_labels = ax_airmass_labels.tolist()
-    ax_airmass_labels[0] = ""
-    ax_airmass.set_yticklabels(ax_airmass_labels)
-    ax_airmass.set_ylabel("Airmass")
+    from app.constraints import Constraints, objects_altaz
 
-    # Plotting limits are sun setting and rising, which
-    # are the first and last elements in fractions_days list
-    ax.set_xlim(setting_time, rising_time)
-    ax.set_xlabel('{} Local Time, starting night {}'.format(observatory, obs_date))
+    data = state['data']
+    objects = data['objects']
 
-    # Upper x axis with sidereal time
-    # -------------------------------
-    # sidereal time upper ticks are cloned from xticks (UT local time) using
-    # ax.get_xticks(), which returns a list of floats  which gives the number
-    # of days (fraction part represents hours, minutes, seconds) since
-    # 0001-01-01 00:00:00 UTC *plus* *one* (historical reasons)
-    # Then this float must be converted to datetime with num2date and then
-    # to astropy.Time to compute the sidereal time for each value, properly formatted
-    ax_sidereal_time = ax.twiny()
-    ax_sidereal_time_ticks = ax.get_xticks()
-    ax_sidereal_time.set_xticks(ax_sidereal_time_ticks)
-    ax_sidereal_time.set_xbound(ax.get_xbound())
+    resolution = float(data.get('resolution', 5))/1440
+    n_slots = max(int(round(float(data.get('window', 12))/24/resolution)), 1)
+    start = int(np.floor(now.jd/resolution))
 
-    sidereal_times = []
-    dates_datetime = Time(dates.num2date(ax.get_xticks()))
+    def evaluate(first, last):
+        """Observability mask of the absolute slots first to last"""
+        location = get_location(data['observatory'])
+        times = Time(np.arange(first, last)*resolution, format='jd')
+        alt, az = objects_altaz(location, objects, times)
+        return Constraints(data).evaluate(location, times, alt, az, get_horizon(data['observatory']))
 
-    for sidereal in dates_datetime.sidereal_time(
-            kind='mean', longitude=location.location.lon):
-        sidereal_times.append("{:02.0f}:{:02.0f}".format(sidereal.hms.h, sidereal.hms.m))
+    mask = state['mask']
 
-    ax_sidereal_time.set_xticklabels(sidereal_times)
-    ax_sidereal_time.set_xlabel('Local sidereal time at {}'.format(observatory), fontsize=10)
+    if not objects:
+        mask = np.zeros((0, n_slots), dtype=bool)
+    elif mask is None or not 0 <= start - state['start'] < n_slots:
+        mask = evaluate(start, start + n_slots)
+    elif start > state['start']:
+        # Only the time slice that advanced is evaluated
+        advance = start - state['start']
+        mask = np.concatenate([mask[:, advance:],
+                               evaluate(start + n_slots - advance, start + n_slots)], axis=1)
 
-    # Transit band limits, if any.
-    # Dates in YYYY-MM-SS hh:mm format. seconds are removed if included
-    if transits:
-        for transit in transits:
-            t_early = datetime.datetime.strptime(transit['t_early'][:16], "%Y-%m-%d %H:%M")
-            t_late = datetime.datetime.strptime(transit['t_late'][:16], "%Y-%m-%d %H:%M")
+    state['start'] = start
+    state['mask'] = mask
 
-            ax.axvspan(t_early, t_late, color=object_colors[transit['name']], alpha=0.2)
+    # Observable windows of all the objects, from the mask edges
+    edges = np.diff(np.pad(mask.astype(np.int8), ((0, 0), (1, 1))), axis=1)
+    window_rows, window_starts = np.nonzero(edges == 1)
+    window_ends = np.nonzero(edges == -1)[1] - 1
 
-    ax.set_ylim(0, 90)
-    ax.set_ylabel('Altitude')
+    windows = collections.defaultdict(list)
+    for row, first, last in zip(window_rows, window_starts, window_ends):
+        windows[row].append((first, last))
 
-    ax.legend(loc='upper center', bbox_to_anchor=(0.5, -0.15),
-          fancybox=False, shadow=False, ncol=5, fontsize=8)
+    iso = Time(np.arange(start, start + n_slots)*resolution, format='jd').iso if objects else []
 
-    ax.set_ymargin(0)
+    changed = {}
+    for i, obj in enumerate(objects):
+        # Open windows are compared without their moving limits
+        signature = [mask[i, 0]] + [(None if first == 0 else start + first,
+                                     None if last == n_slots - 1 else start + last)
+                                    for first, last in windows[i]]
+        signature = str(signature)
 
-    return fig
+        if state['reported'].get(obj['name']) != signature:
+            state['reported'][obj['name']] = signature
+            changed[obj['name']] = {
+                    'observable': str(bool(windows[i])),
+                    'observable_now': str(bool(mask[i, 0])),
+                    'windows': [[iso[first], iso[last]] for first, last in windows[i]]
+                    }
+
+    return changed
 
 
 def observability(data):
@@ -242,6 +1192,7 @@ def observability(data):
             'altitude_lower_limit' : '30',
             'altitude_higher_limit' : '90',
             'twilight_type' : 'astronomical',
+            'moon_separation_lower_limit' : 20,
             'objects' : [{
                     'name' : 'Kelt 8b',
                     'RA' : 283.30551667 ,
@@ -251,6 +1202,9 @@ def observability(data):
                 ]
             }
 
+        Optional constraints (moon separation, airmass, moon illumination,
+        hour angle and horizon) are described in app.constraints.Constraints
+
     Returns
     -------
     observability : dict
@@ -266,59 +1220,69 @@ def observability(data):
 
     """
 
-    import astropy.units as u
-    from astroplan import FixedTarget
-    from astroplan import (AltitudeConstraint, AtNightConstraint)
-    from astroplan import is_observable, is_always_observable
+    from app.constraints import Constraints, DateTable, evaluate_windows, sample_altaz, angular_separation
+    from app.constraints import check_targets
+    from app.cache import memoize_entries
 
-    # Site location
-    location = get_location(data['observatory'])
+    objects = data['objects']
+    check_targets(objects)
 
-    time_range = Time([data['date'], data['date_end']])
+    # Site location and horizon
+    location = get_location(data['observatory'])
+    horizon = get_horizon(data['observatory'])
 
-    if 'twilight_type' not in data.keys():
-        data['twilight_type'] = 'astronomical'
+    # Observation constraints, compiled once for all the targets
+    constraints = Constraints(data)
 
-    if data['twilight_type'] == 'civil':
-        twilight_constraint = AtNightConstraint.twilight_civil()
-    elif data['twilight_type'] == 'nautical':
-        twilight_constraint = AtNightConstraint.twilight_nautical()
-    else:
-        twilight_constraint = AtNightConstraint.twilight_astronomical()
+    def compute(indices):
+        """Observability of the objects not cached"""
 
-    # Observation constraints
-    constraints = [AltitudeConstraint(int(data['altitude_lower_limit'])*u.deg,
-                                      int(data['altitude_higher_limit'])*u.deg),
-                                      twilight_constraint
-                                      ]
+        targets = [objects[i] for i in indices]
 
-    # Dictionary with star name and observability (bool str)
-    result = {}
+        # All the dates of the request, parsed at once
+        transit = np.array(['transit' in target for target in targets], dtype=bool)
+        dates = DateTable([data['date'], data['date_end']] +
+                          [target['transit'][limit] for target in targets if 'transit' in target
+                           for limit in ('t_early', 't_late')])
 
-    # Moon location for the observation date
-    middle_observing_time = time_range[-1] - (time_range[-1] - time_range[0])/2
-    moon = location.moon_altaz(middle_observing_time)
+        # Time window of each target: the time range, or the transit
+        time_range = dates.jd[dates.index([data['date'], data['date_end']])]
+        starts = np.full(len(targets), time_range[0])
+        ends = np.full(len(targets), time_range[1])
+        if transit.any():
+            starts[transit] = dates.jd[dates.index([target['transit']['t_early']
+                                                    for target in targets if 'transit' in target])]
+            ends[transit] = dates.jd[dates.index([target['transit']['t_late']
+                                                  for target in targets if 'transit' in target])]
 
-    for target in data['objects']:
-        # Object coordinates
-        coords = SkyCoord(ra=target['RA']*u.deg, dec=target['Dec']*u.deg)
-        fixed_target = [FixedTarget(coord=coords, name=target['name'])]
+        # Targets are *ever* observable in the time range,
+        # or *always* observable during the transit
+        ever, always = evaluate_windows(constraints, location, targets, starts, ends, horizon)
+        observable = np.where(transit, always, ever)
 
+        # Moon location for the observation date
+        middle_observing_time = Time(np.full(len(targets), time_range.mean()), format='jd')
+        moon = location.moon_altaz(middle_observing_time[0])
+        alt, az = sample_altaz(location, targets, np.arange(len(targets)), middle_observing_time)
+        moon_separation = angular_separation(alt, az, moon.alt.deg, moon.az.deg)
+
+        return [{'observable': str(observable[i]), 'moon_separation': moon_separation[i]}
+                for i in range(len(targets))]
+
+    # Only the objects not cached are computed
+    keys = []
+    for target in objects:
+        window = ['ever', data['date'], data['date_end']]
         if 'transit' in target.keys():
-           time_range = Time([target['transit']['t_early'], target['transit']['t_late']])
-           # Are targets *always* observable in the time range?
-           observable = is_always_observable(constraints, location, fixed_target, time_range=time_range)
-        else:
-           time_range = Time([data['date'], data['date_end']])
-           # Are targets *ever* observable in the time range?
-           observable = is_observable(constraints, location, fixed_target, time_range=time_range)
+            window += ['always', target['transit']['t_early'], target['transit']['t_late']]
+        keys.append(entry_key('observability', target, data['observatory'], window, constraints))
 
-        moon_separation = moon.separation(coords)
+    results = memoize_entries('observability', keys, compute)
 
-        result[target['name']] = {
-                'observable': str(observable[0]),
-                'moon_separation': moon_separation.degree
-                }
+    # Dictionary with star name and observability (bool str)
+    result = {}
+    for target, target_result in zip(objects, results):
+        result[target['name']] = target_result
 
     return result
 
@@ -365,6 +1329,9 @@ def observability_dates(data):
                     ]
             }
 
+        Optional constraints (moon separation, airmass, moon illumination,
+        hour angle and horizon) are described in app.constraints.Constraints
+
     Returns
     -------
     observability : dict
@@ -380,63 +1347,54 @@ def observability_dates(data):
 
     """
 
-    import astropy.units as u
-    from astroplan import FixedTarget
-    from astroplan import (AltitudeConstraint, AtNightConstraint)
-    from astroplan import is_observable, is_always_observable
-
-    # Site location
-    location = get_location(data['observatory'])
+    from app.constraints import Constraints, DateTable, evaluate_windows, sample_altaz, angular_separation
+    from app.constraints import check_targets
+    from app.cache import memoize_entries
 
-    coords = SkyCoord(ra=data['RA']*u.deg, dec=data['Dec']*u.deg)
-    fixed_target = [FixedTarget(coord=coords, name=data['name'])]    
+    # The request is the target
+    check_targets([data])
 
-    # List of dates of observability
-    observabilities = []
+    # Site location and horizon
+    location = get_location(data['observatory'])
+    horizon = get_horizon(data['observatory'])
 
-    if 'twilight_type' not in data.keys():
-        data['twilight_type'] = 'astronomical'
+    # Observation constraints, compiled once for all the dates
+    constraints = Constraints(data)
 
-    if data['twilight_type'] == 'civil':
-        twilight_constraint = AtNightConstraint.twilight_civil()
-    elif data['twilight_type'] == 'nautical':
-        twilight_constraint = AtNightConstraint.twilight_nautical()
-    else:
-        twilight_constraint = AtNightConstraint.twilight_astronomical()
+    # Time ranges are tested as *always*, single dates as *ever*
+    time_ranges = len(data['dates'][0]) > 1 if data['dates'] else False
 
-    # Observation constraints
-    constraints = [AltitudeConstraint(float(data['altitude_lower_limit'])*u.deg,
-                                    float(data['altitude_higher_limit'])*u.deg),
-                                    twilight_constraint
-                ]
+    def compute(indices):
+        """Observability for the dates not cached"""
 
-    for date in data['dates']:
+        todo = [data['dates'][i] for i in indices]
 
-        # time range for transits
-        # Always observable for time range
-        if len(data['dates'][0]) > 0:
+        # All the dates of the request, parsed at once
+        dates = DateTable([value for date in todo for value in date])
+        first = dates.index([date[0] for date in todo])
 
-            # If exoplanet transits, check for observability always during transit,
-            # if not, check observability *ever* during night
-            time_range = Time([date[0], date[1]])
+        # Single dates are evaluated at that time only
+        starts = dates.jd[first]
+        ends = dates.jd[dates.index([date[-1] for date in todo])]
 
-            # Are targets *always* observable in the time range?
-            observable = is_always_observable(constraints, location, fixed_target, time_range=time_range)
+        ever, always = evaluate_windows(constraints, location, [data]*len(todo), starts, ends, horizon)
+        observable = always if time_ranges else ever
 
-        # No time range, *ever* observabable during the night
-        else:
-            observable = is_observable(constraints, location, fixed_target, times=Time(date[0]))
+        # Moon location for each distinct observation date
+        moon_dates, moon_index = np.unique(first, return_inverse=True)
+        moon = location.moon_altaz(dates.times[moon_dates])[moon_index.ravel()]
+        alt, az = sample_altaz(location, [data], np.zeros(len(todo)), dates.times[first])
+        moon_separation = angular_separation(alt, az, moon.alt.deg, moon.az.deg)
 
-        # Moon location for the observation date
-        moon = location.moon_altaz(Time(date[0]))
-        moon_separation = moon.separation(coords)
+        return [{'observable': str(observable[i]), 'moon_separation': moon_separation[i]}
+                for i in range(len(todo))]
 
-        observabilities.append({
-                'observable': str(observable[0]),
-                'moon_separation': moon_separation.degree
-                })
+    # Only the dates not cached are computed
+    mode = 'always' if time_ranges else 'ever'
+    keys = [entry_key('observability_dates', data, data['observatory'], [mode] + list(date), constraints)
+            for date in data['dates']]
 
-    return observabilities
+    return memoize_entries('observability_dates', keys, compute)
 
 
 def observability_objects(data):
@@ -471,6 +1429,9 @@ def observability_objects(data):
             ]
         }
 
+        Optional constraints (moon separation, airmass, moon illumination,
+        hour angle and horizon) are described in app.constraints.Constraints
+
     Returns
     -------
     observability : dict
@@ -486,71 +1447,430 @@ def observability_objects(data):
 
     """
 
-    import astropy.units as u
-    from astroplan import FixedTarget
-    from astroplan import (AltitudeConstraint, AtNightConstraint)
-    from astroplan import is_observable, is_always_observable
+    from app.constraints import Constraints, DateTable, evaluate_windows, sample_altaz, angular_separation
+    from app.constraints import check_targets
+    from app.cache import memoize_entries
 
-    # Site location
+    check_targets(data['objects'])
+
+    # Site location and horizon
     location = get_location(data['observatory'])
+    horizon = get_horizon(data['observatory'])
+
+    # Observation constraints, compiled once for all the targets
+    constraints = Constraints(data)
+
+    # (target, date) entries of the request
+    entries = [(target, date) for target in data['objects'] for date in target['dates']]
+
+    def compute(indices):
+        """Observability of the entries not cached"""
+
+        todo = [entries[i] for i in indices]
+
+        # All the dates of the request, parsed at once
+        dates = DateTable([value for _, date in todo for value in date])
+        first = dates.index([date[0] for _, date in todo])
+
+        # Time range for transits, *always* observable for time range
+        ranged = np.array([len(date) > 1 for _, date in todo], dtype=bool)
+        starts = dates.jd[first]
+        ends = starts.copy()
+        if ranged.any():
+            ends[ranged] = dates.jd[dates.index([date[1] for _, date in todo if len(date) > 1])]
+
+        # No time range, *ever* observable from sunset to sunrise.
+        # Each distinct night is computed once.
+        if not ranged.all():
+            nights, night_index = np.unique(first[~ranged], return_inverse=True)
+            night_times = dates.times[nights]
+            # A single night gives scalar twilight times
+            sunsets = np.atleast_1d(location.sun_set_time(night_times).jd)
+            sunrises = np.atleast_1d(location.sun_rise_time(night_times, 'next').jd)
+            starts[~ranged] = sunsets[night_index.ravel()]
+            ends[~ranged] = sunrises[night_index.ravel()]
+
+        targets = [target for target, _ in todo]
+        ever, always = evaluate_windows(constraints, location, targets, starts, ends, horizon)
+        observable = np.where(ranged, always, ever)
+
+        # Moon location for each distinct observation date
+        moon_dates, moon_index = np.unique(first, return_inverse=True)
+        moon = location.moon_altaz(dates.times[moon_dates])[moon_index.ravel()]
+        alt, az = sample_altaz(location, targets, np.arange(len(todo)), dates.times[first])
+        moon_separation = angular_separation(alt, az, moon.alt.deg, moon.az.deg)
+
+        return [{'observable': str(observable[i]), 'moon_separation': moon_separation[i]}
+                for i in range(len(todo))]
+
+    # Only the entries not cached are computed
+    keys = []
+    for target, date in entries:
+        window = ['always'] + list(date) if len(date) > 1 else ['night', date[0]]
+        keys.append(entry_key('observability_objects', target, data['observatory'], window, constraints))
+
+    results = memoize_entries('observability_objects', keys, compute)
 
     # dict of observability for each target
     observabilities =  {}
+    for (target, date), result in zip(entries, results):
+        observabilities.setdefault(target['name'], []).append(result)
+
+    # Targets without dates
+    for target in data['objects']:
+        observabilities.setdefault(target['name'], [])
+
+    return observabilities
+
+
+def observability_sites(data):
+    """
+    Test the observability of a list of objects for several observatories
+
+    The site independent work (coordinates and their CIRS transformation
+    for a shared UTC time grid) is done once, and then the altitudes and
+    constraints are computed for each site.
+
+    Parameters
+    ----------
+    data : POST data format
+
+        If 'date_end' is included, the time range from 'date' to 'date_end'
+        is used for all the sites, otherwise the night starting at 'date'
+        at each site.
+        data = {
+            'observatories' : ['OT', 'ORM', 'CAHA', 'OAO', 'Keck'],
+            'date' : '2020-06-11',
+            'altitude_lower_limit' : '30',
+            'altitude_higher_limit' : '90',
+            'twilight_type' : 'astronomical',
+            'objects' : [{
+                    'name' : 'Kelt 8b',
+                    'RA' : 283.30551667 ,
+                    'Dec' : 24.12738139
+                    },
+                    (more objects...)
+                ]
+            }
+
+        Optional constraints (moon separation, airmass, moon illumination,
+        hour angle and horizon) are described in app.constraints.Constraints
+
+        Only fixed targets, with RA and Dec, are supported.
+
+    Returns
+    -------
+    observability : dict
+        Dictionary with the observability and moon distance for all
+        the objects in each site
+
+        {'OT' : {
+                'V0879 Cas' : {'observable' : 'True', 'moon_separation' : 30.4},
+                'RU Scl' : {'observable' : 'False', 'moon_separation' : 10.8}
+            },
+        'Keck' : {
+                'V0879 Cas' : {'observable' : 'True', 'moon_separation' : 31.2},
+                'RU Scl' : {'observable' : 'True', 'moon_separation' : 11.5}
+            }
+        }
+
+    """
+
+    from app.constraints import Constraints, target_coords, time_grid, cirs_grid, cirs_altaz
+    from app.constraints import check_targets
+    from app.cache import memoize_entries
+
+    # Observation constraints, compiled once for all the sites
+    constraints = Constraints(data)
+
+    observatories = data['observatories']
+    objects = data['objects']
 
-    if 'twilight_type' not in data.keys():
-        data['twilight_type'] = 'astronomical'
+    # The shared CIRS grid is only computed for fixed targets
+    check_targets(objects, moving=False)
 
-    if data['twilight_type'] == 'civil':
-        twilight_constraint = AtNightConstraint.twilight_civil()
-    elif data['twilight_type'] == 'nautical':
-        twilight_constraint = AtNightConstraint.twilight_nautical()
+    # Time range of each site
+    if 'date_end' in data.keys():
+        time_ranges = [Time([data['date'], data['date_end']])]*len(observatories)
+        window = ['ever', data['date'], data['date_end']]
     else:
-        twilight_constraint = AtNightConstraint.twilight_astronomical()
+        time_ranges = [night_time_range(observatory, data['date']) for observatory in observatories]
+        window = ['site_night', data['date'][:10]]
 
-    # Observation constraints
-    constraints = [AltitudeConstraint(float(data['altitude_lower_limit'])*u.deg,
-                                      float(data['altitude_higher_limit'])*u.deg),
-                                      twilight_constraint
-                  ]
+    # (site, target) entries of the request
+    entries = [(s, t) for s in range(len(observatories)) for t in range(len(objects))]
 
-    for target in data['objects']:
+    def compute(indices):
+        """Observability of the entries not cached"""
 
-        coords = SkyCoord(ra=target['RA']*u.deg, dec=target['Dec']*u.deg)
-        fixed_target = [FixedTarget(coord=coords, name=target['name'])]    
+        sites = sorted({entries[i][0] for i in indices})
+        targets = sorted({entries[i][1] for i in indices})
 
-        observabilities[target['name']] =  []
+        # Shared UTC grid covering all the sites, twilight is tested for each site.
+        # The grid starts at a multiple of the resolution, so the results do not
+        # depend on the sites requested together.
+        start = min(time_ranges[site][0] for site in sites)
+        end = max(time_ranges[site][1] for site in sites)
+        start = Time(np.floor(start.jd*48)/48, format='jd')
+        times = time_grid(Time([start, end]))
 
-        for date in target['dates']:
+        # Site independent coordinates
+        coords = target_coords([objects[t] for t in targets])
+        cirs = cirs_grid(coords, times)
 
-            # time range for transits
-            # Always observable for time range
-            if len(date) > 1:
-                # If exoplanet transit, test observability always during transit,
-                # if not, test observability *ever* during night
-                time_range = Time([date[0], date[1]])
+        results = {}
+        for site in sites:
 
-                # Are targets *always* observable in the time range?
-                observable = is_always_observable(constraints, location, fixed_target, time_range=time_range)
+            observatory = observatories[site]
+            location = get_location(observatory)
+            time_range = time_ranges[site]
 
-            # No time range, *ever* observabable during the night
-            # Observability is test from sunset to sunrise
-            # Default time resolution is 0.5h
-            else:
-                sunset = location.sun_set_time(Time(date[0]))
-                sunrise = location.sun_rise_time(Time(date[0]), 'next')
-                time_range = Time([sunset, sunrise])
-                observable = is_observable(constraints, location, fixed_target, time_range=time_range)
+            alt, az = cirs_altaz(location, cirs, times)
+            mask = constraints.evaluate(location, times, alt, az, get_horizon(observatory))
 
-            # Moon location for the observation date
-            moon = location.moon_altaz(Time(date[0]))
-            moon_separation = moon.separation(coords)
+            # Only the time range of the site
+            in_range = (times >= time_range[0]) & (times <= time_range[1])
+            observable = (mask & in_range).any(axis=1)
 
-            observabilities[target['name']].append({
-                    'observable': str(observable[0]),
-                    'moon_separation': moon_separation.degree
-                    })
+            # Moon location in the middle of the time range
+            middle_observing_time = time_range[-1] - (time_range[-1] - time_range[0])/2
+            moon_separation = location.moon_altaz(middle_observing_time).separation(coords)
 
-    return observabilities
+            for i, t in enumerate(targets):
+                results[(site, t)] = {
+                        'observable': str(observable[i]),
+                        'moon_separation': moon_separation[i].degree
+                        }
+
+        return [results[entries[i]] for i in indices]
+
+    # Only the entries not cached are computed
+    keys = [entry_key('observability_sites', objects[t], observatories[s], window, constraints)
+            for s, t in entries]
+    results = memoize_entries('observability_sites', keys, compute)
+
+    result = collections.OrderedDict()
+    for observatory in observatories:
+        result[observatory] = {}
+
+    for (s, t), entry_result in zip(entries, results):
+        result[observatories[s]][objects[t]['name']] = entry_result
+
+    return result
+
+
+def entry_key(endpoint, target, observatory, window, constraints):
+    """
+    Cache key of the observability of a target in a site and time window
+
+    Each endpoint has its own keys, as the time grid and the Moon
+    separation time of the results differ between them.
+
+    Parameters
+    ----------
+    endpoint : str
+        Endpoint name
+    target : dict
+        Target with RA and Dec in degrees, rounded to 1e-5 deg, or moving
+        target with body or ephemeris
+    observatory : str
+        Observatory code
+    window : list
+        Time window description: type and dates
+    constraints : app.constraints.Constraints
+        Observation constraints
+
+    """
+
+    from app.cache import cache_key
+
+    # Moving targets are identified by their body or ephemeris
+    if 'body' in target:
+        position = ['body', target['body'].strip().lower()]
+    elif 'ephemeris' in target:
+        position = ['ephemeris', target['ephemeris']]
+    else:
+        position = [round(float(target['RA']), 5), round(float(target['Dec']), 5)]
+
+    return cache_key(endpoint, position, observatory, window, constraints.signature())
+
+
+def night_time_range(observatory, date):
+    """
+    Sun setting and next rising times of the night starting at a local date
+
+    Parameters
+    ----------
+    observatory : str
+        Observatory code
+    date : str
+        Local date of the beginning of the night, YYYY-MM-DD. Time is ignored.
+
+    Returns
+    -------
+    time_range : astropy.time.Time
+        Sun setting and rising times
+
+    """
+
+    from app.cache import get_cache, cache_key
+
+    def compute():
+        location = get_location(observatory)
+
+        # Local noon, before the night starts
+        noon = datetime.datetime.strptime(date[:10], "%Y-%m-%d").replace(hour=12)
+        noon = Time(location.timezone.localize(noon))
+
+        sunset = location.sun_set_time(noon, which='next')
+        sunrise = location.sun_rise_time(noon, which='next')
+
+        return [sunset.jd, sunrise.jd]
+
+    key = cache_key('night_time_range', observatory, date[:10])
+
+    return Time(get_cache().get_or_set(key, compute), format='jd')
+
+
+def night_grid(observatory, date, twilight='astronomical', samples=100):
+    """
+    Night boundaries and time grid of the altitude plot
+
+    Parameters
+    ----------
+    observatory : str
+        Observatory code
+    date : str
+        Observation date, YYYY-MM-DD
+    twilight : str (optional)
+        Twilight type: civil, nautical or astronomical
+    samples : int (optional)
+        Number of times from Sun setting to rising
+
+    Returns
+    -------
+    night : dict
+        Night boundaries, from night_boundaries
+    times : astropy.time.Time
+        Time grid from Sun setting to rising
+
+    """
+
+    night = night_boundaries(observatory, date, twilight)
+
+    times = Time(night['sunset'] + (night['sunrise'] - night['sunset'])*np.linspace(0, 1, samples),
+                 format='jd')
+
+    return night, times
+
+
+def night_boundaries(observatory, date, twilight='astronomical'):
+    """
+    Sun setting and rising and twilight times of the altitude plot night
+
+    The times are the next ones after the local noon of the date, as in
+    night_time_range and night_table, so the night starting at the local
+    date is used at any longitude. They are cached for all the workers.
+
+    Parameters
+    ----------
+    observatory : str
+        Observatory code
+    date : str
+        Observation date, YYYY-MM-DD
+    twilight : str (optional)
+        Twilight type: civil, nautical or astronomical
+
+    Returns
+    -------
+    night : dict
+        'sunset', 'sunrise', 'twilight_evening' and 'twilight_morning' times, in JD
+
+    """
+
+    from app.cache import get_cache, cache_key
+
+    def compute():
+        location = get_location(observatory)
+
+        # Local noon, before the night starts
+        noon = datetime.datetime.strptime(date[:10], "%Y-%m-%d").replace(hour=12)
+        noon = Time(location.timezone.localize(noon))
+
+        # twilights in astropy.Time object
+        if twilight == 'civil':
+            twilight1 = location.twilight_evening_civil(noon, which='next')
+            twilight2 = location.twilight_morning_civil(noon, which='next')
+        elif twilight == 'nautical':
+            twilight1 = location.twilight_evening_nautical(noon, which='next')
+            twilight2 = location.twilight_morning_nautical(noon, which='next')
+        else:
+            twilight1 = location.twilight_evening_astronomical(noon, which='next')
+            twilight2 = location.twilight_morning_astronomical(noon, which='next')
+
+        return {
+            'sunset': location.sun_set_time(noon, which='next').jd,
+            'sunrise': location.sun_rise_time(noon, which='next').jd,
+            'twilight_evening': twilight1.jd,
+            'twilight_morning': twilight2.jd,
+        }
+
+    # Apart from the nights around 12:00 UT cached by earlier versions
+    key = cache_key('night_boundaries', 'local noon', observatory, date[:10], twilight)
+
+    return get_cache().get_or_set(key, compute)
+
+
+def night_table(observatory, start, days, twilight='astronomical'):
+    """
+    Twilight times of consecutive nights
+
+    All the nights are computed in a single vectorized call, from the local
+    noon of each date as in night_time_range, and cached for all the workers.
+
+    Parameters
+    ----------
+    observatory : str
+        Observatory code
+    start : str
+        Date of the first night, YYYY-MM-DD
+    days : int
+        Number of nights
+    twilight : str (optional)
+        Twilight type: civil, nautical or astronomical
+
+    Returns
+    -------
+    night : dict
+        'twilight_evening' and 'twilight_morning' times of each night, in JD
+        arrays. NaN if the Sun does not reach the twilight altitude.
+
+    """
+
+    from app.cache import get_cache, cache_key
+
+    if twilight not in ('civil', 'nautical', 'astronomical'):
+        twilight = 'astronomical'
+
+    def compute():
+        location = get_location(observatory)
+
+        # Local noon of each date, before its night starts at any longitude
+        first = datetime.datetime.strptime(start[:10], "%Y-%m-%d").replace(hour=12)
+        noons = Time([location.timezone.localize(first + datetime.timedelta(days=day))
+                      for day in range(days)])
+
+        evening = getattr(location, 'twilight_evening_' + twilight)(noons, which='next')
+        morning = getattr(location, 'twilight_morning_' + twilight)(noons, which='next')
+
+        return {
+            'twilight_evening': np.ma.filled(np.ma.masked_invalid(evening.jd), np.nan),
+            'twilight_morning': np.ma.filled(np.ma.masked_invalid(morning.jd), np.nan),
+        }
+
+    key = cache_key('night_table', observatory, start, days, twilight)
+
+    return get_cache().get_or_set(key, compute)
 
 
 def transits(planets, obstime=None, n_eclipses=3):
@@ -629,35 +1949,76 @@ def get_location(observatory=None):
 
     """
 
-    import collections
+    locations = _locations()
+
+    # If an observatory is indicated, return its Observer object,
+    # otherwise return the dict of observatories
+    if observatory:
+        return locations[observatory]['location']
+
+    return locations
+
+
+@functools.lru_cache()
+def _locations():
+    """
+    Available observatories, built once per process
+    """
+
     from pytz import timezone
 
-    locations = collections.OrderedDict({
+    return collections.OrderedDict({
             "OT" : {"name" : "Observatorio del Teide",
-                    "location" : OT_observer()
+                    "location" : OT_observer(),
+                    "horizon" : horizon_profile("OT")
                    },
             "ORM": {"name" : "Observatorio del Roque de los Muchachos",
-                    "location" : Observer.at_site("lapalma", timezone=timezone('Atlantic/Canary'))
+                    "location" : Observer.at_site("lapalma", timezone=timezone('Atlantic/Canary')),
+                    "horizon" : horizon_profile("ORM")
                    },
             "CAHA": {"name" :  "Calar Alto Observatory",
-                    "location" : CAHA_observer()
+                    "location" : CAHA_observer(),
+                    "horizon" : horizon_profile("CAHA")
                    },
             "OAO": {"name" : "Okayama Astrophysical Observatory",
-                    "location" : OAO_observer()
+                    "location" : OAO_observer(),
+                    "horizon" : horizon_profile("OAO")
                    },
             "Keck": {"name" : "Keck Observatory",
-                    "location" : Observer.at_site("Keck Observatory", timezone=timezone('Pacific/Honolulu'))
+                    "location" : Observer.at_site("Keck Observatory", timezone=timezone('Pacific/Honolulu')),
+                    "horizon" : horizon_profile("Keck")
                    },
         })
 
-    # If an observatory is indicated, return its Observer object,
-    # otherwise return the dict of observatories
-    if observatory:
-        return locations[observatory]['location']
 
-    return locations
+@functools.lru_cache()
+def get_horizon(observatory):
+    """Return the horizon lookup array of an observatory
+
+    The horizon profile registered in get_location is converted once
+    to a dense azimuth to minimum altitude array.
+
+    Parameters
+    ----------
+    observatory : str
+        Observatory name code, from the locations available at get_location
+
+    Return
+    ------
+    horizon : numpy.ndarray
+        Horizon lookup array (see app.constraints.horizon_lookup), or
+        None if the observatory has a flat horizon
+
+    """
+
+    from app.constraints import horizon_lookup
+
+    profile = get_location()[observatory]['horizon']
 
+    if profile is None:
+        return None
 
+    return horizon_lookup(profile)
 
 
     
\ No newline at end of file
@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Load test and request replay of the ReST services
+
+Requests are sent at a target rate (open loop, so slow responses do not
+lower the offered load) by a pool of concurrent clients, either to the Flask
+application in this process (test client) or to a running server.
+
+Usage:
+
+    # Synthetic mix against the application in this process
+    python3 benchmarks/load.py run --qps 5 --duration 60 --concurrency 8 \\
+        --mix altitudeplot=1,observability_objects=3,transits=1 --targets 20 \\
+        --output before.json
+
+    # Replay of recorded requests against a running server
+    python3 benchmarks/load.py run --url http://localhost:5000 --requests requests.jsonl \\
+        --qps 20 --duration 120 --pid 12345 --output after.json
+
+    # Compare two runs
+    python3 benchmarks/load.py compare before.json after.json
+
+Recorded requests are JSON lines with the method, path and either the JSON
+body or the form data of each request:
+
+    {"method": "POST", "path": "/observability_objects", "json": {...}}
+    {"method": "POST", "path": "/submit", "form": {...}}
+
+The report has, for each endpoint, throughput, latency percentiles (from the
+scheduled send time), error rate and status codes. In process, it also has
+the CPU time per request and the peak RSS of the whole process (load
+generator and application, shared by all the endpoints) up to each request of
+the endpoint. With a server, the CPU time and peak RSS of the server process
+are reported for the whole run if its --pid is given (Linux only).
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+# Synthetic mix, weight of each endpoint
+DEFAULT_MIX = 'altitudeplot=1,observability=1,observability_dates=1,observability_objects=2,transits=1,submit=1'
+
+PERCENTILES = [50, 90, 99]
+
+
+def random_objects(rng, n_targets):
+    """Random fixed targets"""
+
+    return [{'name': 'Target {}'.format(i),
+             'RA': rng.uniform(0, 360),
+             'Dec': rng.uniform(-20, 70)} for i in range(n_targets)]
+
+
+def random_date(rng, date_spread):
+    """Random date within date_spread days from today"""
+
+    return datetime.date.today() + datetime.timedelta(days=rng.randint(0, date_spread))
+
+
+def synthetic_request(endpoint, rng, n_targets=10, date_spread=30, observatory='OT'):
+    """
+    Synthetic request for an endpoint
+
+    Returns
+    -------
+    request : dict
+        Request with method, path and json or form data, as the recorded ones
+
+    """
+
+    date = random_date(rng, date_spread)
+    day = date.strftime("%Y-%m-%d")
+    limits = {'observatory': observatory, 'altitude_lower_limit': '30',
+              'altitude_higher_limit': '90', 'twilight_type': 'astronomical'}
+
+    if endpoint == 'altitudeplot':
+        body = {'observatory': observatory, 'date': day, 'objects': random_objects(rng, n_targets)}
+
+    elif endpoint == 'observability':
+        body = dict(limits, date=day + ' 21:00:00', date_end=(date + datetime.timedelta(days=1)).strftime(
+                    "%Y-%m-%d") + ' 06:00:00', objects=random_objects(rng, n_targets))
+
+    elif endpoint == 'observability_dates':
+        target = random_objects(rng, 1)[0]
+        dates = [[random_date(rng, date_spread).strftime("%Y-%m-%d") + ' 23:00:00']
+                 for _ in range(n_targets)]
+        body = dict(limits, dates=dates, **target)
+
+    elif endpoint == 'observability_objects':
+        objects = random_objects(rng, n_targets)
+        for obj in objects:
+            obj['dates'] = [[random_date(rng, date_spread).strftime("%Y-%m-%d") + ' 23:59:59']]
+        body = dict(limits, objects=objects)
+
+    elif endpoint == 'transits':
+        planets = {'Planet {}'.format(i): {'period': rng.uniform(0.5, 10),
+                                           't0': 2458764.78 + rng.uniform(0, 10),
+                                           'duration': rng.uniform(0.05, 0.2)}
+                   for i in range(n_targets)}
+        body = {'planets': planets, 'obstime': day, 'n_eclipses': 3}
+
+    elif endpoint == 'submit':
+        # Coordinates in the form, so no name resolution is needed
+        lines = []
+        for obj in random_objects(rng, n_targets):
+            ra = obj['RA']/15
+            dec = abs(obj['Dec'])
+            sign = '-' if obj['Dec'] < 0 else '+'
+            lines.append('{},{:02.0f}:{:02.0f}:{:04.1f},{}{:02.0f}:{:02.0f}:00'.format(
+                obj['name'], ra // 1, (ra % 1)*60 // 1, ((ra*60) % 1)*60,
+                sign, dec // 1, (dec % 1)*60 // 1))
+        return {'method': 'POST', 'path': '/submit',
+                'form': {'objects': '\r\n'.join(lines), 'observatory': observatory, 'date': day}}
+
+    else:
+        raise ValueError("No synthetic requests for {}".format(endpoint))
+
+    return {'method': 'POST', 'path': '/' + endpoint, 'json': body}
+
+
+def read_requests(filename):
+    """Recorded requests, one JSON object per line"""
+
+    with open(filename) as requests_file:
+        return [json.loads(line) for line in requests_file if line.strip()]
+
+
+def endpoint_name(path):
+    """Endpoint of a request path, without parameters"""
+
+    return '/' + path.strip('/').split('/')[0]
+
+
+class Client(object):
+    """
+    Request sender, to the application in this process or to a server
+
+    Parameters
+    ----------
+    url : str (optional)
+        Server base URL. Default the Flask application in this process.
+    timeout : float (optional)
+        Request timeout in seconds, for servers
+
+    """
+
+    def __init__(self, url=None, timeout=60):
+        self.url = url.rstrip('/') if url else None
+        self.timeout = timeout
+        self._local = threading.local()
+
+        if self.url is None:
+            from app import app
+            self.app = app
+
+    def send(self, request):
+        """Send a request and return the HTTP status code"""
+
+        if self.url is None:
+            return self._send_local(request)
+
+        data = None
+        headers = {}
+        if 'json' in request:
+            data = json.dumps(request['json']).encode('utf8')
+            headers['Content-Type'] = 'application/json'
+        elif 'form' in request:
+            data = urlencode(request['form']).encode('utf8')
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        http_request = Request(self.url + request['path'], data=data, headers=headers,
+                               method=request.get('method', 'POST'))
+
+        try:
+            with urlopen(http_request, timeout=self.timeout) as response:
+                response.read()
+                return response.status
+        except HTTPError as error:
+            return error.code
+
+    def _send_local(self, request):
+        """Send a request to the application with a test client of this thread"""
+
+        if not hasattr(self._local, 'client'):
+            self._local.client = self.app.test_client()
+
+        kwargs = {}
+        if 'json' in request:
+            kwargs['json'] = request['json']
+        elif 'form' in request:
+            kwargs['data'] = request['form']
+
+        response = self._local.client.open(request['path'], method=request.get('method', 'POST'), **kwargs)
+
+        return response.status_code
+
+
+def current_rss(pid='self'):
+    """Resident set size of a process in MB, from /proc (Linux)"""
+
+    try:
+        with open('/proc/{}/statm'.format(pid)) as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        return float('nan')
+
+
+def process_cpu(pid):
+    """User and system CPU time of a process in seconds, from /proc (Linux)"""
+
+    try:
+        with open('/proc/{}/stat'.format(pid)) as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return float('nan')
+
+
+def run(requests, client, qps, duration, concurrency, pid=None):
+    """
+    Send the requests at a target rate and measure the responses
+
+    Parameters
+    ----------
+    requests : function
+        Function returning the next request
+    client : Client
+        Request sender
+    qps : float
+        Target requests per second
+    duration : float
+        Duration of the run in seconds
+    concurrency : int
+        Maximum number of requests in progress
+    pid : int (optional)
+        Server process id, to measure its CPU time and RSS
+
+    Returns
+    -------
+    samples : list
+        (endpoint, status, latency, service time, CPU time, RSS) of each request
+    server : dict
+        CPU time and peak RSS of the server process, if pid is given
+
+    """
+
+    samples = []
+    samples_lock = threading.Lock()
+    local = client.url is None
+
+    def send(request, scheduled):
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            status = client.send(request)
+        except Exception:
+            status = 0
+        end = time.perf_counter()
+
+        sample = (endpoint_name(request['path']), status, end - scheduled, end - start,
+                  time.thread_time() - cpu_start if local else float('nan'),
+                  current_rss() if local else float('nan'))
+
+        with samples_lock:
+            samples.append(sample)
+
+    # Server process usage, sampled while the run is in progress
+    server = {}
+    stop = threading.Event()
+
+    def monitor():
+        peak = 0
+        while not stop.wait(0.5):
+            peak = max(peak, current_rss(pid))
+        server['peak_rss_mb'] = max(peak, current_rss(pid))
+
+    if pid:
+        server_cpu = process_cpu(pid)
+        monitor_thread = threading.Thread(target=monitor, daemon=True)
+        monitor_thread.start()
+
+    n_requests = int(qps*duration)
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i in range(n_requests):
+            scheduled = start + i/qps
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, requests(), scheduled)
+
+    elapsed = time.perf_counter() - start
+
+    if pid:
+        stop.set()
+        monitor_thread.join()
+        server['cpu_seconds'] = process_cpu(pid) - server_cpu
+
+    server['elapsed'] = elapsed
+
+    return samples, server
+
+
+def summary(samples, elapsed, settings=None, server=None):
+    """
+    Per endpoint statistics of a run
+
+    Returns
+    -------
+    report : dict
+        Run settings, server usage and, for each endpoint: requests,
+        throughput, error rate, status codes, latency percentiles (ms),
+        mean service time, CPU time per request (ms) and peak RSS of the
+        whole process (MB)
+
+    """
+
+    endpoints = collections.defaultdict(list)
+    for sample in samples:
+        endpoints[sample[0]].append(sample)
+        endpoints['all'].append(sample)
+
+    report = {'settings': settings or {}, 'server': server or {}, 'endpoints': {}}
+
+    for endpoint, endpoint_samples in sorted(endpoints.items()):
+        status = np.array([sample[1] for sample in endpoint_samples])
+        latency = 1000*np.array([sample[2] for sample in endpoint_samples])
+        service = 1000*np.array([sample[3] for sample in endpoint_samples])
+        cpu = 1000*np.array([sample[4] for sample in endpoint_samples])
+        rss = np.array([sample[5] for sample in endpoint_samples])
+
+        errors = (status == 0) | (status >= 400)
+
+        stats = {
+            'requests': len(endpoint_samples),
+            'throughput': len(endpoint_samples)/elapsed,
+            'error_rate': float(errors.mean()),
+            'status': {str(code): int(count) for code, count in zip(*np.unique(status, return_counts=True))},
+            'service_ms': float(service.mean()),
+            'cpu_ms': float(np.nanmean(cpu)) if np.isfinite(cpu).any() else None,
+            'peak_rss_mb': float(np.nanmax(rss)) if np.isfinite(rss).any() else None,
+        }
+
+        for percentile in PERCENTILES:
+            stats['p{}_ms'.format(percentile)] = float(np.percentile(latency, percentile))
+        stats['max_ms'] = float(latency.max())
+
+        report['endpoints'][endpoint] = stats
+
+    return report
+
+
+# Column titles of the statistics, the RSS is the one of the whole process
+TITLES = {'peak_rss_mb': 'process_peak_rss_mb'}
+
+
+def print_table(columns, rows):
+    """
+    Print a table with the columns sized from their titles and values
+
+    Parameters
+    ----------
+    columns : list
+        Column titles, the first one is left aligned
+    rows : list
+        Rows of the table, lists of strings
+
+    """
+
+    widths = [max(len(cell) for cell in column) for column in zip(columns, *rows)]
+
+    for row in [columns] + rows:
+        cells = [row[0].ljust(widths[0])] + [cell.rjust(width) for cell, width in zip(row[1:], widths[1:])]
+        print(' | '.join(cells))
+
+
+def print_report(report):
+    """Print the per endpoint statistics of a run"""
+
+    columns = ['requests', 'throughput', 'error_rate'] + \
+        ['p{}_ms'.format(p) for p in PERCENTILES] + ['max_ms', 'cpu_ms', 'peak_rss_mb']
+
+    rows = []
+    for endpoint, stats in report['endpoints'].items():
+        rows.append([endpoint] + ['-' if stats[column] is None else '{:.2f}'.format(stats[column])
+                                  for column in columns])
+
+    print_table(['endpoint'] + [TITLES.get(column, column) for column in columns], rows)
+
+    if report['server']:
+        print("\nserver: " + ', '.join('{} {:.2f}'.format(key, value)
+                                       for key, value in report['server'].items()))
+
+
+def compare(before, after):
+    """Print the changes of the per endpoint statistics between two runs"""
+
+    columns = ['throughput', 'error_rate', 'p50_ms', 'p99_ms', 'cpu_ms', 'peak_rss_mb']
+
+    rows = []
+    for endpoint in sorted(set(before['endpoints']) | set(after['endpoints'])):
+        values = [endpoint]
+        for column in columns:
+            old = before['endpoints'].get(endpoint, {}).get(column)
+            new = after['endpoints'].get(endpoint, {}).get(column)
+
+            if old is None or new is None:
+                values.append('-')
+            elif old:
+                values.append('{:.2f} -> {:.2f} ({:+.0f}%)'.format(old, new, 100*(new - old)/old))
+            else:
+                values.append('{:.2f} -> {:.2f}'.format(old, new))
+
+        rows.append(values)
+
+    print_table(['endpoint'] + [TITLES.get(column, column) for column in columns], rows)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Send requests and report the statistics')
+    run_parser.add_argument('--url', help='Server base URL. Default the application in this process')
+    run_parser.add_argument('--requests', help='Recorded requests file, JSON lines')
+    run_parser.add_argument('--mix', default=DEFAULT_MIX,
+                            help='Synthetic mix, endpoint=weight pairs separated by commas')
+    run_parser.add_argument('--targets', type=int, default=10, help='Targets per synthetic request')
+    run_parser.add_argument('--date-spread', type=int, default=30,
+                            help='Days from today of the synthetic request dates')
+    run_parser.add_argument('--observatory', default='OT', help='Observatory of the synthetic requests')
+    run_parser.add_argument('--qps', type=float, default=2, help='Target requests per second')
+    run_parser.add_argument('--duration', type=float, default=30, help='Duration in seconds')
+    run_parser.add_argument('--concurrency', type=int, default=4, help='Maximum requests in progress')
+    run_parser.add_argument('--pid', type=int, help='Server process id, to measure its CPU and RSS')
+    run_parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    run_parser.add_argument('--output', help='Save the report to a JSON file')
+
+    compare_parser = commands.add_parser('compare', help='Compare the reports of two runs')
+    compare_parser.add_argument('before', help='Report of the first run')
+    compare_parser.add_argument('after', help='Report of the second run')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        with open(args.before) as before, open(args.after) as after:
+            compare(json.load(before), json.load(after))
+        return
+
+    rng = random.Random(args.seed)
+    lock = threading.Lock()
+
+    if args.requests:
+        recorded = read_requests(args.requests)
+        cycle = iter(range(sys.maxsize))
+
+        def requests():
+            with lock:
+                return recorded[next(cycle) % len(recorded)]
+    else:
+        mix = [item.split('=') for item in args.mix.split(',')]
+        endpoints = [endpoint.strip() for endpoint, _ in mix]
+        weights = [float(weight) for _, weight in mix]
+
+        def requests():
+            with lock:
+                endpoint = rng.choices(endpoints, weights)[0]
+                return synthetic_request(endpoint, rng, args.targets, args.date_spread, args.observatory)
+
+    client = Client(args.url)
+    samples, server = run(requests, client, args.qps, args.duration, args.concurrency, args.pid)
+
+    settings = {key: value for key, value in vars(args).items() if key not in ('command', 'output')}
+    report = summary(samples, server.pop('elapsed'), settings, server)
+
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
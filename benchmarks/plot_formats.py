@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the encode time and size of the altitude plots for each output format
+
+Usage:
+
+    python3 benchmarks/plot_formats.py [n_objects]
+
+"""
+
+import os
+import sys
+import time
+import datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app.staralt import staralt, render
+
+
+# (format, dpi, figsize) combinations to test
+CASES = [
+    ('png', 100, (11, 6)),
+    ('png', 50, (11, 6)),
+    ('png', 72, (5.5, 3)),
+    ('svg', 100, (11, 6)),
+    ('webp', 100, (11, 6)),
+    ('webp', 72, (5.5, 3)),
+    ('jpeg', 100, (11, 6)),
+    ('jpeg', 72, (5.5, 3)),
+]
+
+REPEAT = 5
+
+
+def main(n_objects=10):
+
+    rng = np.random.default_rng(0)
+    objects = [{'name': 'Target {}'.format(i),
+                'RA': rng.uniform(0, 360),
+                'Dec': rng.uniform(-20, 70)} for i in range(n_objects)]
+
+    date = datetime.date.today()
+
+    print("{:6s} {:>5s} {:>11s} {:>12s} {:>12s} {:>12s}".format(
+          'format', 'dpi', 'size (in)', 'encode (ms)', 'bytes', 'base64 bytes'))
+
+    for plot_format, dpi, figsize in CASES:
+        fig = staralt('OT', date, objects, figsize=figsize)
+
+        times = []
+        for _ in range(REPEAT):
+            start = time.perf_counter()
+            image = render(fig, plot_format, dpi)
+            times.append(time.perf_counter() - start)
+
+        print("{:6s} {:5d} {:>11s} {:12.1f} {:12d} {:12d}".format(
+              plot_format, dpi, '{}x{}'.format(*figsize), 1000*np.median(times),
+              len(image), 4*((len(image) + 2)//3)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
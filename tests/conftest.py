@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures of the test suite
+
+The pure Python modules of the application (cache, admission control,
+name resolver) are loaded from their files, so they can be tested without
+Flask and the astronomy dependencies of the app package.
+
+"""
+
+import importlib.util
+import os
+
+import pytest
+
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app')
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def load_module(name):
+    """
+    Load app/<name>.py as a standalone module
+    """
+
+    spec = importlib.util.spec_from_file_location('staralt_' + name,
+                                                  os.path.join(APP_PATH, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+@pytest.fixture(scope='session', autouse=True)
+def cache_home(tmp_path_factory):
+    """Private cache directory of the application in a temporary directory"""
+
+    path = str(tmp_path_factory.mktemp('cache'))
+    os.environ['XDG_CACHE_HOME'] = path
+
+    return path
+
+
+@pytest.fixture(scope='session')
+def client():
+    """Test client of the Flask application"""
+
+    pytest.importorskip('flask')
+    pytest.importorskip('astroplan')
+    pytest.importorskip('matplotlib')
+
+    from app import app
+
+    return app.test_client()
+
+
+@pytest.fixture(scope='session')
+def data_path():
+    return DATA_PATH
+
+
+@pytest.fixture(scope='session')
+def cache_module():
+    return load_module('cache')
+
+
+@pytest.fixture(scope='session')
+def admission_module():
+    return load_module('admission')
+
+
+@pytest.fixture(scope='session')
+def resolver_module():
+    return load_module('resolver')
+
+
+@pytest.fixture(scope='session')
+def constraints_module():
+    pytest.importorskip('numpy')
+    pytest.importorskip('astropy')
+    return load_module('constraints')
+
+
+@pytest.fixture(scope='session')
+def locations_module():
+    pytest.importorskip('numpy')
+    pytest.importorskip('astroplan')
+    pytest.importorskip('pytz')
+    return load_module('locations')
+
+
+@pytest.fixture(scope='session')
+def staralt_module():
+    """Services of the application, imported with the app package"""
+
+    pytest.importorskip('flask')
+    pytest.importorskip('astroplan')
+    pytest.importorskip('matplotlib')
+
+    from app import staralt
+
+    return staralt
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Admission control of the expensive endpoints
+"""
+
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def admission(admission_module):
+    return admission_module
+
+
+def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_requests_within_capacity_are_admitted(admission):
+    controller = admission.AdmissionController('test', capacity=2, max_queued=1, queue_time=1)
+
+    assert controller.acquire(1) is None
+    assert controller.acquire(1) is None
+    assert controller.stats()['in_progress_cost'] == 2
+
+
+def test_full_queue_is_rejected_with_429(admission):
+    controller = admission.AdmissionController('test', capacity=1, max_queued=1, queue_time=5,
+                                               seconds_per_cost=0.001)
+    controller.acquire(1)
+
+    # A second request waits for the capacity
+    results = []
+    waiting = threading.Thread(target=lambda: results.append(controller.acquire(1)))
+    waiting.start()
+    wait_until(lambda: controller.stats()['queued'] == 1)
+
+    status, retry_after = controller.acquire(1)
+    assert status == 429 and retry_after >= 1
+
+    # The waiting request runs when the capacity is released
+    controller.release(1, 0.001)
+    waiting.join()
+    assert results == [None]
+    assert controller.stats()['rejected_429'] == 1
+
+
+def test_expected_wait_over_budget_is_rejected_with_503(admission):
+    controller = admission.AdmissionController('test', capacity=1, max_queued=10, queue_time=1,
+                                               seconds_per_cost=10)
+    controller.acquire(1)
+
+    assert controller.acquire(1) == (503, 10)
+    assert controller.stats()['rejected_503'] == 1
+
+
+def test_queue_time_budget(admission):
+    controller = admission.AdmissionController('test', capacity=1, max_queued=10, queue_time=0.2,
+                                               seconds_per_cost=0.001)
+    controller.acquire(1)
+
+    start = time.monotonic()
+    status, retry_after = controller.acquire(1)
+
+    assert status == 503
+    assert time.monotonic() - start >= 0.2
+
+
+def test_costly_requests_run_alone(admission):
+    controller = admission.AdmissionController('test', capacity=10, max_queued=1, queue_time=1)
+
+    assert controller.acquire(100) is None
+    controller.release(100, 1)
+    assert controller.stats()['in_progress'] == 0
+
+
+def test_release_without_duration_keeps_the_estimate(admission):
+    controller = admission.AdmissionController('test', capacity=10, max_queued=1, queue_time=1,
+                                               seconds_per_cost=0.5)
+    controller.acquire(2)
+    controller.release(2)
+
+    assert controller.seconds_per_cost == 0.5
+
+
+def test_endpoint_names(admission):
+    assert admission.endpoint_name('/observability') == 'observability'
+    assert admission.endpoint_name('/observability_sites') == 'observability_sites'
+    assert admission.endpoint_name('/staralt/2021-10-08/OT') == 'staralt'
+    assert admission.endpoint_name('/subscription/abc') == 'subscription'
+    assert admission.endpoint_name('/plot/abc') is None
+    assert admission.endpoint_name('/') is None
+
+
+def test_every_controller_has_a_cost(admission):
+    assert set(admission.costs) == set(admission.controllers)
+    assert admission.costs['observability']({'objects': [{}, {}]}) == 2*admission.NIGHT_SAMPLES
+
+
+def test_costs_follow_the_requested_time_span(admission):
+    night = {'objects': [{}], 'date': '2020-06-11 20:00:00', 'date_end': '2020-06-12 08:00:00'}
+    week = dict(night, date_end='2020-06-18 20:00:00')
+
+    assert admission.costs['observability'](night) == 24
+    assert admission.costs['observability'](week) == 7*48
+    assert admission.costs['observability_dates']({'dates': [
+        ['2020-06-11 00:16:30', '2020-06-11 03:44:26'],
+        ['2020-06-14T06:07', '2020-06-14T09:35'],
+        ['2020-06-15 23:00:00']]}) == 7 + 7 + admission.NIGHT_SAMPLES
+    assert admission.costs['observability_objects']({'objects': [
+        {'dates': [['2020-06-11 00:00:00', '2020-06-11 00:10:00']]},
+        {'dates': [['2020-06-11 23:59:59']]}]}) == 1 + admission.NIGHT_SAMPLES
+
+
+def test_malformed_dates_raise_value_error(admission):
+    with pytest.raises(ValueError):
+        admission.costs['observability']({'date': 'tonight', 'date_end': '2020-06-12'})
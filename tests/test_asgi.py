@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+ASGI adapter
+"""
+
+import asyncio
+import threading
+from urllib.parse import urlencode
+
+import pytest
+
+
+def call(application, method, path, body=b'', content_type='application/x-www-form-urlencoded'):
+    """Send a request to an ASGI application, return the status and the body"""
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'',
+             'headers': [(b'content-type', content_type.encode('latin1'))]}
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(application(scope, receive, send))
+
+    return sent[0]['status'], b''.join(message.get('body', b'') for message in sent[1:])
+
+
+@pytest.fixture
+def application(client):
+    from app.asgi import create_app
+
+    application = create_app(plot_workers=1, json_workers=1, light_workers=1, io_workers=1,
+                             plot_processes=False)
+    yield application
+
+    for executor in application.executors.values():
+        executor.shutdown()
+
+
+def test_names_are_resolved_in_the_io_pool(monkeypatch, application):
+    import app
+
+    class StubResolver(object):
+        """Resolver recording the threads of the lookups"""
+
+        def __init__(self):
+            self.threads = []
+
+        def resolve(self, names):
+            self.threads.append(threading.current_thread().name)
+            return {name: (10.68471, 41.26875) for name in names}
+
+    resolver = StubResolver()
+    monkeypatch.setattr(app, 'get_name_resolver', lambda: resolver)
+
+    body = urlencode({'objects': 'M31\r\nVega, 18:36:56.3, +38:47:01', 'observatory': 'OT',
+                      'date': '2020-06-11'}).encode('utf8')
+    status, content = call(application, 'POST', '/submit', body)
+
+    # A single lookup, in the I/O pool, and none in the plot pool
+    assert status == 200
+    assert len(resolver.threads) == 1
+    assert resolver.threads[0].startswith('io')
+
+
+def test_overloaded_endpoints_are_rejected_before_the_views(monkeypatch, application):
+    from app.admission import controllers
+
+    monkeypatch.setattr(controllers['observability'], 'acquire', lambda cost: (503, 7))
+
+    status, content = call(application, 'POST', '/observability', b'{"objects": []}',
+                           content_type='application/json')
+
+    assert status == 503
+    assert b'retry_after' in content
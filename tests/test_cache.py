@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+In-process and shared caches, state store and memoized results
+"""
+
+import os
+import stat
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def cache(cache_module):
+    return cache_module
+
+
+@pytest.fixture
+def sqlite_cache(cache, tmp_path):
+    return cache.SQLiteCache(str(tmp_path / 'cache.sqlite'), max_bytes=250, fill_timeout=5)
+
+
+def test_lru_eviction(cache):
+    lru = cache.LRUCache(maxsize=2)
+    lru.set('a', 1)
+    lru.set('b', 2)
+    lru.get('a')
+    lru.set('c', 3)
+
+    assert 'a' in lru and 'c' in lru
+    assert 'b' not in lru
+
+
+def test_lru_expiration(cache):
+    lru = cache.LRUCache()
+    lru.set('a', 1, ttl=-1)
+
+    assert lru.get('a', 'expired') == 'expired'
+
+
+def test_values_round_trip(sqlite_cache):
+    sqlite_cache.set('plot', (b'\x89PNG\r\n', {'format': 'png'}))
+    sqlite_cache.set('night', {'sunset': 2459012.3, 'sunrise': float('nan')})
+
+    image, options = sqlite_cache.get('plot')
+    assert image == b'\x89PNG\r\n' and options == {'format': 'png'}
+    assert sqlite_cache.get_many(['night', 'missing']).keys() == {'night'}
+
+
+def test_numpy_round_trip(cache):
+    np = pytest.importorskip('numpy')
+
+    value = {'mask': np.array([[True, False]]), 'jd': np.array([2459012.5, np.nan]),
+             'count': np.int64(3)}
+    restored = cache.loads(cache.dumps(value))
+
+    assert restored['mask'].dtype == bool and restored['mask'].tolist() == [[True, False]]
+    assert restored['jd'][0] == 2459012.5 and np.isnan(restored['jd'][1])
+    assert restored['count'] == 3
+
+
+def test_only_data_is_cached(cache):
+    with pytest.raises(TypeError):
+        cache.dumps({'value': object()})
+
+
+def test_expiration(sqlite_cache):
+    sqlite_cache.set('a', 'value', ttl=-1)
+
+    assert sqlite_cache.get('a') is None
+
+
+def test_least_recently_used_eviction(monkeypatch, cache, sqlite_cache):
+    # Access times updated on every read
+    monkeypatch.setattr(cache, 'ACCESS_RESOLUTION', 0)
+
+    # Values of about 100 bytes, only two fit
+    sqlite_cache.set('a', 'x'*100)
+    time.sleep(0.01)
+    sqlite_cache.set('b', 'x'*100)
+    time.sleep(0.01)
+    sqlite_cache.get('a')
+    time.sleep(0.01)
+    sqlite_cache.set('c', 'x'*100)
+
+    assert 'a' in sqlite_cache and 'c' in sqlite_cache
+    assert 'b' not in sqlite_cache
+
+
+def test_too_large_values_are_not_stored(sqlite_cache):
+    sqlite_cache.set('large', 'x'*1000)
+
+    assert 'large' not in sqlite_cache
+
+
+def test_single_fill(sqlite_cache):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'value'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(sqlite_cache.get_or_set('key', compute)))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ['value']*4
+    assert len(calls) == 1
+
+
+def test_fill_timeout(cache, tmp_path):
+    sqlite_cache = cache.SQLiteCache(str(tmp_path / 'cache.sqlite'), fill_timeout=0.2)
+
+    # Fill lock taken by a process that never stores the value
+    assert sqlite_cache._start_fill('key')
+
+    assert sqlite_cache.get_or_set('key', lambda: 'value') == 'value'
+    assert sqlite_cache.get('key') == 'value'
+
+
+def test_private_cache_directory(monkeypatch, cache, tmp_path):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    os.makedirs(str(tmp_path / 'staralt'), mode=0o755)
+
+    path = cache.cache_directory()
+
+    assert path == str(tmp_path / 'staralt')
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o700
+
+    sqlite_cache = cache.SQLiteCache(max_bytes=1000)
+    assert os.path.dirname(sqlite_cache.path) == path
+    assert stat.S_IMODE(os.stat(sqlite_cache.path).st_mode) == 0o600
+
+
+def test_symbolic_links_are_refused(cache, tmp_path):
+    os.symlink(str(tmp_path / 'elsewhere.sqlite'), str(tmp_path / 'cache.sqlite'))
+
+    with pytest.raises(OSError):
+        cache.SQLiteCache(str(tmp_path / 'cache.sqlite'))
+
+
+@pytest.mark.skipif(not hasattr(os, 'getuid') or os.getuid() != 0,
+                    reason="changing the owner of a file requires root")
+def test_files_of_other_users_are_refused(cache, tmp_path):
+    path = tmp_path / 'cache.sqlite'
+    path.touch()
+    os.chown(str(path), 12345, -1)
+
+    with pytest.raises(PermissionError):
+        cache.SQLiteCache(str(path))
+
+
+def test_memoize_entries(monkeypatch, cache):
+    monkeypatch.setattr(cache, 'get_cache', lambda lru=cache.LRUCache(): lru)
+
+    computed = []
+
+    def compute(keys):
+        def compute_entries(indices):
+            computed.extend(keys[i] for i in indices)
+            return [keys[i].upper() for i in indices]
+        return compute_entries
+
+    keys = ['a', 'b']
+    assert cache.memoize_entries('test', keys, compute(keys)) == ['A', 'B']
+    keys = ['b', 'c', 'a']
+    assert cache.memoize_entries('test', keys, compute(keys)) == ['B', 'C', 'A']
+
+    # Only the entries not cached are computed
+    assert computed == ['a', 'b', 'c']
+
+    stats = cache.memoize_stats()['test']
+    assert stats['hits'] == 2 and stats['misses'] == 3
+@pytest.mark.parametrize('store', ['sqlite', 'memory'])
+def test_state_store_compare_and_set(cache, tmp_path, store):
+    if store == 'sqlite':
+        states = cache.StateStore(str(tmp_path / 'cache.sqlite'))
+    else:
+        states = cache.MemoryStateStore()
+
+    states.add('token', {'polls': 0}, ttl=60)
+
+    # Two concurrent updates from the same version, only the first one is stored
+    first, version = states.get('token')
+    second, _ = states.get('token')
+    first['polls'] += 1
+    second['polls'] += 1
+
+    assert states.replace('token', first, version, ttl=60)
+    assert not states.replace('token', second, version, ttl=60)
+    assert states.get('token') == ({'polls': 1}, version + 1)
+
+    states.add('expired', {}, ttl=-1)
+    assert states.get('expired') is None
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Constraints evaluated by the application, compared with astroplan
+
+The observability services evaluate the constraints on their own
+vectorized grids (Constraints.evaluate and evaluate_windows); the results
+must be the ones of astroplan is_observable (*ever*) and
+is_always_observable (*always*) on the same time grid.
+
+"""
+
+import pytest
+
+
+np = pytest.importorskip('numpy')
+astroplan = pytest.importorskip('astroplan')
+
+from astropy import units as u
+from astropy.coordinates import EarthLocation, SkyCoord
+from astropy.time import Time
+from astroplan import (Observer, FixedTarget, is_observable, is_always_observable,
+                       AltitudeConstraint, AirmassConstraint, AtNightConstraint,
+                       MoonSeparationConstraint)
+
+
+# Bright stars all over the sky, RA and Dec in degrees
+TARGETS = [
+    ('Vega', 279.23473, 38.78369),
+    ('Deneb', 310.35798, 45.28034),
+    ('Altair', 297.69583, 8.86832),
+    ('Antares', 247.35192, -26.43200),
+    ('Arcturus', 213.91530, 19.18241),
+    ('Spica', 201.29825, -11.16132),
+    ('Sirius', 101.28716, -16.71612),
+    ('Betelgeuse', 88.79294, 7.40706),
+    ('Polaris', 37.95456, 89.26411),
+    ('Fomalhaut', 344.41269, -29.62224),
+    ('M31', 10.68471, 41.26875),
+    ('Kelt 8b', 283.30552, 24.12738),
+]
+
+# Request constraints and their astroplan equivalent
+CONSTRAINTS = [
+    ({'altitude_lower_limit': 30},
+     [AltitudeConstraint(30*u.deg, 90*u.deg), AtNightConstraint.twilight_astronomical()]),
+    ({'altitude_lower_limit': 20, 'airmass_higher_limit': 2.0, 'twilight_type': 'nautical'},
+     [AltitudeConstraint(20*u.deg, 90*u.deg), AirmassConstraint(2.0),
+      AtNightConstraint.twilight_nautical()]),
+    ({'moon_separation_lower_limit': 40},
+     [AltitudeConstraint(0*u.deg, 90*u.deg), MoonSeparationConstraint(40*u.deg),
+      AtNightConstraint.twilight_astronomical()]),
+]
+
+# Night at Teide Observatory, and a transit window inside it
+NIGHT = ('2020-06-11 20:00', '2020-06-12 07:00')
+TRANSIT = ('2020-06-12 00:10', '2020-06-12 03:20')
+
+
+@pytest.fixture(scope='module')
+def observer():
+    location = EarthLocation(lon=-16.50972*u.deg, lat=28.3*u.deg, height=2390*u.m)
+    return Observer(location=location, name='OT')
+
+
+@pytest.fixture(scope='module')
+def objects():
+    return [{'name': name, 'RA': ra, 'Dec': dec} for name, ra, dec in TARGETS]
+
+
+@pytest.fixture(scope='module')
+def targets():
+    return [FixedTarget(SkyCoord(ra*u.deg, dec*u.deg), name=name) for name, ra, dec in TARGETS]
+
+
+def evaluate(constraints_module, data, observer, objects, window):
+    """ever and always of all the objects in a window, with evaluate_windows"""
+
+    start, end = Time(list(window)).jd
+    constraints = constraints_module.Constraints(data)
+
+    return constraints_module.evaluate_windows(constraints, observer, objects,
+                                               np.full(len(objects), start), np.full(len(objects), end))
+
+
+@pytest.mark.parametrize('data, constraints', CONSTRAINTS)
+@pytest.mark.parametrize('window', [NIGHT, TRANSIT])
+def test_windows(constraints_module, observer, objects, targets, data, constraints, window):
+    ever, always = evaluate(constraints_module, data, observer, objects, window)
+
+    time_range = Time(list(window))
+    expected_ever = is_observable(constraints, observer, targets, time_range=time_range,
+                                  time_grid_resolution=0.5*u.hour)
+    expected_always = is_always_observable(constraints, observer, targets, time_range=time_range,
+                                           time_grid_resolution=0.5*u.hour)
+
+    assert ever.tolist() == np.asarray(expected_ever).tolist()
+    assert always.tolist() == np.asarray(expected_always).tolist()
+
+    # Both answers occur, so the comparison is meaningful
+    assert ever.any() and not always.all()
+
+
+@pytest.mark.parametrize('data, constraints', CONSTRAINTS)
+def test_single_dates(constraints_module, observer, objects, targets, data, constraints):
+    date = '2020-06-12 01:30'
+    ever, always = evaluate(constraints_module, data, observer, objects, (date, date))
+
+    expected = is_observable(constraints, observer, targets, times=Time([date]))
+
+    assert ever.tolist() == always.tolist() == np.asarray(expected).tolist()
+
+
+@pytest.mark.parametrize('data, constraints', CONSTRAINTS)
+def test_grid(constraints_module, observer, objects, targets, data, constraints):
+    # Constraints.evaluate over the targets x times grid, sample by sample
+    times = Time(NIGHT[0]) + np.arange(22)*0.5*u.hour
+    alt, az = constraints_module.target_altaz(observer, constraints_module.target_coords(objects), times)
+
+    mask = constraints_module.Constraints(data).evaluate(observer, times, alt, az)
+
+    expected = np.logical_and.reduce([
+        np.broadcast_to(constraint(observer, targets, times=times, grid_times_targets=True), mask.shape)
+        for constraint in constraints])
+
+    assert mask.tolist() == expected.tolist()
+
+
+def test_entries_with_own_windows(constraints_module, observer, objects, targets):
+    # Night (*ever*) and transit (*always*) entries evaluated together
+    data, constraints = CONSTRAINTS[0]
+    night = Time(list(NIGHT)).jd
+    transit = Time(list(TRANSIT)).jd
+
+    starts = np.array([night[0], transit[0]]*len(objects))
+    ends = np.array([night[1], transit[1]]*len(objects))
+    entries = [obj for obj in objects for _ in range(2)]
+
+    ever, always = constraints_module.evaluate_windows(constraints_module.Constraints(data), observer,
+                                                       entries, starts, ends)
+
+    assert ever[0::2].tolist() == np.asarray(
+        is_observable(constraints, observer, targets, time_range=Time(list(NIGHT)))).tolist()
+    assert always[1::2].tolist() == np.asarray(
+        is_always_observable(constraints, observer, targets, time_range=Time(list(TRANSIT)))).tolist()
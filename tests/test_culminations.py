@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Culminations computed analytically, compared with astroplan
+
+The transit, maximum altitude and rising and setting times above the
+altitude limit must be the ones of astroplan Observer.target_meridian_transit_time,
+altaz, target_rise_time and target_set_time.
+
+"""
+
+import pytest
+
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('astroplan')
+
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.time import Time
+from astroplan import FixedTarget
+
+
+# RA and Dec in degrees, with transits in the night and in the day
+TARGETS = [
+    ('Vega', 279.23473, 38.78369),
+    ('Deneb', 310.35798, 45.28034),
+    ('Altair', 297.69583, 8.86832),
+    ('Antares', 247.35192, -26.43200),
+    ('Arcturus', 213.91530, 19.18241),
+    ('Sirius', 101.28716, -16.71612),
+    ('Kelt 8b', 283.30552, 24.12738),
+]
+
+DATE = '2020-06-11'
+ALTITUDE_LIMIT = 30
+
+
+@pytest.fixture(scope='module')
+def result(staralt_module):
+    data = {'observatory': 'OT', 'date': DATE, 'altitude_lower_limit': str(ALTITUDE_LIMIT),
+            'objects': [{'name': name, 'RA': ra, 'Dec': dec} for name, ra, dec in TARGETS]}
+
+    return staralt_module.culminations(data)
+
+
+@pytest.fixture(scope='module')
+def observer(staralt_module):
+    return staralt_module.get_location('OT')
+
+
+@pytest.mark.parametrize('name, ra, dec', TARGETS)
+def test_transit(staralt_module, result, observer, name, ra, dec):
+    target = FixedTarget(SkyCoord(ra*u.deg, dec*u.deg), name=name)
+    sunset = staralt_module.night_time_range('OT', DATE)[0]
+
+    expected = observer.target_meridian_transit_time(sunset, target, which='next')
+    transit = Time(result[name]['transit'])
+
+    assert abs((transit - expected).to_value(u.min)) < 1
+
+    # Geometric altitude at the transit
+    altitude = observer.altaz(expected, target).alt.deg
+    assert result[name]['max_altitude'] == pytest.approx(altitude, abs=0.05)
+
+
+@pytest.mark.parametrize('name, ra, dec', TARGETS)
+def test_rise_and_set(result, observer, name, ra, dec):
+    target = FixedTarget(SkyCoord(ra*u.deg, dec*u.deg), name=name)
+
+    # All the targets culminate above the limit
+    assert result[name]['rise'] is not None
+
+    # Rising and setting around the transit of the window
+    rise, set_ = Time(result[name]['rise']), Time(result[name]['set'])
+    culmination = rise + (set_ - rise)/2
+
+    expected_rise = observer.target_rise_time(culmination, target, which='previous',
+                                              horizon=ALTITUDE_LIMIT*u.deg)
+    expected_set = observer.target_set_time(culmination, target, which='next',
+                                            horizon=ALTITUDE_LIMIT*u.deg)
+
+    assert abs((rise - expected_rise).to_value(u.min)) < 2
+    assert abs((set_ - expected_set).to_value(u.min)) < 2
+
+
+def test_windows_are_in_the_night(staralt_module, result):
+    sunset, sunrise = staralt_module.night_time_range('OT', DATE).jd
+
+    for name, _, _ in TARGETS:
+        window = result[name]['window']
+        if window:
+            start, end = Time(window).jd
+            assert sunset - 1e-6 <= start < end <= sunrise + 1e-6
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Site horizon profiles and request horizons
+"""
+
+import os
+import types
+
+import pytest
+
+
+np = pytest.importorskip('numpy')
+
+
+class NightObserver(object):
+    """
+    Observer stub with the Sun always below the horizon
+    """
+
+    location = types.SimpleNamespace(lat=types.SimpleNamespace(deg=28.3))
+
+    def sun_altaz(self, times):
+        return types.SimpleNamespace(alt=types.SimpleNamespace(deg=np.full(len(times), -30.0)))
+
+
+@pytest.fixture
+def site_horizon(monkeypatch, data_path, locations_module, constraints_module):
+    monkeypatch.setattr(locations_module, 'HORIZONS_PATH', os.path.join(data_path, 'horizons'))
+    return constraints_module.horizon_lookup(locations_module.horizon_profile('TEST'))
+
+
+def test_missing_profile_is_flat(monkeypatch, data_path, locations_module):
+    monkeypatch.setattr(locations_module, 'HORIZONS_PATH', os.path.join(data_path, 'horizons'))
+    assert locations_module.horizon_profile('NOWHERE') is None
+
+
+def test_site_profile_masks_targets(constraints_module, site_horizon):
+    # Targets at 30 degrees of altitude, behind the 60 degrees obstruction
+    # at azimuth 90 and in the clear at azimuth 270
+    times = np.zeros(2)
+    alt = np.array([[30.0, 30.0], [30.0, 30.0]])
+    az = np.array([[90.0, 90.0], [270.0, 270.0]])
+
+    constraints = constraints_module.Constraints({})
+    mask = constraints.evaluate(NightObserver(), times, alt, az, site_horizon)
+
+    assert not mask[0].any()
+    assert mask[1].all()
+
+
+def test_request_horizon_combined_with_site_profile(constraints_module, site_horizon):
+    times = np.zeros(1)
+    alt = np.array([[30.0], [30.0]])
+    az = np.array([[90.0], [270.0]])
+
+    # The request horizon only blocks the west, the site profile still blocks the east
+    constraints = constraints_module.Constraints({'horizon' : [[0, 0], [180, 0], [270, 45]]})
+    mask = constraints.evaluate(NightObserver(), times, alt, az, site_horizon)
+
+    assert not mask[0].any()
+    assert not mask[1].any()
+
+
+def test_site_registry_loads_profiles(monkeypatch, tmp_path):
+    pytest.importorskip('flask')
+    pytest.importorskip('matplotlib')
+
+    import shutil
+    import app.locations
+    from app import staralt
+    from app.constraints import Constraints
+
+    # The example profile installed as the OT profile
+    shutil.copy(os.path.join(os.path.dirname(app.locations.__file__), 'horizons', 'example.dat'),
+                str(tmp_path / 'OT.dat'))
+    monkeypatch.setattr(app.locations, 'HORIZONS_PATH', str(tmp_path))
+    staralt._locations.cache_clear()
+    staralt.get_horizon.cache_clear()
+
+    try:
+        horizon = staralt.get_horizon('OT')
+        assert staralt.get_horizon('ORM') is None
+
+        # 12 degrees of altitude: behind the 15 degrees obstruction at azimuth 90,
+        # above the 5 degrees one at azimuth 180
+        alt = np.array([[12.0], [12.0]])
+        az = np.array([[90.0], [180.0]])
+        mask = Constraints({}).evaluate(NightObserver(), np.zeros(1), alt, az, horizon)
+
+        assert mask[:, 0].tolist() == [False, True]
+    finally:
+        staralt._locations.cache_clear()
+        staralt.get_horizon.cache_clear()
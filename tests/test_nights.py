@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Nights of the services, anchored at the local noon of the dates
+
+A date is the local date of the beginning of the night at every site, also
+far from UTC (Keck, UTC-10) and across daylight saving time transitions
+(the Canary Islands change to summer time on 2020-03-29).
+
+"""
+
+import datetime
+
+import pytest
+
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('astropy')
+
+from astropy.time import Time
+
+
+def local_jd(location, date, hour):
+    """JD of a local time of the site, hours after the midnight beginning date"""
+
+    midnight = datetime.datetime.strptime(date, "%Y-%m-%d")
+
+    return Time(location.timezone.localize(midnight + datetime.timedelta(hours=hour))).jd
+
+
+def dates(start, days):
+    first = datetime.datetime.strptime(start, "%Y-%m-%d")
+
+    return [(first + datetime.timedelta(days=day)).strftime("%Y-%m-%d") for day in range(days)]
+
+
+@pytest.mark.parametrize('observatory, start', [('Keck', '2020-12-30'), ('Keck', '2020-06-10'),
+                                                ('OT', '2020-03-27'), ('OT', '2020-10-23')])
+def test_night_table_starts_at_the_local_date(staralt_module, observatory, start):
+    location = staralt_module.get_location(observatory)
+    night = staralt_module.night_table(observatory, start, 4)
+
+    for i, date in enumerate(dates(start, 4)):
+        # After the local noon of the date, around the next local midnight
+        assert local_jd(location, date, 12) < night['twilight_evening'][i] < local_jd(location, date, 24)
+        assert local_jd(location, date, 24) < night['twilight_morning'][i] < local_jd(location, date, 36)
+
+    # Consecutive nights, without the one hour jump of the local time
+    assert np.allclose(np.diff(night['twilight_evening']), 1, atol=5/1440)
+    assert np.allclose(np.diff(night['twilight_morning']), 1, atol=5/1440)
+
+
+@pytest.mark.parametrize('observatory, date', [('Keck', '2020-12-31'), ('Keck', '2020-06-10'),
+                                               ('OT', '2020-03-28'), ('OT', '2020-03-29')])
+def test_night_boundaries_start_at_the_local_date(staralt_module, observatory, date):
+    location = staralt_module.get_location(observatory)
+    night = staralt_module.night_boundaries(observatory, date)
+
+    assert local_jd(location, date, 12) < night['sunset'] < night['twilight_evening'] \
+        < local_jd(location, date, 24) < night['twilight_morning'] < night['sunrise'] \
+        < local_jd(location, date, 36)
+
+    # The same night of the other services
+    table = staralt_module.night_table(observatory, date, 1)
+    assert night['twilight_evening'] == pytest.approx(table['twilight_evening'][0], abs=1e-5)
+    assert night['twilight_morning'] == pytest.approx(table['twilight_morning'][0], abs=1e-5)
+
+    sunset, sunrise = staralt_module.night_time_range(observatory, date).jd
+    assert night['sunset'] == pytest.approx(sunset, abs=1e-5)
+    assert night['sunrise'] == pytest.approx(sunrise, abs=1e-5)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Name resolver and its persistent cache, with a stub backend
+"""
+
+import pytest
+
+
+class StubBackend(object):
+    """
+    Backend answering from a dictionary, with lowercase names,
+    and recording the requests
+    """
+
+    def __init__(self, catalogue, failing=()):
+        self.catalogue = catalogue
+        self.failing = set(failing)
+        self.calls = []
+
+    def __call__(self, name):
+        self.calls.append(name)
+        if name in self.failing:
+            raise IOError('service unavailable')
+        return self.catalogue.get(name.lower())
+
+
+@pytest.fixture
+def resolver(resolver_module):
+    return resolver_module
+
+
+@pytest.fixture
+def cache(resolver, tmp_path):
+    return resolver.NameCache(str(tmp_path / 'names.sqlite'))
+
+
+def test_spellings_share_a_single_lookup(resolver, cache):
+    backend = StubBackend({'m31' : (10.68, 41.27)})
+    names = resolver.Resolver(cache, backend)
+
+    for _ in range(3):
+        result = names.resolve(['M31', 'm31', ' m31 '])
+        assert result['M31'] == result['m31'] == result[' m31 '] == (10.68, 41.27)
+
+    assert backend.calls == ['M31']
+
+
+def test_cached_spellings(cache):
+    cache.set_many({'M31' : (10.68, 41.27)})
+
+    assert cache.get_many(['m31', 'M31', ' m31 ']) == {
+        'm31' : (10.68, 41.27),
+        'M31' : (10.68, 41.27),
+        ' m31 ' : (10.68, 41.27),
+    }
+
+
+def test_unknown_names_are_cached(resolver, cache):
+    backend = StubBackend({})
+    names = resolver.Resolver(cache, backend)
+
+    assert names.resolve(['nothing']) == {'nothing' : None}
+    assert names.resolve(['Nothing']) == {'Nothing' : None}
+    assert backend.calls == ['nothing']
+
+
+def test_failures_are_not_cached(resolver, cache):
+    backend = StubBackend({'m42' : (83.82, -5.39)}, failing=['M42'])
+    names = resolver.Resolver(cache, backend)
+
+    assert names.resolve(['M42']) == {'M42' : None}
+    assert cache.get_many(['M42']) == {}
+
+    backend.failing.clear()
+    assert names.resolve(['M42']) == {'M42' : (83.82, -5.39)}
+    assert backend.calls == ['M42', 'M42']
+
+
+def test_seeded_names_never_expire(resolver, cache, tmp_path):
+    catalogue = tmp_path / 'catalogue.csv'
+    catalogue.write_text('# name, ra, dec\nVega, 279.23, 38.78\n')
+    cache.seed(str(catalogue))
+
+    backend = StubBackend({})
+    names = resolver.Resolver(cache, backend)
+
+    assert names.resolve(['vega']) == {'vega' : (279.23, 38.78)}
+    assert backend.calls == []
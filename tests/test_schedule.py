@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Schedules of a night: observations without overlaps, in the night and
+satisfying the constraints, checked with astroplan
+"""
+
+import pytest
+
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('astroplan')
+
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.time import Time
+from astroplan import (FixedTarget, is_always_observable, AltitudeConstraint, AirmassConstraint,
+                       AtNightConstraint)
+
+
+TARGETS = [
+    ('Vega', 279.23473, 38.78369, 2, 60),
+    ('Deneb', 310.35798, 45.28034, 1, 90),
+    ('Altair', 297.69583, 8.86832, 3, 45),
+    ('Antares', 247.35192, -26.43200, 1, 30),
+    ('Arcturus', 213.91530, 19.18241, 2, 120),
+    ('Sirius', 101.28716, -16.71612, 5, 30),
+    ('M31', 10.68471, 41.26875, 1, 60),
+]
+
+SLOT = 5
+
+
+@pytest.fixture(scope='module')
+def data():
+    objects = [{'name': name, 'RA': ra, 'Dec': dec, 'priority': priority, 'exposure': exposure}
+               for name, ra, dec, priority, exposure in TARGETS]
+    objects.append({'name': 'Kelt 8b', 'RA': 283.30551667, 'Dec': 24.12738139, 'priority': 3,
+                    'planet': {'period': 3.24406, 't0': 2456883.4803, 'duration': 0.1431}})
+
+    return {'observatory': 'OT', 'date': '2020-06-11', 'twilight_type': 'astronomical',
+            'altitude_lower_limit': '30', 'airmass_higher_limit': '1.8', 'slot': SLOT,
+            'objects': objects}
+
+
+@pytest.fixture(scope='module')
+def result(staralt_module, data):
+    return staralt_module.schedule(data)
+
+
+def test_every_target_is_answered(result, data):
+    names = [obs['name'] for obs in result['schedule']] + [obs['name'] for obs in result['unscheduled']]
+
+    assert sorted(names) == sorted(obj['name'] for obj in data['objects'])
+    assert result['schedule']
+
+
+def test_observations_do_not_overlap(result):
+    night_start, night_end = Time(result['night']).jd
+    windows = [Time([obs['start'], obs['end']]).jd for obs in result['schedule']]
+
+    for start, end in windows:
+        assert night_start - 1e-6 <= start < end <= night_end + 1e-6
+
+    for (_, end), (start, _) in zip(windows[:-1], windows[1:]):
+        assert end <= start + 1e-6
+
+
+def test_observations_satisfy_the_constraints(staralt_module, result, data):
+    observer = staralt_module.get_location('OT')
+    constraints = [AltitudeConstraint(30*u.deg, 90*u.deg), AirmassConstraint(1.8),
+                   AtNightConstraint.twilight_astronomical()]
+    objects = {obj['name']: obj for obj in data['objects']}
+
+    for obs in result['schedule']:
+        obj = objects[obs['name']]
+        target = FixedTarget(SkyCoord(obj['RA']*u.deg, obj['Dec']*u.deg), name=obj['name'])
+
+        # Middle of each slot of the observation
+        start, end = Time([obs['start'], obs['end']])
+        n_slots = int(round((end - start).to_value(u.min)/SLOT))
+        times = start + (np.arange(n_slots) + 0.5)*SLOT*u.min
+
+        assert is_always_observable(constraints, observer, [target], times=times)[0], obs['name']
+
+        # Long enough for the exposure
+        if 'exposure' in obj:
+            assert n_slots*SLOT >= obj['exposure']
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+ReST services, through the Flask test client
+"""
+
+import pytest
+
+
+def test_plot_urls_only_serve_plots(client):
+    from app.cache import get_cache, cache_key
+
+    # Another entry of the shared cache, with a key like the plot ones
+    key = cache_key('observability', 'test')
+    get_cache().set(key, [{'observable': 'True', 'moon_separation': 30.0}])
+
+    assert client.get('/plot/' + key).status_code == 404
+    assert client.get('/plot/missing').status_code == 404
+
+
+def test_import_creates_no_files(tmp_path):
+    pytest.importorskip('flask')
+    pytest.importorskip('astroplan')
+    pytest.importorskip('matplotlib')
+
+    import os
+    import subprocess
+    import sys
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, XDG_CACHE_HOME=str(tmp_path), HOME=str(tmp_path))
+    env.pop('STARALT_CACHE', None)
+    env.pop('STARALT_NAMES_CACHE', None)
+
+    subprocess.check_call([sys.executable, '-c', 'import app'], cwd=root, env=env)
+
+    assert os.listdir(str(tmp_path)) == []
+
+
+@pytest.mark.parametrize('path, data', [
+    ('/observability', ['OT']),
+    ('/visibility', {'observatory': 'OT', 'days': 'abc', 'objects': []}),
+    ('/observability', {'objects': [], 'date': 'tonight', 'date_end': '2020-06-12'}),
+])
+def test_malformed_requests_are_rejected_with_400(client, path, data):
+    response = client.post(path, json=data)
+
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'Invalid request data'}
+
+
+def observability_objects_request(objects):
+    return {'observatory': 'OT', 'altitude_lower_limit': '30', 'altitude_higher_limit': '90',
+            'objects': objects}
+
+
+def test_observability_objects_single_date(client):
+    data = observability_objects_request([
+        {'name': 'KIC8012732', 'RA': 284.72949583, 'Dec': 43.86421667,
+         'dates': [['2020-06-11 23:00:00']]}])
+
+    response = client.post('/observability_objects', json=data)
+
+    assert response.status_code == 200
+    result = response.get_json()['KIC8012732']
+    assert len(result) == 1
+    assert set(result[0]) == {'observable', 'moon_separation'}
+
+
+def test_observability_objects_sharing_a_night(client):
+    data = observability_objects_request([
+        {'name': 'KIC8012732', 'RA': 284.72949583, 'Dec': 43.86421667,
+         'dates': [['2020-06-11 23:00:00']]},
+        {'name': 'Kelt 8b', 'RA': 283.30551667, 'Dec': 24.12738139,
+         'dates': [['2020-06-11 23:00:00']]},
+        {'name': 'TIC 123456789', 'RA': 13.13055667, 'Dec': 24.13912738,
+         'dates': [['2020-06-11 23:00:00'], ['2020-06-11 00:16:30', '2020-06-11 03:44:26']]}])
+
+    response = client.post('/observability_objects', json=data)
+
+    assert response.status_code == 200
+    result = response.get_json()
+    assert [len(result[name]) for name in ['KIC8012732', 'Kelt 8b', 'TIC 123456789']] == [1, 1, 2]
+    assert all(entry['observable'] in ('True', 'False')
+               for entries in result.values() for entry in entries)
+
+
+@pytest.mark.parametrize('body', ['earth', 'Earth-Moon-Barycenter'])
+def test_observer_bodies_are_rejected(client, body):
+    data = {'observatory': 'OT', 'date': '2020-06-11', 'altitude_lower_limit': '30',
+            'objects': [{'name': 'Home', 'body': body}]}
+
+    response = client.post('/culmination', json=data)
+
+    assert response.status_code == 400
+    assert 'unknown body' in response.get_json()['error']